@@ -1,9 +1,10 @@
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from bs4 import BeautifulSoup, SoupStrainer, MarkupResemblesLocatorWarning, XMLParsedAsHTMLWarning
 from bs4.dammit import EntitySubstitution
 from bs4.formatter import XMLFormatter
 import warnings
 warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
-from bs4.element import Comment
+warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)  # lxml notices the <?xml ...?> at the top of Takeout files
+from html.parser import HTMLParser
 import re
 import os
 from fs.path import basename
@@ -12,13 +13,36 @@ import dateutil.parser
 import datetime
 from calendar import timegm
 import base64
-from io import open, TextIOBase
+from io import open, TextIOBase, TextIOWrapper
 import json
 import isodate
 import argparse
-from operator import itemgetter
 import pprint
 from typing import Optional
+from collections import deque, OrderedDict
+import concurrent.futures
+import multiprocessing
+import contextlib
+import itertools
+import shutil
+import tempfile
+import time
+import sys
+import threading
+import cProfile
+import pstats
+import zipfile
+import tarfile
+import zlib
+import bz2
+import lzma
+import queue
+import stat
+import importlib.util
+import functools
+import hashlib
+import pickle
+from dataclasses import dataclass
 
 __updated__ = "2023-12-06 14:19"
 
@@ -59,6 +83,11 @@ counters = {
     "conflict_warnings":             0,
     "todo_errors":                   0,
     "number_of_discovered_contacts": 0,
+    "call_files_read_quickly":       0,
+    "call_files_fully_parsed":       0,
+    "html_files_from_snapshot":      0,
+    "attachments_from_cache":        0,
+    "attachment_bytes_saved":        0,
     }
 
 # I really don't like globals, but there are just too many things to tote around in all these function calls.
@@ -66,7 +95,6 @@ phone_number_from_filename = None
 contact_name_from_filename = None
 phone_number_from_html_title = None
 contact_name_from_html_title = None
-html_elt: Optional[BeautifulSoup] = None
 
 # This number is used a couple of places where we can't figure out the real number.
 # If you want to manually fix things up, you should be able to easily search for it in
@@ -78,6 +106,14 @@ ATTACHMENT_TYPE_AUDIO = "audio"
 ATTACHMENT_TYPE_VIDEO = "video"
 ATTACHMENT_TYPE_VCARD = "vcard"
 
+# Choices for the HTML parser used to read Google Voice files. They all give the same results.
+# "lxml" is only available if you have installed it (pip install lxml).
+PARSER_AUTO = "auto"
+PARSER_BS4 = "bs4"
+PARSER_LXML = "lxml"
+PARSER_STREAM = "stream"
+have_lxml = importlib.util.find_spec('lxml') is not None
+
 POLICY_ASIS = "asis"
 POLICY_NEWEST = "newest"
 POLICY_CONFIGURED = "configured"
@@ -89,6 +125,71 @@ FORMATTER = XMLFormatter(entity_substitution=EntitySubstitution.substitute_xml_c
 # 2. some name: some number              (a degenerate case that is turned into a list)
 # 3. some name: [some list of numbers]   (all of these numbers are acceptable for this contact name; leftmost is preferred)
 # 4. some number: some other number      (if some number is seen, some other number will be used in output)
+
+# All of the numbers known for one contact name, each as a (number, iso_timestamp, isconfigured) tuple.
+# It gives the same answers as a list of those kept sorted newest first, with ties in the order they
+# got that timestamp, but it's indexed by number so that a discovery doesn't have to scan and re-sort
+# the list. A discovery only ever moves a number's timestamp forward, so the first (best) one can
+# only be replaced by a newer one. The configured numbers get timestamps in the far future.
+class NameNumbers:
+    __slots__ = ('_by_number', '_duplicates', '_first', '_next_sequence')
+
+    def __init__(self):
+        self._by_number = dict()  # number: (timestamped_number, sequence)
+        self._duplicates = list()  # (timestamped_number, sequence) for a number listed twice in the contacts file
+        self._first = None
+        self._next_sequence = 0
+
+    def __len__(self):
+        return len(self._by_number)
+
+    def _put(self, timestamped_number):
+        number, iso_timestamp, __ = timestamped_number
+        self._by_number[number] = (timestamped_number, self._next_sequence)
+        self._next_sequence += 1
+        if self._first is None or iso_timestamp > self._first[1] or number == self._first[0]:
+            self._first = timestamped_number
+
+    def add_configured(self, number, iso_timestamp):
+        timestamped_number = (number, iso_timestamp, True)
+        if number in self._by_number:
+            self._duplicates.append((timestamped_number, self._next_sequence))
+            self._next_sequence += 1
+        else:
+            self._put(timestamped_number)
+
+    # True if it's a number we didn't already have for this name
+    def add_discovered(self, number, iso_timestamp):
+        existing = self._by_number.get(number, None)
+        if existing:
+            (__, this_timestamp, __), __ = existing
+            if iso_timestamp > this_timestamp:
+                # it's a newer discovery
+                # we only want to update discovered items, but the timestamps of the configured items
+                # will already deal with that because configured timestamps are artificially far future
+                self._put((number, iso_timestamp, False))
+            return False
+        self._put((number, iso_timestamp, False))
+        return True
+
+    def first(self):
+        return self._first
+
+    def has_number(self, number):
+        return number in self._by_number
+
+    def has_configured_number(self, number):
+        existing = self._by_number.get(number, None)
+        if existing and existing[0][2]:
+            return True
+        return any(timestamped_number[0] == number for timestamped_number, __ in self._duplicates)
+
+    def as_list(self):
+        entries = list(self._by_number.values()) + self._duplicates
+        entries.sort(key=lambda entry: entry[1])
+        entries.sort(key=lambda entry: entry[0][1], reverse=True)
+        return [timestamped_number for timestamped_number, __ in entries]
+
 class ContactsOracle:
     def __init__(self, contacts_filename, policy, nanp_heuritics):
         self._contacts_filename = contacts_filename
@@ -98,6 +199,11 @@ class ContactsOracle:
         self._number_to_names = dict()
         self._policy = policy
         self._nanp_heuristics = nanp_heuritics
+        # Answers to the lookup methods, since they get asked the same things over and over. Anything
+        # that changes what the oracle knows throws them all away. See precompute().
+        self._resolutions = dict()
+        self._resolution_hits = 0
+        self._resolution_misses = 0
 
         if not os.path.exists(self._contacts_filename):
             print('>> No (optional) JSON contacts file', os.path.abspath(self._contacts_filename))
@@ -133,20 +239,17 @@ class ContactsOracle:
                 f'"{name}" entry value of type {type(value)} is not a string or a list: {value}\n    in {get_aka_path(self._contacts_filename)}')
 
         far_future = 2_000_000_000  # a pseudo-Unix timestamp, in seconds, in the distant future
+        name_numbers = NameNumbers()
         for ii in range(len(values)):
             value = values[ii]
             if not is_phone_number(value):
                 raise Exception(
                     f'"{name}" entry value of type {type(value)} is not a phone number: {value}\n    in {get_aka_path(self._contacts_filename)}')
-            # (value, timestamp, isconfigured)
             value = self.apply_nanp_heuristics(value)
             far_future_iso = unix_to_iso_time(far_future - ii)
-            timestamped_number = (value, far_future_iso, True)
-            values[ii] = timestamped_number
+            name_numbers.add_configured(value, far_future_iso)
             self._add_number_to_name_item(name, value)
-        # these are already reverse sorted; just belt and suspenders
-        values.sort(key=itemgetter(1), reverse=True)
-        self._name_to_numbers[name] = values
+        self._name_to_numbers[name] = name_numbers
 
     def _add_number_to_name_item(self, name, number):
         number = self.apply_nanp_heuristics(number)
@@ -163,19 +266,53 @@ class ContactsOracle:
         number = self.apply_nanp_heuristics(number)
         self._number_to_number[name] = number
 
+    def _resolve(self, key, compute, *args):
+        try:
+            value = self._resolutions[key]
+            self._resolution_hits += 1
+            return value
+        except KeyError:
+            pass
+        value = compute(*args)
+        self._resolution_misses += 1
+        self._resolutions[key] = value
+        return value
+
+    # Once the first pass has found all the contacts, work out the answers for every name and number
+    # we know about. The second pass still discovers a few things as it goes, and each time that
+    # changes what the oracle knows, these are thrown away and worked out again as needed.
+    def precompute(self):
+        for name in list(self._name_to_numbers) + list(self._name_to_name):
+            try:
+                self.get_number_by_name(name, None)
+            except RecursionError:
+                pass  # a loop of aliases in the contacts file; leave it for whoever actually asks
+        for number in list(self._number_to_names) + list(self._number_to_number):
+            try:
+                self.get_best_number(number)
+            except RecursionError:
+                pass
+
+    def get_resolution_counts(self):
+        return self._resolution_hits, self._resolution_misses
+
+    # for lookups done by a copy of the oracle in a chat worker process
+    def add_resolution_counts(self, hits, misses):
+        self._resolution_hits += hits
+        self._resolution_misses += misses
+
     def is_already_known_pair(self, name, number):
+        return self._resolve(('is_already_known_pair', name, number), self._is_already_known_pair, name, number)
+
+    def _is_already_known_pair(self, name, number):
         if not name or not number:
             return False
         number = self.apply_nanp_heuristics(number)
-        existing_list = self._name_to_numbers.get(name, None)
-        if not existing_list:
+        name_numbers = self._name_to_numbers.get(name, None)
+        if not name_numbers:
             alias_to = self._name_to_name.get(name, None)
             return self.is_already_known_pair(alias_to, number)
-        for list_item in existing_list:
-            this_number = list_item[0]
-            if this_number == number:
-                return True
-        return False
+        return name_numbers.has_number(number)
 
     def is_me_number(self, number):
         names = self._number_to_names.get(number, None)
@@ -183,7 +320,6 @@ class ContactsOracle:
             return False
         return 'Me' in names
 
-    # This is really inefficient, but we're banking on the set of contacts being managable
     def add_discovered_contact(self, name, number, timestamp):
         # We could ignore any discovered contacts for policy "configured", but we want to
         # do proper countihg and give messages to the user, etc.
@@ -191,33 +327,18 @@ class ContactsOracle:
             # it's a number that pairs with itself instead of a name, so ignore it.
             return False
         number = self.apply_nanp_heuristics(number)
-        existing_list = self._name_to_numbers.get(name, None)
-        if not existing_list:
-            existing_list = list()
-            self._name_to_numbers[name] = existing_list
-        found_it = False
-        # (value, timestamp, isconfigured)
-        iso_timestamp = unix_to_iso_time(timestamp)
-        new_tuple = (number, iso_timestamp, False)
-        for ii in range(len(existing_list)):
-            this_tuple = existing_list[ii]
-            this_number, this_timestamp, this_isconfigured = this_tuple
-            if this_number == number:
-                found_it = True
-                if iso_timestamp > this_timestamp:
-                    # it's a newer discovery
-                    # we only want to update discovered items, but the timestamps of the configured items
-                    # will already deal with that because configured timestamps are artificially far future
-                    existing_list[ii] = new_tuple
-                break
-
-        if not found_it:
-            existing_list.append(new_tuple)
+        name_numbers = self._name_to_numbers.get(name, None)
+        if name_numbers is None:
+            name_numbers = NameNumbers()
+            self._name_to_numbers[name] = name_numbers
+        first_before = name_numbers.first()
+        is_new = name_numbers.add_discovered(number, unix_to_iso_time(timestamp))
+        if is_new:
             self._add_number_to_name_item(name, number)
-
-        existing_list.sort(key=itemgetter(1), reverse=True)
-
-        return not found_it
+        if is_new or name_numbers.first() != first_before:
+            # The lookups only ever see the first number for a name and which numbers a name has.
+            self._resolutions.clear()
+        return is_new
 
     # The strategy for this method and the next is to first do a lookup by the
     # passed in key. If that doesn't yield a result, see if the key is an
@@ -226,6 +347,10 @@ class ContactsOracle:
     # The argument "number" is typically None, but if it does have a value
     # we'll see if we can do better, where "better" is according to policy.
     def get_number_by_name(self, name, number):
+        # _policy_asis() switches the policy for a moment, so it has to be part of the key
+        return self._resolve(('get_number_by_name', self._policy, name, number), self._get_number_by_name, name, number)
+
+    def _get_number_by_name(self, name, number):
         if not name:                            return number  # only happens by recursion
         number = self.apply_nanp_heuristics(number)
         if self._policy == POLICY_ASIS:
@@ -249,10 +374,9 @@ class ContactsOracle:
                 self._policy = POLICY_ASIS
 
     def _policy_newest(self, name):
-        candidate_list = self._name_to_numbers.get(name, None)
-        if candidate_list:
-            # candidate_list will be a list with the first item the preferred number
-            this_number, this_timestamp, this_isconfigured = candidate_list[0]
+        name_numbers = self._name_to_numbers.get(name, None)
+        if name_numbers:
+            this_number, this_timestamp, this_isconfigured = name_numbers.first()
             return this_number
         else:
             aliased_to = self._name_to_name.get(name, None)
@@ -260,19 +384,17 @@ class ContactsOracle:
 
     def _policy_configured(self, name, number):
         value = None
-        candidate_list = self._name_to_numbers.get(name, None)
-        if candidate_list:
+        name_numbers = self._name_to_numbers.get(name, None)
+        if name_numbers:
             # if no candidate number was passed in, return the best configured number
             if not number:
-                this_number, this_timestamp, this_isconfigured = candidate_list[0]
+                this_number, this_timestamp, this_isconfigured = name_numbers.first()
                 if this_isconfigured:
                     value = this_number
             else:
                 # a number was passed in, so vet it
-                for this_number, this_timestamp, this_isconfigured in candidate_list:
-                    if this_isconfigured and number == this_number:
-                        value = this_number
-                        break
+                if name_numbers.has_configured_number(number):
+                    value = number
 
         if value:
             return value
@@ -281,6 +403,9 @@ class ContactsOracle:
             return self.get_number_by_name(aliased_to, None)
 
     def get_names_by_number(self, number):
+        return self._resolve(('get_names_by_number', number), self._get_names_by_number, number)
+
+    def _get_names_by_number(self, number):
         if not number:
             return None
         number = self.apply_nanp_heuristics(number)
@@ -291,6 +416,9 @@ class ContactsOracle:
         return self.get_names_by_number(self._number_to_number.get(number, None))
 
     def get_best_number(self, number):
+        return self._resolve(('get_best_number', number), self._get_best_number, number)
+
+    def _get_best_number(self, number):
         number = self.apply_nanp_heuristics(number)
         if self._policy == POLICY_ASIS:
             return number
@@ -300,9 +428,9 @@ class ContactsOracle:
         if names:
             for name in names:
                 # iterate over all the names, choosing the latest timestamp from among all of them
-                tuples = self._name_to_numbers.get(name, None)
-                if tuples:
-                    this_number, this_timestamp, this_isconfigured = tuples[0]
+                name_numbers = self._name_to_numbers.get(name, None)
+                if name_numbers:
+                    this_number, this_timestamp, this_isconfigured = name_numbers.first()
                     if self._policy == POLICY_CONFIGURED and not this_isconfigured:
                         continue
                     if this_timestamp > best_timestamp:
@@ -316,20 +444,13 @@ class ContactsOracle:
     def apply_nanp_heuristics(self, number):
         if not self._nanp_heuristics or not number:
             return number
-
-        if len(number) == 10 and not number.startswith('1'):
-            return '+1' + number
-        elif len(number) == 11 and number.startswith('1'):
-            return '+' + number
-        else:
-            # This is unlikely to work out
-            return number
+        return get_nanp_number(number)
 
     def dump(self):
         pp = pprint.PrettyPrinter(indent=2, width=132)
         print()
         print("Mappings of names-to-numbers (configured True, discovered False):")
-        pp.pprint(self._name_to_numbers)
+        pp.pprint({name: name_numbers.as_list() for name, name_numbers in self._name_to_numbers.items()})
         print()
         print("Mappings of numbers-to-names (computed reverse mappings)")
         pp.pprint(self._number_to_names)
@@ -348,8 +469,7 @@ contacts_oracle: Optional[ContactsOracle] = None
 def main():
     global sms_backup_file, vm_backup_file, call_backup_file, chat_backup_file
     global contacts_oracle
-    global html_elt
-    
+    global voice_file_parser, compat_xml, attachment_cache, takeout_archive
     # This file is *optional* unless you get an error message asking you to add entries to it.
     contacts_filename = os.path.join('..', 'contacts.json')
     # SMS Backup and Restore likes to notice filenames that start with "sms-" or "calls-".
@@ -391,6 +511,11 @@ def main():
                            default=chat_backup_filename, 
                            help=f"File to receive SMS/MMS messages from Google Chat. Defaults to \"{chat_backup_filename}\".")
 
+    argparser.add_argument('--takeout_archive',
+                           default=None,
+                           nargs='+',
+                           metavar='ARCHIVE_FILENAME',
+                           help=f"Read the Google Voice and Google Chat files straight from the Takeout .zip or .tgz file(s) instead of from an unpacked \"Takeout/\" directory. Give all of the parts if Takeout split it up. The voice_directory and chat_directory are then inside the \"Takeout/\" folder of the archive. By default, the files are read from the file system.")
     argparser.add_argument('-j', '--contacts_filename',    
                            default=contacts_filename,    
                            help=f"JSON formatted file of definitive contact name/number pairs. Defaults to \"{contacts_filename}\".")
@@ -401,6 +526,47 @@ def main():
     argparser.add_argument('-n', '--nanp_numbers',
                            action='store_true',
                            help=f"Heuristically treat some partial numbers as North American numbers.")
+    argparser.add_argument('--compression',
+                           default=COMPRESSION_NONE,
+                           choices=(COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_BZ2, COMPRESSION_XZ),
+                           help=f"Compress the output files as they are written. The matching extension (\".gz\", \".bz2\", or \".xz\") is added to the output filenames if they don't already end with it. Defaults to \"{COMPRESSION_NONE}\".")
+    argparser.add_argument('--parser',
+                           default=PARSER_AUTO,
+                           choices=(PARSER_AUTO, PARSER_BS4, PARSER_LXML, PARSER_STREAM),
+                           help=f"HTML parser for reading Google Voice files. They all give the same results, but some are faster. \"{PARSER_AUTO}\" picks the fastest one available. Defaults to \"{PARSER_AUTO}\".")
+    argparser.add_argument('--jobs',
+                           default=1,
+                           type=int,
+                           help=f"Number of worker processes for reading and converting Google Voice and Google Chat files. 0 means one per CPU. The output is the same no matter how many. Defaults to 1.")
+    argparser.add_argument('--snapshot_filename',
+                           default=None,
+                           help=f"File for saving what the 1st pass over the Google Voice HTML files finds. If nothing under the voice_directory has changed since it was saved, the 1st pass is skipped. By default, there is no snapshot.")
+    argparser.add_argument('--attachment_cache_megabytes',
+                           default=ATTACHMENT_CACHE_MEGABYTES,
+                           type=int,
+                           help=f"Memory for remembering the encoded contents of attachments, so that an attachment that appears more than once is only encoded once. 0 turns it off. Defaults to {ATTACHMENT_CACHE_MEGABYTES}.")
+    argparser.add_argument('--attachment_threads',
+                           default=ATTACHMENT_THREADS,
+                           type=int,
+                           help=f"Number of threads for reading and encoding attachments ahead of time while the rest of the work goes on. It's only used when there is a single process (see --jobs). 0 turns it off. Defaults to {ATTACHMENT_THREADS}.")
+    argparser.add_argument('--metrics_filename',
+                           default=None,
+                           help=f"JSON file for writing the counters, how long each stage took, and histograms of per-file timings, for keeping track of performance. By default, there is no metrics file.")
+    argparser.add_argument('--profile_filename',
+                           default=None,
+                           help=f"Profile the run and write the results to PROFILE_FILENAME.pstats (for pstats, snakeviz, and friends) and PROFILE_FILENAME.collapsed (collapsed stacks for flame graph tools). A summary of the busiest functions is printed at the end. Work done by --jobs worker processes is not included. By default, there is no profiling.")
+    argparser.add_argument('--profile_stages',
+                           default=[PROFILE_ALL_STAGES],
+                           nargs='+',
+                           choices=(PROFILE_ALL_STAGES,) + STAGE_NAMES,
+                           help=f"With --profile_filename, the stages of the run to profile. Defaults to \"{PROFILE_ALL_STAGES}\".")
+    argparser.add_argument('--profile_top',
+                           default=25,
+                           type=int,
+                           help=f"With --profile_filename, how many functions to list in the summary. Defaults to 25.")
+    argparser.add_argument('--compat_xml',
+                           action='store_true',
+                           help=f"Lay out the XML output exactly the way older versions of this script did, for comparing output files. The content is the same either way.")
     argparser.add_argument('-z', '--dump_data',
                            action='store_true',
                            help=f"Dump some internal tables at the end of the run, which might help with sorting out some thing.")
@@ -410,35 +576,98 @@ def main():
     sms_backup_filename = args['sms_backup_filename']
     vm_backup_filename = args['vm_backup_filename']
     call_backup_filename = args['call_backup_filename']
+    chat_backup_filename = args['chat_backup_filename']
     voice_directory = args['voice_directory']
     chat_directory = args['chat_directory']
     contacts_filename = args['contacts_filename']
     number_policy = args['number_policy']
     nanp_heuritstics = args['nanp_numbers']
     dump_data = args['dump_data']
-
+    voice_file_parser = choose_voice_file_parser(args['parser'])
+    jobs = args['jobs']
+    compat_xml = args['compat_xml']
+    snapshot_filename = args['snapshot_filename']
+    metrics_filename = args['metrics_filename']
+    profile_filename = args['profile_filename']
+    attachment_cache = AttachmentCache(args['attachment_cache_megabytes'] * 1024 * 1024)
+    compression = args['compression']
+    sms_backup_filename = get_compressed_filename(sms_backup_filename, compression)
+    vm_backup_filename = get_compressed_filename(vm_backup_filename, compression)
+    call_backup_filename = get_compressed_filename(call_backup_filename, compression)
+    chat_backup_filename = get_compressed_filename(chat_backup_filename, compression)
+    stdout_filenames = [filename for filename in (sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename) if is_stdout_output(filename)]
+    if len(stdout_filenames) > 1:
+        raise Exception(f'Only one output file can be standard output, not {len(stdout_filenames)} of them')
+    if stdout_filenames:
+        send_stdout_to_stderr()
+
+    if profile_filename:
+        start_profiler(args['profile_stages'], jobs)
+    start_stage('setup')
+    if args['takeout_archive']:
+        takeout_archive = TakeoutArchive(args['takeout_archive'])
     contacts_oracle = ContactsOracle(contacts_filename, number_policy, nanp_heuritstics)    
     prep_output_files(sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename)
     
-    print('>> 1st pass reading *.html files under', get_aka_path(voice_directory))
-    # We make two passes over the HTML files. The first pass is merely to gather contact info so that
+    # We make two passes over the HTML files. The first pass gathers contact info so that
     # we have the complete picture before starting the second ("real") pass. That's so that we can
-    # correctly apply phone number replacement policies for all of the HTML files. It's true that
-    # some of the policies do not require this complete picture, and we could greatly reduce the files
-    # processed in the second pass (maybe even not needing a second pass), but that clutters up the 
-    # logic quite a bit. Since this is a one-time migration, efficiency is not that critical and we
-    # accept the inefficiency for some number_policy cases.
-    for subdirectory, __, files in os.walk(voice_directory):
-        for html_basename in files:
-            html_target = (subdirectory, html_basename)
-            process_one_voice_file(True, html_target)
-
-    with (open(sms_backup_filename,  'w', encoding='utf-8', newline='\n') as sms_backup_file,
-          open(vm_backup_filename,   'w', encoding='utf-8', newline='\n') as vm_backup_file,
-          open(call_backup_filename, 'w', encoding='utf-8', newline='\n') as call_backup_file,
-          open(chat_backup_filename, 'w', encoding='utf-8', newline='\n') as chat_backup_file):
+    # correctly apply phone number replacement policies for all of the HTML files. The first pass
+    # is also the only time we parse the HTML. Everything the second pass needs is pulled out into
+    # a compact VoiceFileRecord, so the second pass never has to reopen or re-parse a file.
+    start_stage('scan')
+    file_catalogue.scan(voice_directory)
+    file_catalogue.scan(chat_directory)
+    start_worker_pool(jobs, args['attachment_threads'])
+    start_stage('pass1')
+    first_pass_snapshot = None
+    first_pass_skipped = False
+    if snapshot_filename:
+        fingerprint = get_catalogue_fingerprint(voice_directory)
+        first_pass_snapshot = load_first_pass_snapshot(snapshot_filename, fingerprint)
+    if first_pass_snapshot:
+        print('>> 1st pass skipped; nothing has changed under', get_aka_path(voice_directory), 'since the snapshot in', get_aka_path(snapshot_filename))
+        # nothing was read this time, so the reader counts from the snapshot don't apply
+        first_pass_skipped = True
+        counters['html_files_from_snapshot'] = sum(1 for entry in file_catalogue.files_under(voice_directory) if entry.kind == FILE_KIND_HTML)
+    else:
+        print(f">> Reading Google Voice HTML files with the '{voice_file_parser}' parser")
+        print('>> 1st pass reading *.html files under', get_aka_path(voice_directory))
+        html_targets = [entry.target for entry in file_catalogue.files_under(voice_directory) if entry.kind == FILE_KIND_HTML]
+        first_pass_snapshot = FirstPassSnapshot(SNAPSHOT_VERSION, None, list(), list(), dict())
+        for some_voice_file_records, contact_sightings, reader_counts, some_histograms in read_voice_files(html_targets):
+            merge_histograms(some_histograms)
+            first_pass_snapshot.voice_file_records.extend(some_voice_file_records)
+            first_pass_snapshot.contact_sightings.extend(contact_sightings)
+            for counter_name, count in reader_counts.items():
+                first_pass_snapshot.reader_counts[counter_name] = first_pass_snapshot.reader_counts.get(counter_name, 0) + count
+        if snapshot_filename:
+            first_pass_snapshot.fingerprint = fingerprint
+            save_first_pass_snapshot(snapshot_filename, first_pass_snapshot)
+    # The contacts file and the policy might be different from the run that made the snapshot, so
+    # the sightings are always merged into the ContactsOracle fresh. That part is quick.
+    start_stage('contacts')
+    voice_file_records = first_pass_snapshot.voice_file_records
+    merge_contact_sightings(first_pass_snapshot.contact_sightings)
+    if not first_pass_skipped:
+        for counter_name, count in first_pass_snapshot.reader_counts.items():
+            counters[counter_name] += count
+    contacts_oracle.precompute()
+
+    with (BackupFile(sms_backup_filename,  compression) as sms_backup_file,
+          BackupFile(vm_backup_filename,   compression) as vm_backup_file,
+          BackupFile(call_backup_filename, compression) as call_backup_file,
+          BackupFile(chat_backup_filename, compression) as chat_backup_file,
+          tempfile.TemporaryDirectory(prefix='sms-chat-') as chat_spool_directory):
         
+        start_stage('pass2')
         write_dummy_headers()
+        header_counts = None
+        if any(backup_file.header_first for backup_file in (sms_backup_file, vm_backup_file, call_backup_file, chat_backup_file)):
+            start_stage('headers')
+            print('>> Some output files are compressed or are not regular files, so their records are counted ahead of time and their headers are written first')
+            header_counts = count_output_records(voice_file_records, file_catalogue.directories_under(chat_directory))
+            write_real_headers(header_counts, True)
+            start_stage('pass2')
         
         me_contact_number = contacts_oracle.get_number_by_name('Me', None)
         if not me_contact_number:
@@ -451,41 +680,167 @@ def main():
             print(f">> Your 'Me' phone number is {me_contact_number}")
 
         print('>> 2nd pass reading *.html files under', get_aka_path(voice_directory))
-        # second pass over GV files
-        for subdirectory, __, files in os.walk(voice_directory):
-            for html_basename in files:
-                html_target = (subdirectory, html_basename)
-                process_one_voice_file(False, html_target)
+        # second pass over GV files, working only from what the first pass extracted
+        for voice_file_record in voice_file_records:
+            start_time = time.perf_counter()
+            process_one_voice_file(voice_file_record)
+            add_timing('second_pass_file_seconds', time.perf_counter() - start_time)
 
+        start_stage('chat')
         print('>> Reading chat files under', get_aka_path(chat_directory))
-        for subdirectory, __, __ in os.walk(chat_directory):
-            process_one_chat_directory(me_contact_number, subdirectory)
+        process_chat_directories(me_contact_number, file_catalogue.directories_under(chat_directory), chat_spool_directory)
 
+        start_stage('flush')
+        flush_fragments()
         write_trailers()
-    
-    # we have to reopen the files with a different mode for this
-    write_real_headers(sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename)
+
+        # the dummy headers get replaced as the files are closed
+        start_stage('headers')
+        write_real_headers(counters, False)
+        if header_counts:
+            check_header_counts(header_counts)
+    stop_worker_pool()
+    start_stage('report')
     print_counters(contacts_filename, sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename)
     if dump_data:
         contacts_oracle.dump()
 
-    for subdirectory, __, files in os.walk(voice_directory):
-        for basename in files:
-            if get_rel_path((subdirectory, basename)) not in files_used:
-                print(f"Warning: {get_rel_path((subdirectory, basename))} was not used")
+    start_stage('audit')
+    unused_rel_paths = {entry.rel_path for entry in file_catalogue.files_under(voice_directory)} - files_used
+    for entry in file_catalogue.files_under(voice_directory):
+        if entry.rel_path in unused_rel_paths:
+            print(f"Warning: {entry.rel_path} was not used")
+    start_stage(None)
+    if profile_filename:
+        stop_profiler(profile_filename, args['profile_top'])
+    if metrics_filename:
+        write_metrics(metrics_filename, args)
+
+# For --jobs. Each chat group only reads the ContactsOracle, so the groups can be done in worker processes.
+# A worker writes one group's records to a spool file and holds on to anything it prints. The parent
+# copies the spools into the chat_backup_file and prints the messages in the same order a single
+# process would have done the groups. The chat pool is separate from the worker_pool because its
+# processes need the ContactsOracle as it is after the first pass.
+def process_chat_directories(me_contact_number, subdirectories, spool_directory):
+    if not worker_pool:
+        for subdirectory in subdirectories:
+            process_one_chat_directory(me_contact_number, subdirectory)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count, mp_context=get_worker_context(), initializer=init_chat_worker, initargs=(compat_xml, contacts_oracle, file_catalogue, attachment_cache.budget, takeout_archive, spool_directory)) as chat_pool:
+        for spool_filename, chat_log_pieces, counts, resolution_counts, some_files_used, some_histograms in chat_pool.map(spool_one_chat_directory, itertools.repeat(me_contact_number), subdirectories):
+            print_chat_log(chat_log_pieces)
+            for counter_name, count in counts.items():
+                counters[counter_name] += count
+            contacts_oracle.add_resolution_counts(*resolution_counts)
+            merge_histograms(some_histograms)
+            files_used.update(some_files_used)
+            copy_chat_spool_file(spool_filename)
+
+def copy_chat_spool_file(spool_filename):
+    with open(spool_filename, 'r', encoding='utf-8', newline='\n') as spool_file:
+        shutil.copyfileobj(spool_file, chat_backup_file)
+    os.remove(spool_filename)
+
+def init_chat_worker(compat, oracle, catalogue, attachment_cache_budget, archive, spool_directory):
+    global compat_xml, contacts_oracle, file_catalogue, worker_pool, prefetch_pool, attachment_cache, takeout_archive
+    global chat_spool_directory
+    compat_xml = compat
+    chat_spool_directory = spool_directory
+    takeout_archive = archive
+    contacts_oracle = oracle
+    file_catalogue = catalogue
+    attachment_cache = AttachmentCache(attachment_cache_budget)
+    worker_pool = None  # a forked process might have a copy of the parent's
+    prefetch_pool = None  # likewise
+    histograms.clear()  # likewise
+
+# The spool files go in a temporary directory that belongs to the parent, so that they are cleaned
+# up even if something goes wrong before the parent gets to them.
+chat_spool_directory = None
+
+def spool_one_chat_directory(me_contact_number, subdirectory):
+    global chat_backup_file, chat_log
+    chat_backup_file = None
+    counts_before = dict(counters)
+    resolution_hits_before, resolution_misses_before = contacts_oracle.get_resolution_counts()
+    files_used.clear()
+    chat_log = ChatLog()
+    try:
+        with (tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', prefix='sms-chat-', suffix='.xml', dir=chat_spool_directory, delete=False) as chat_backup_file,
+              contextlib.redirect_stdout(chat_log)):
+            process_one_chat_directory(me_contact_number, subdirectory)
+    except BaseException:
+        if chat_backup_file:
+            os.remove(chat_backup_file.name)
+        raise
+    counts = {counter_name: count - counts_before[counter_name] for counter_name, count in counters.items()}
+    resolution_hits, resolution_misses = contacts_oracle.get_resolution_counts()
+    resolution_counts = (resolution_hits - resolution_hits_before, resolution_misses - resolution_misses_before)
+    return chat_backup_file.name, chat_log.get_pieces(), counts, resolution_counts, set(files_used), take_histograms()
+
+# What a chat worker printed for one group. A missing contact is kept as (name, email, json_target)
+# instead of text, because whether it gets reported depends on what the groups before it reported.
+chat_log = None
+
+class ChatLog:
+    def __init__(self):
+        self.pieces = list()
+        self.text = list()
+
+    def write(self, text):
+        self.text.append(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def add_missing_contact(self, name, email, json_target):
+        self.flush_text()
+        self.pieces.append((name, email, json_target))
+
+    def flush_text(self):
+        if self.text:
+            self.pieces.append(''.join(self.text))
+            self.text.clear()
+
+    def get_pieces(self):
+        self.flush_text()
+        return self.pieces
+
+def print_chat_log(chat_log_pieces):
+    for piece in chat_log_pieces:
+        if isinstance(piece, str):
+            print(piece, end='')
+        else:
+            report_missing_chat_contact(*piece)
+
+def report_missing_chat_contact(name, email, json_target):
+    if chat_log:
+        chat_log.add_missing_contact(name, email, json_target)
+        return
+    if email not in missing_contacts or name not in missing_contacts:
+        print()
+        print(f'TODO:     Missing or disallowed +phonenumber for contact: "{name}": "+",')
+        print(f'TODO: and Missing or disallowed +phonenumber for contact: "{email}": "+",')
+        print(f'      due to File: "{get_abs_path(json_target)}"')
+        counters['todo_errors'] += 1
+        missing_contacts.add(name)
+        missing_contacts.add(email)
 
 def process_one_chat_directory(me_contact_number, subdirectory):
+    start_time = time.perf_counter()
     participants = process_chat_group_info(me_contact_number, subdirectory)
     process_chat_messages(me_contact_number, subdirectory, participants)
+    add_timing('chat_group_seconds', time.perf_counter() - start_time)
 
 def process_chat_group_info(me_contact_number, subdirectory):
     group_info_basename = "group_info.json"
     group_info_filename = os.path.join(subdirectory, group_info_basename)
     json_target = (subdirectory, group_info_basename)
-    if not os.path.exists(group_info_filename):
+    if not file_catalogue.has_file(json_target):
         return None
     
-    with open(group_info_filename, "r") as fp:
+    with open_input_file(group_info_filename) as fp:
         parsed_group_info = json.load(fp)
 
     me_in_participants = False 
@@ -496,14 +851,7 @@ def process_chat_group_info(me_contact_number, subdirectory):
         name = member["name"]
         name_number = contacts_oracle.get_number_by_name(name, None)
         if not email_number and not name_number:
-            if email not in missing_contacts or name not in missing_contacts:
-                print()
-                print(f'TODO:     Missing or disallowed +phonenumber for contact: "{name}": "+",')
-                print(f'TODO: and Missing or disallowed +phonenumber for contact: "{email}": "+",')
-                print(f'      due to File: "{get_abs_path(json_target)}"')
-                counters['todo_errors'] += 1
-                missing_contacts.add(name)
-                missing_contacts.add(email)
+            report_missing_chat_contact(name, email, json_target)
         else:
             if email_number and name_number and email_number != name_number:
                 print(f'>> Info: conflicting information for email {email}: {email_number} versus name {name}: {name_number}. Using {name_number}.')
@@ -530,14 +878,12 @@ def process_chat_messages(me_contact_number, subdirectory, participants):
     messages_basename = "messages.json"
     messages_filename = os.path.join(subdirectory, messages_basename)
     json_target = (subdirectory, messages_basename)
-    if not os.path.exists(messages_filename):
+    if not file_catalogue.has_file(json_target):
         return None
     
-    with open(messages_filename, "r") as fp:
-        parsed_messages = json.load(fp)
-        
+    # The messages are read one at a time. Some chats have so many that the whole file won't fit in memory.
+    message_list = iter_json_file_array(messages_filename, 'messages')
     attachment_collisions = dict()
-    message_list = parsed_messages['messages']
     for message in message_list:
         creator = message['creator']
         name = creator['name']
@@ -569,6 +915,99 @@ def process_chat_messages(me_contact_number, subdirectory, participants):
                 attachment_list.append((original_name, export_path_revised))
         write_message_for_chat(json_target, me_contact_number, sender_number, participants, created_date, text, attachment_list)
 
+# For count_output_records(). process_chat_messages() writes one record for each message.
+def count_chat_messages(subdirectory):
+    messages_basename = "messages.json"
+    if not file_catalogue.has_file((subdirectory, messages_basename)):
+        return 0
+    return sum(1 for __ in iter_json_file_array(os.path.join(subdirectory, messages_basename), 'messages'))
+
+# Like json.load(fp)[key] for a top-level object, where that value is an array, but it reads a bit
+# at a time and hands back the items of the array one by one.
+JSON_READ_SIZE = 64 * 1024
+JSON_WHITESPACE = ' \t\n\r'
+JSON_DELIMITERS = tuple(JSON_WHITESPACE + ',]}')
+
+def iter_json_file_array(filename, key):
+    with open_input_file(filename) as fp:
+        yield from iter_json_array(fp, key)
+
+def iter_json_array(fp, key):
+    reader = JsonReader(fp)
+    reader.expect('{')
+    while not reader.maybe('}'):
+        this_key = reader.decode()
+        reader.expect(':')
+        if this_key != key:
+            reader.decode()  # not the one we want
+        else:
+            reader.expect('[')
+            if not reader.maybe(']'):
+                while True:
+                    yield reader.decode()
+                    if reader.maybe(']'):
+                        break
+                    reader.expect(',')
+            return
+        if not reader.maybe(','):
+            reader.expect('}')
+            break
+    raise KeyError(key)
+
+class JsonReader:
+    def __init__(self, fp):
+        self._fp = fp
+        self._buffer = ''
+        self._position = 0
+        self._at_eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _read_more(self):
+        if self._at_eof:
+            return False
+        if self._position:
+            self._buffer = self._buffer[self._position:]
+            self._position = 0
+        # read more each time, so that one huge value doesn't take forever
+        more = self._fp.read(max(JSON_READ_SIZE, len(self._buffer)))
+        if not more:
+            self._at_eof = True
+            return False
+        self._buffer += more
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in JSON_WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer) or not self._read_more():
+                return
+
+    def maybe(self, character):
+        self._skip_whitespace()
+        if self._buffer.startswith(character, self._position):
+            self._position += 1
+            return True
+        return False
+
+    def expect(self, character):
+        if not self.maybe(character):
+            raise json.JSONDecodeError(f'Expecting {character!r}', self._buffer, self._position)
+
+    def decode(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # a number cut off by the end of the buffer might have more digits, fraction, or exponent still to come
+                if self._at_eof or self._buffer[end:end+1] in JSON_DELIMITERS:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._at_eof:
+                    raise
+            self._read_more()
+
 def write_message_for_chat(json_target, me_contact_number, sender_number, participants, created_date, the_text, attachment_list):
     name_list = contacts_oracle.get_names_by_number(sender_number)
     sent_by_me = (me_contact_number == sender_number)
@@ -576,36 +1015,464 @@ def write_message_for_chat(json_target, me_contact_number, sender_number, partic
         message_type = '2'
     else:
         message_type = '1'
-    timestamp = unix_time_ms_from_datetime(datetime_from_string(created_date))
-    #attachment_elts = get_attachment_elts(message_elt)
-    parent_elt = BeautifulSoup()
-    parent_elt.append(bs4_get_file_comment(json_target))
+    timestamp = unix_ms_from_chat_time(created_date)
+    comment_path = use_file(json_target)
     # if it was just an attachment with no text, there is no point in creating an empty SMS to go with it
     if the_text and not attachment_list and len(participants) == 1:
         for other_party_number in participants:
             if other_party_number != me_contact_number:
                 break
-        bs4_append_sms_elt(parent_elt, other_party_number, timestamp, the_text, message_type)
+        fragment = SmsFragment(comment_path, other_party_number, timestamp, the_text, message_type)
     else:
         msgbox_type = message_type
-        bs4_append_mms_elt_with_parts_for_chat(parent_elt, json_target, attachment_list, the_text, sender_number, sent_by_me, timestamp, msgbox_type, participants)
-    chat_backup_file.write(parent_elt.prettify(formatter=FORMATTER))
-    chat_backup_file.write('\n')
+        fragment = get_mms_fragment_for_chat(comment_path, attachment_list, the_text, sender_number, sent_by_me, timestamp, msgbox_type, participants)
+    write_fragment(chat_backup_file, fragment)
     counters['number_of_chat_sms_output'] += 1
 
-def process_one_voice_file(is_first_pass, html_target):
-    global html_elt
+# Everything the second pass needs from one Google Voice HTML file. The first pass
+# builds these while it has the parsed HTML in hand so that the second pass can do
+# contact resolution and XML output without reopening or re-parsing any files.
+@dataclass
+class VoiceMessageRecord:
+    the_text: Optional[str]
+    message_type: int
+    timestamp: int
+    vcards: list       # (number, name) for each vcard in the message
+    attachments: list  # (attachment_type, attachment_file_ref); attachment_type None for unrecognized
+
+@dataclass
+class VoiceFileRecord:
+    html_target: tuple
+    title_value: str
+    tag_values: set
+    timestamp: int     # from the first "dt" or "published" element in the body
+    vcards: list       # (number, name) for each vcard in the body
+    # Text
+    messages: Optional[list] = None
+    participants: Optional[list] = None  # raw "tel:" numbers, or None if there is no participants element
+    # Received, Placed, Missed, Voicemail, Recorded
+    telephone_number_suffix: Optional[str] = None
+    readable_date: Optional[str] = None
+    duration: int = 0
+    # Voicemail, Recorded
+    contributor_number: Optional[str] = None
+    contributor_name: Optional[str] = None
+    transcript: Optional[str] = None
+    attachments: Optional[list] = None
+
+def read_one_voice_file(html_target, reader_counts):
+    __, html_basename = html_target
+    if not html_basename.endswith('.html'): return None
+    if not NOT_A_CALL_FILENAME_PATTERN.search(html_basename):
+        voice_file_record = read_call_file_quickly(html_target)
+        if voice_file_record:
+            reader_counts['call_files_read_quickly'] += 1
+            return voice_file_record
+        reader_counts['call_files_fully_parsed'] += 1
+    return voice_file_readers[voice_file_parser](html_target)
+
+# Everything we read is in the <title> or somewhere in the <body>. Skipping the rest of the <head>
+# (mostly a big <style> element) saves BeautifulSoup from building a tree for it.
+VOICE_FILE_STRAINER = SoupStrainer(['title', 'body'])
+
+def read_one_voice_file_bs4(html_target, features='html.parser'):
+    with open_input_file(get_rel_path(html_target), encoding="utf-8") as html_file:
+        html_elt = BeautifulSoup(html_file, features, parse_only=VOICE_FILE_STRAINER)
+    body_elt = html_elt.body
+    title_value = html_elt.find('title').get_text()
+
+    tags_div = body_elt.find(class_='tags')
+    tag_elts = tags_div.find_all(rel='tag')
+    tag_values = set()
+    for tag_elt in tag_elts:
+        tag_value = tag_elt.get_text()
+        tag_values.add(tag_value)
+
+    voice_file_record = VoiceFileRecord(html_target, title_value, tag_values,
+                                        get_time_unix_ms(body_elt), get_vcards(body_elt))
+    if "Text" in tag_values:
+        read_Text_from_html_elt(voice_file_record, html_elt)
+    elif "Received" in tag_values or "Placed" in tag_values or "Missed" in tag_values:
+        read_call_from_html_elt(voice_file_record, html_elt)
+    elif "Voicemail" in tag_values or "Recorded" in tag_values:
+        read_call_from_html_elt(voice_file_record, html_elt)
+        read_Voicemail_from_html_elt(voice_file_record, html_elt)
+    return voice_file_record
+
+def read_Text_from_html_elt(voice_file_record, html_elt):
+    messages = list()
+    for message_elt in html_elt.find_all(class_='message'):
+        messages.append(VoiceMessageRecord(get_message_text(message_elt),
+                                           get_message_type(message_elt),
+                                           get_time_unix_ms(message_elt),
+                                           get_vcards(message_elt),
+                                           get_attachments(message_elt)))
+    voice_file_record.messages = messages
+
+    participants_elt = html_elt.find(class_='participants')
+    if participants_elt:
+        participants = list()
+        for tel_elt in participants_elt.find_all(class_='tel'):
+            if not tel_elt.name == 'a':
+                continue
+            participants.append(tel_elt['href'][4:])
+        voice_file_record.participants = participants
+
+def read_call_from_html_elt(voice_file_record, html_elt):
+    contributor_elt = html_elt.body.find(class_="contributor")
+    tel_elt = contributor_elt.find(class_="tel")
+    telephone_number_full = tel_elt.attrs['href']
+    voice_file_record.telephone_number_suffix = telephone_number_full[4:]
+
+    published_elt = html_elt.body.find(class_="published")
+    voice_file_record.readable_date = published_elt.get_text().replace("\r"," ").replace("\n"," ")
+    duration_elt = html_elt.find(class_="duration")
+    if duration_elt:
+        iso_duration = duration_elt.attrs['title']
+        duration = isodate.parse_duration(iso_duration)
+        voice_file_record.duration = round(datetime.timedelta.total_seconds(duration))
+
+def read_Voicemail_from_html_elt(voice_file_record, html_elt):
+    body_elt = html_elt.find('body')
+    contributor_elt = body_elt.find(class_='contributor')
+    voice_file_record.contributor_number, voice_file_record.contributor_name = get_number_and_name_from_tel_elt_parent(contributor_elt)
+    voice_file_record.transcript = get_vm_transcript(body_elt)
+    voice_file_record.attachments = get_attachments(body_elt)
+
+def read_one_voice_file_lxml(html_target):
+    return read_one_voice_file_bs4(html_target, 'lxml')
+
+def read_one_voice_file_stream(html_target):
+    with open_input_file(get_rel_path(html_target), encoding="utf-8") as html_file:
+        extractor = VoiceHTMLExtractor()
+        extractor.feed(html_file.read())
+        extractor.close()
+    try:
+        return extractor.get_voice_file_record(html_target)
+    except UnexpectedHTMLShape:
+        # Not what we expected, so let BeautifulSoup have a go at it. It will do whatever it would have done anyhow.
+        return read_one_voice_file_bs4(html_target)
+
+# Most of the files in a big Takeout are call logs, and they are tiny and all look the same. For
+# one of those, a single regular expression gets everything the HTML parsers would. If anything at
+# all is different from what we expect, the file is read by the regular parser instead. It's not
+# worth trying for a file whose name says it's something else. (Some call logs have no type in the name.)
+NOT_A_CALL_FILENAME_PATTERN = re.compile(r' - (Text|Voicemail|Recorded) - |^Group Conversation - ')
+CALL_FILE_PATTERN = re.compile(
+    r'<\?xml version="1.0" \?>\s*<!DOCTYPE html [^<>]*>'
+    r'<html xmlns="http://www.w3.org/1999/xhtml"><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />\s*'
+    r'<title>(?P<title>[^<]*)</title>\s*'
+    r'<style type="text/css">[^<]*</style></head>\s*'
+    r'<body><div class="haudio"><span class="album">[^<]*</span>\s*'
+    r'<span class="fn">[^<]*</span>\s*'
+    r'<div class="contributor vcard">[^<]*<a class="tel" href="(?P<href>[^"<>]*)"><span class="fn">(?P<fn>[^<]*)</span></a></div>\s*'
+    r'<abbr class="published" title="(?P<published_title>[^"<>]*)">(?P<published>[^<]*)</abbr>\s*'
+    r'(?:<br />\s*<abbr class="duration" title="(?P<duration_title>[^"<>]*)">[^<]*</abbr>\s*)?'
+    r'<div class="tags">Labels:\s*(?P<tags>(?:<a rel="tag" href="[^"<>]*">[^<]*</a>(?:, )?)*)</div>\s*'
+    r'<div class="deletedStatusContainer">[^<]*</div></div></body></html>\s*')
+CALL_FILE_TAG_PATTERN = re.compile(r'<a rel="tag" href="[^"<>]*">([^<]*)</a>')
+# The few character references we decode ourselves. For anything fancier, the HTML parser knows best.
+CALL_FILE_REFERENCE_PATTERN = re.compile(r'&(?:#(\d+)|#[xX]([0-9a-fA-F]+)|(amp|lt|gt|quot|apos));|&')
+CALL_FILE_NAMED_REFERENCES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+class NotAPlainCallFile(Exception):
+    pass
+
+def unescape_call_file_text(text):
+    if '&' not in text:
+        return text
+    return CALL_FILE_REFERENCE_PATTERN.sub(unescape_call_file_reference, text)
+
+def unescape_call_file_reference(match):
+    decimal, hexadecimal, name = match.groups()
+    if name:
+        return CALL_FILE_NAMED_REFERENCES[name]
+    if decimal or hexadecimal:
+        code_point = int(decimal, 10) if decimal else int(hexadecimal, 16)
+        # below 256, BeautifulSoup has its own ideas (Windows-1252); surrogates and such are no good either
+        if 0x20 <= code_point < 0x7f or 0xa0 <= code_point < 0xd800 or 0xe000 <= code_point < 0xfffe:
+            return chr(code_point)
+    raise NotAPlainCallFile(match.group(0))
+
+def read_call_file_quickly(html_target):
+    with open_input_file(get_rel_path(html_target), encoding="utf-8") as html_file:
+        match = CALL_FILE_PATTERN.fullmatch(html_file.read())
+    if not match:
+        return None
+    try:
+        tag_values = set(unescape_call_file_text(tag_value) for tag_value in CALL_FILE_TAG_PATTERN.findall(match.group('tags')))
+        if "Text" in tag_values or not tag_values & {"Received", "Placed", "Missed"}:
+            return None
+        href = unescape_call_file_text(match.group('href'))
+        this_number, this_name = get_number_and_name_from_href_and_fn(href, unescape_call_file_text(match.group('fn')))
+        voice_file_record = VoiceFileRecord(html_target, unescape_call_file_text(match.group('title')), tag_values,
+                                            unix_ms_from_iso_time(unescape_call_file_text(match.group('published_title'))),
+                                            [(this_number, this_name)] if this_number else [])
+        voice_file_record.telephone_number_suffix = href[4:]
+        voice_file_record.readable_date = unescape_call_file_text(match.group('published')).replace("\r"," ").replace("\n"," ")
+        if match.group('duration_title') is not None:
+            duration = isodate.parse_duration(unescape_call_file_text(match.group('duration_title')))
+            voice_file_record.duration = round(datetime.timedelta.total_seconds(duration))
+    except NotAPlainCallFile:
+        return None
+    return voice_file_record
+
+# Each of these takes an html_target and returns a VoiceFileRecord.
+voice_file_readers = {
+    PARSER_BS4:    read_one_voice_file_bs4,
+    PARSER_LXML:   read_one_voice_file_lxml,
+    PARSER_STREAM: read_one_voice_file_stream,
+    }
+voice_file_parser = PARSER_BS4
+
+# Fastest first, for "auto". Measured with the 1st pass over 230 synthetic HTML files (test_data/make_takeout.py
+# --scale 0.2): stream 0.74s, lxml 2.0-2.4s, bs4 2.4-2.5s. See "HTML parsers" in the README.
+# stream needs nothing outside the standard library, so today "auto" always picks it. The
+# rest of the list is only there in case a faster backend that might not be installed is added.
+VOICE_FILE_PARSERS_FASTEST_FIRST = (PARSER_STREAM, PARSER_LXML, PARSER_BS4)
+
+def is_voice_file_parser_available(parser):
+    if parser == PARSER_LXML:
+        return have_lxml
+    return True
+
+def choose_voice_file_parser(parser):
+    if parser == PARSER_AUTO:
+        return next(candidate for candidate in VOICE_FILE_PARSERS_FASTEST_FIRST if is_voice_file_parser_available(candidate))
+    if not is_voice_file_parser_available(parser):
+        raise Exception(f'The "{PARSER_LXML}" parser needs the lxml module, which is not installed. Try "pip install lxml".')
+    return parser
+
+class UnexpectedHTMLShape(Exception):
+    pass
+
+# An element seen by VoiceHTMLExtractor. We keep only the handful of things we care about:
+# the first descendant matching each of the "wants" keys, all descendants matching each of
+# the "alls" keys, and the text content if somebody asked for it. A key is either a tag name
+# or a class name with a leading ".", sort of like CSS. The keys an element itself matches are its "roles".
+class StreamElement:
+    __slots__ = ('name', 'attrs', 'classes', 'roles', 'firsts', 'wanting', 'alls', 'text', 'br_text')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = {key: ('' if value is None else value) for key, value in attrs}
+        self.classes = self.attrs.get('class', '').split()
+        self.roles = {name}
+        self.roles.update('.' + class_name for class_name in self.classes)
+        rel = self.attrs.get('rel', None)
+        if rel is not None and ('tag' in rel.split() if name == 'a' else rel == 'tag'):
+            self.roles.add('rel=tag')
+        self.firsts = None
+        self.wanting = None  # the keys in firsts that haven't been matched yet
+        self.alls = None
+        self.text = None
+        self.br_text = False
+        for role in self.roles:
+            wants = STREAM_WANTS.get(role, None)
+            if wants:
+                if self.firsts is None:
+                    self.firsts = dict()
+                    self.wanting = set()
+                for key in wants:
+                    self.firsts.setdefault(key, None)
+                    self.wanting.add(key)
+            alls = STREAM_ALLS.get(role, None)
+            if alls:
+                if self.alls is None:
+                    self.alls = dict()
+                for key in alls:
+                    self.alls.setdefault(key, list())
+
+    def first(self, key):
+        return self.firsts[key]
+
+    def all(self, key):
+        return self.alls[key]
+
+    def get_text(self):
+        return ''.join(self.text) if self.text is not None else ''
+
+    def get_attr(self, key):
+        value = self.attrs.get(key, None)
+        if value is None:
+            raise UnexpectedHTMLShape(f'<{self.name}> has no "{key}" attribute')
+        return value
+
+# The first-descendant and all-descendants lookups done by the BeautifulSoup reader, by the kind of
+# element doing the looking. Matches for keys in STREAM_TEXT_KEYS also have their text content collected.
+STREAM_WANTS = {
+    '[document]':   ('head', 'body', '.duration', '.participants'),
+    'head':         ('title',),
+    'body':         ('.dt', '.published', '.contributor', '.tags', '.full-text'),
+    '.message':     ('q', 'cite', '.dt', '.published'),
+    '.vcard':       ('.tel', '.fn'),
+    '.contributor': ('.tel', '.fn'),
+    'cite':         ('span',),
+    'div':          ('img', 'audio', '.video', '.vcard'),
+    'audio':        ('a',),
+    }
+STREAM_ALLS = {
+    '[document]':    ('.message',),
+    'body':          ('.vcard', 'div'),
+    '.message':      ('.vcard', 'div'),
+    '.tags':         ('rel=tag',),
+    '.participants': ('.tel',),
+    }
+STREAM_TEXT_KEYS = {'title', '.fn', '.published', '.full-text', 'q', 'rel=tag'}
+# these never have content or end tags, which is how BeautifulSoup treats them
+VOID_ELEMENTS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+                 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr'}
+
+# An event-driven alternative to BeautifulSoup for Google Voice HTML files. It never builds a tree.
+# It opens and closes elements the same way the BeautifulSoup "html.parser" tree builder does, so
+# the answers it collects come out the same as BeautifulSoup's find() and find_all() would give.
+# If a file doesn't look the way we expect, get_voice_file_record() raises UnexpectedHTMLShape.
+class VoiceHTMLExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._document = StreamElement('[document]', [])
+        self._stack = [self._document]
+        self._collecting = []
+
+    def handle_starttag(self, tag, attrs):
+        element = StreamElement(tag, attrs)
+        roles = element.roles
+        wants_text = False
+        for ancestor in self._stack:
+            if ancestor.wanting:
+                for key in ancestor.wanting & roles:
+                    ancestor.firsts[key] = element
+                    ancestor.wanting.discard(key)
+                    wants_text = wants_text or key in STREAM_TEXT_KEYS
+            if ancestor.alls:
+                for key in ancestor.alls.keys() & roles:
+                    ancestor.alls[key].append(element)
+                    wants_text = wants_text or key in STREAM_TEXT_KEYS
+        if tag == 'br':
+            for collecting in self._collecting:
+                if collecting.br_text:
+                    collecting.text.append('&#10;')
+        if tag in VOID_ELEMENTS:
+            return
+        self._stack.append(element)
+        if wants_text:
+            element.text = []
+            element.br_text = (tag == 'q')
+            self._collecting.append(element)
+
+    def handle_endtag(self, tag):
+        # like BeautifulSoup, close everything back to the most recent matching open element, if any
+        for ii in range(len(self._stack) - 1, 0, -1):
+            if self._stack[ii].name == tag:
+                for element in self._stack[ii:]:
+                    if element.text is not None:
+                        self._collecting.remove(element)
+                del self._stack[ii:]
+                return
+
+    def handle_data(self, data):
+        for element in self._collecting:
+            element.text.append(data)
+
+    def get_voice_file_record(self, html_target):
+        document = self._document
+        head_elt = required(document.first('head'), 'head')
+        body_elt = required(document.first('body'), 'body')
+        title_value = required(head_elt.first('title'), 'title').get_text()
+        tags_div = required(body_elt.first('.tags'), 'tags')
+        tag_values = set(tag_elt.get_text() for tag_elt in tags_div.all('rel=tag'))
+
+        voice_file_record = VoiceFileRecord(html_target, title_value, tag_values,
+                                            self._get_time_unix_ms(body_elt), self._get_vcards(body_elt))
+        if "Text" in tag_values:
+            messages = list()
+            for message_elt in document.all('.message'):
+                if message_elt.alls is None or message_elt.firsts is None:
+                    raise UnexpectedHTMLShape('message')
+                q_elt = message_elt.first('q')
+                cite_elt = required(message_elt.first('cite'), 'cite')
+                messages.append(VoiceMessageRecord(q_elt.get_text() if q_elt else None,
+                                                   1 if cite_elt.first('span') else 2,
+                                                   self._get_time_unix_ms(message_elt),
+                                                   self._get_vcards(message_elt),
+                                                   self._get_attachments(message_elt)))
+            voice_file_record.messages = messages
+            participants_elt = document.first('.participants')
+            if participants_elt:
+                voice_file_record.participants = [tel_elt.get_attr('href')[4:]
+                                                  for tel_elt in participants_elt.all('.tel') if tel_elt.name == 'a']
+        elif tag_values & {"Received", "Placed", "Missed", "Voicemail", "Recorded"}:
+            contributor_elt = required(body_elt.first('.contributor'), 'contributor')
+            tel_elt = required(contributor_elt.first('.tel'), 'tel')
+            voice_file_record.telephone_number_suffix = tel_elt.get_attr('href')[4:]
+            published_elt = required(body_elt.first('.published'), 'published')
+            voice_file_record.readable_date = published_elt.get_text().replace("\r"," ").replace("\n"," ")
+            duration_elt = document.first('.duration')
+            if duration_elt:
+                duration = isodate.parse_duration(duration_elt.get_attr('title'))
+                voice_file_record.duration = round(datetime.timedelta.total_seconds(duration))
+            if "Received" not in tag_values and "Placed" not in tag_values and "Missed" not in tag_values:
+                voice_file_record.contributor_number, voice_file_record.contributor_name = self._get_number_and_name(contributor_elt)
+                full_text_elt = body_elt.first('.full-text')
+                voice_file_record.transcript = prettify_vm_transcript(full_text_elt.get_text()) if full_text_elt else None
+                voice_file_record.attachments = self._get_attachments(body_elt)
+        return voice_file_record
+
+    def _get_time_unix_ms(self, scope_elt):
+        time_elt = scope_elt.first('.dt') or scope_elt.first('.published')
+        return unix_ms_from_iso_time(required(time_elt, 'dt').get_attr('title'))
+
+    def _get_vcards(self, scope_elt):
+        vcards = list()
+        for vcard_elt in scope_elt.all('.vcard'):
+            this_number, this_name = self._get_number_and_name(vcard_elt)
+            if this_number:
+                vcards.append((this_number, this_name))
+        return vcards
+
+    def _get_number_and_name(self, parent_elt):
+        tel_elt = parent_elt.first('.tel')
+        if not tel_elt:
+            return None, None
+        fn_elt = parent_elt.first('.fn')
+        return get_number_and_name_from_href_and_fn(tel_elt.get_attr('href'), fn_elt.get_text() if fn_elt else None)
+
+    # mirrors get_attachment_elts() and get_attachments()
+    def _get_attachments(self, scope_elt):
+        attachments = []
+        for div_elt in scope_elt.all('div'):
+            attachment_elts = [div_elt.first('img'), div_elt.first('audio'), div_elt.first('.video')]
+            vcard_elt = div_elt.first('.vcard')
+            if vcard_elt and vcard_elt.name == "a":
+                attachment_elts.append(vcard_elt)
+            for attachment_elt in attachment_elts:
+                if not attachment_elt:
+                    continue
+                if attachment_elt.name == 'img':
+                    attachments.append((ATTACHMENT_TYPE_IMAGE, attachment_elt.get_attr('src')))
+                elif attachment_elt.name == 'audio':
+                    src = attachment_elt.attrs.get('src', None) or required(attachment_elt.first('a'), 'a').get_attr('href')
+                    attachments.append((ATTACHMENT_TYPE_AUDIO, src))
+                elif attachment_elt.name == 'a' and 'video' in attachment_elt.classes:
+                    attachments.append((ATTACHMENT_TYPE_VIDEO, attachment_elt.get_attr('href')))
+                elif attachment_elt.name == 'a' and 'vcard' in attachment_elt.classes:
+                    attachments.append((ATTACHMENT_TYPE_VCARD, attachment_elt.get_attr('href')))
+                else:
+                    # the BeautifulSoup reader will describe it in a message
+                    raise UnexpectedHTMLShape('unrecognized attachment')
+        return attachments
+
+def required(element, what):
+    if element is None:
+        raise UnexpectedHTMLShape(f'missing {what}')
+    return element
+
+def process_one_voice_file(voice_file_record):
+    html_target = voice_file_record.html_target
     __, html_basename = html_target
-    if not html_basename.endswith('.html'): return
 
     get_name_or_number_from_filename(html_basename)
-    with open(get_rel_path(html_target), 'r', encoding="utf-8") as html_file:
-        html_elt = BeautifulSoup(html_file, 'html.parser')
-    get_name_or_number_from_title()
-
-    if is_first_pass:
-        scan_vcards_for_contacts(html_target, html_elt.body)
-        return
+    get_name_or_number_from_title(voice_file_record.title_value)
 
     # Need to be firm about mapping contact names to numbers! The contact_name_to_number() function will complain.
     if contact_name_from_html_title and not contact_name_to_number(html_target, contact_name_from_html_title):
@@ -613,64 +1480,68 @@ def process_one_voice_file(is_first_pass, html_target):
     if contact_name_from_filename and not contact_name_to_number(html_target, contact_name_from_filename):
         return
 
-    tags_div = html_elt.body.find(class_='tags')
-    tag_elts = tags_div.find_all(rel='tag')
-    tag_values = set()
-    for tag_elt in tag_elts:
-        tag_value = tag_elt.get_text()
-        tag_values.add(tag_value)
-
-    if   "Text"      in tag_values:  process_Text_from_html_file(html_target)
-    elif "Received"  in tag_values:  process_call_from_html_file(html_target, 1)
-    elif "Placed"    in tag_values:  process_call_from_html_file(html_target, 2)
-    elif "Missed"    in tag_values:  process_call_from_html_file(html_target, 3)
-    elif "Voicemail" in tag_values:  process_Voicemail_from_html_file(html_target)
-    elif "Recorded"  in tag_values:  process_Voicemail_from_html_file(html_target)
+    tag_values = voice_file_record.tag_values
+    if   "Text"      in tag_values:  process_Text_from_html_file(voice_file_record)
+    elif "Received"  in tag_values:  process_call_from_html_file(voice_file_record, 1)
+    elif "Placed"    in tag_values:  process_call_from_html_file(voice_file_record, 2)
+    elif "Missed"    in tag_values:  process_call_from_html_file(voice_file_record, 3)
+    elif "Voicemail" in tag_values:  process_Voicemail_from_html_file(voice_file_record)
+    elif "Recorded"  in tag_values:  process_Voicemail_from_html_file(voice_file_record)
     else:
         print(f"Unrecognized tag_value situation '{tag_values}'; silently ignoring file '{get_abs_path(html_target)}'")
 
-def process_Text_from_html_file(html_target):
+# For count_output_records(). How many (SMS/MMS, voicemail, call) records process_one_voice_file() will
+# write for a file. It makes the same checks, but only looks things up. The names that have numbers are
+# all known after the 1st pass (the 2nd pass only sees vcards the 1st pass already saw), so the checks
+# come out the same as they will in the 2nd pass.
+def count_voice_file_records(voice_file_record):
+    __, html_basename = voice_file_record.html_target
+    get_name_or_number_from_filename(html_basename)
+    get_name_or_number_from_title(voice_file_record.title_value)
+    if contact_name_from_html_title and not contacts_oracle.get_number_by_name(contact_name_from_html_title, None):
+        return 0, 0, 0
+    if contact_name_from_filename and not contacts_oracle.get_number_by_name(contact_name_from_filename, None):
+        return 0, 0, 0
+
+    tag_values = voice_file_record.tag_values
+    if   "Text"      in tag_values:  return len(voice_file_record.messages), 0, 0
+    elif "Received"  in tag_values:  return 0, 0, 1
+    elif "Placed"    in tag_values:  return 0, 0, 1
+    elif "Missed"    in tag_values:  return 0, 0, 1
+    elif "Voicemail" in tag_values:  return 0, 1, 1
+    elif "Recorded"  in tag_values:  return 0, 1, 1
+    else:                            return 0, 0, 0
+
+def process_Text_from_html_file(voice_file_record):
     # A single HTML file can contain arbitrarily many SMS or MMS messages. I don't *think*
     # a single HTML file can have a mix of SMS and MMS since an HTML for MMS has a global
     # "participants" list.
     # MMS can be either with or without attachments.
-    message_elts = html_elt.find_all(class_='message')
-    participants_elt = html_elt.find(class_='participants')
-
-    if participants_elt:
-        write_mms_messages(html_target, participants_elt, message_elts)
+    html_target = voice_file_record.html_target
+    if voice_file_record.participants is not None:
+        write_mms_messages(html_target, voice_file_record.participants, voice_file_record.messages)
     else:
-        write_sms_messages(html_target, message_elts)
+        write_sms_messages(html_target, voice_file_record.messages)
 
-def process_Voicemail_from_html_file(html_target):
+def process_Voicemail_from_html_file(voice_file_record):
     # For a voicemail, we write a call record and also an MMS record with the recording attached.
     # The app doesn't like type 4 (voicemail) in a call record, so we emit type 3 (missed call),
     # which is kinda sorta correct.
-    process_call_from_html_file(html_target, 3)
-    write_mms_message_for_vm(html_target)
+    process_call_from_html_file(voice_file_record, 3)
+    write_mms_message_for_vm(voice_file_record)
 
-def process_call_from_html_file(html_target, call_type):
-    contributor_elt = html_elt.body.find(class_="contributor")
-    tel_elt = contributor_elt.find(class_="tel")
-    telephone_number_full = tel_elt.attrs['href']
-    telephone_number_suffix = telephone_number_full[4:]
+def process_call_from_html_file(voice_file_record, call_type):
+    html_target = voice_file_record.html_target
+    telephone_number_suffix = voice_file_record.telephone_number_suffix
     if not telephone_number_suffix:
         presentation = '2'
     else:
         presentation = '1'
     telephone_number = format_number(html_target, telephone_number_suffix)
 
-    published_elt = html_elt.body.find(class_="published")
-    readable_date = published_elt.get_text().replace("\r"," ").replace("\n"," ")
-    iso_date = published_elt.attrs['title']
-    timestamp = get_time_unix_ms(html_elt.body)
-    duration_elt = html_elt.find(class_="duration")
-    if not duration_elt:
-        duration = 0
-    else:
-        iso_duration = duration_elt.attrs['title']
-        duration = isodate.parse_duration(iso_duration)
-        duration = round(datetime.timedelta.total_seconds(duration))
+    readable_date = voice_file_record.readable_date
+    timestamp = voice_file_record.timestamp
+    duration = voice_file_record.duration
     write_call_message(html_target, telephone_number, presentation, duration, timestamp, call_type, readable_date)
 
 def contact_name_to_number(html_target, contact_name):
@@ -702,54 +1573,48 @@ def get_sender_number_from_title_or_filename(html_target):
     return sender
 
 def write_call_message(html_target, telephone_number, presentation, duration, timestamp, call_type, readable_date):
-    parent_elt = BeautifulSoup()
-    parent_elt.append(bs4_get_file_comment(html_target))
-    bs4_append_call_elt(parent_elt, telephone_number, duration, timestamp, presentation, readable_date, call_type)
-    call_backup_file.write(parent_elt.prettify(formatter=FORMATTER))
-    call_backup_file.write('\n')
+    fragment = CallFragment(use_file(html_target), telephone_number, duration, timestamp, presentation, readable_date, call_type)
+    write_fragment(call_backup_file, fragment)
     counters['number_of_calls_output'] += 1
 
-def write_sms_messages(html_target, message_elts):
+def write_sms_messages(html_target, messages):
     other_party_number = None
     # Since the "address" element of an SMS is always the other end, scan the
     # message elements until we find a number this not "Me". Use that as the
     # address value for all of the SMS files in this HTML.
-    for message_elt in message_elts:
+    for message in messages:
         if other_party_number:
             break
-        other_party_number = scan_vcards_for_contacts(html_target, message_elt)
+        other_party_number = scan_vcards_for_contacts(html_target, message.timestamp, message.vcards)
 
     # This will be the case if the HTML file contains only a single SMS
     # that was sent by "Me". Use fallbacks.
     if not other_party_number:
         other_party_number = get_sender_number_from_title_or_filename(html_target)
 
-    for message_elt in message_elts:
-        the_text = get_message_text(message_elt)
-        message_type = get_message_type(message_elt)
+    for message in messages:
+        the_text = message.the_text
+        message_type = message.message_type
         sent_by_me = (message_type == 2)
-        timestamp = get_time_unix_ms(message_elt)
-        attachment_elts = get_attachment_elts(message_elt)
-        parent_elt = BeautifulSoup()
-        parent_elt.append(bs4_get_file_comment(html_target))
+        timestamp = message.timestamp
+        attachments = message.attachments
+        comment_path = use_file(html_target)
         # if it was just an attachment with no text, there is no point in creating an empty SMS to go with it
-        if the_text and the_text != "MMS Sent" and not attachment_elts:
-            bs4_append_sms_elt(parent_elt, other_party_number, timestamp, the_text, message_type)
+        if the_text and the_text != "MMS Sent" and not attachments:
+            fragment = SmsFragment(comment_path, other_party_number, timestamp, the_text, message_type)
         else:
             msgbox_type = message_type
-            bs4_append_mms_elt_with_parts_for_voice(parent_elt, html_target, attachment_elts, the_text, other_party_number, sent_by_me, timestamp, msgbox_type, [other_party_number])
-        sms_backup_file.write(parent_elt.prettify(formatter=FORMATTER))
-        sms_backup_file.write('\n')
+            fragment = get_mms_fragment_for_voice(comment_path, html_target, attachments, the_text, other_party_number, sent_by_me, timestamp, msgbox_type, [other_party_number])
+        write_fragment(sms_backup_file, fragment)
         counters['number_of_voice_sms_output'] += 1
 
-def write_mms_message_for_vm(html_target):
+def write_mms_message_for_vm(voice_file_record):
     # We want to end up with an MMS messages, just like any other, but the HTML input file is 
     # significantly different, so we have this bit of voodoo where we fake up some of the stuff.
+    html_target = voice_file_record.html_target
     sender = None
     sender_name = None
-    body_elt = html_elt.find('body')
-    contributor_elt = body_elt.find(class_='contributor')
-    this_number, this_name = get_number_and_name_from_tel_elt_parent(contributor_elt)
+    this_number, this_name = voice_file_record.contributor_number, voice_file_record.contributor_name
     if this_number:
         sender = contacts_oracle.get_best_number(this_number)
         sender_name = this_name
@@ -762,43 +1627,57 @@ def write_mms_message_for_vm(html_target):
                 break
 
     participants = [sender] if sender else [BOGUS_NUMBER]
-    timestamp = get_time_unix_ms(body_elt)
+    timestamp = voice_file_record.timestamp
     vm_from = (sender_name if sender_name else sender if sender else "Unknown")
-    transcript = get_vm_transcript(body_elt)
+    transcript = voice_file_record.transcript
     if transcript:
         the_text = "Voicemail/Recording from: " + vm_from + ";\nTranscript: " + transcript
     else:
         the_text = "Voicemail/Recording from: " + vm_from        
-    attachment_elts = get_attachment_elts(body_elt)
+    attachments = voice_file_record.attachments
     msgbox_type = '1' # 1 = Received, 2 = Sent
     sent_by_me = False
-    parent_elt = BeautifulSoup()
-    parent_elt.append(bs4_get_file_comment(html_target))
-    bs4_append_mms_elt_with_parts_for_voice(parent_elt, html_target, attachment_elts, the_text, sender, sent_by_me, timestamp, msgbox_type, participants)
-    vm_backup_file.write(parent_elt.prettify(formatter=FORMATTER))
-    vm_backup_file.write('\n')
+    comment_path = use_file(html_target)
+    fragment = get_mms_fragment_for_voice(comment_path, html_target, attachments, the_text, sender, sent_by_me, timestamp, msgbox_type, participants)
+    write_fragment(vm_backup_file, fragment)
     counters['number_of_vms_output'] += 1
 
-def write_mms_messages(html_target, participants_elt, message_elts):
-    participants = get_mms_participant_phone_numbers(html_target, participants_elt)
+def write_mms_messages(html_target, raw_participants, messages):
+    participants = get_mms_participant_phone_numbers(html_target, raw_participants)
 
-    for message_elt in message_elts:
+    for message in messages:
         # TODO who is sender?
-        not_me_vcard_number = scan_vcards_for_contacts(html_target, message_elt)
+        not_me_vcard_number = scan_vcards_for_contacts(html_target, message.timestamp, message.vcards)
         sender = not_me_vcard_number
         sent_by_me = sender not in participants
-        the_text = get_message_text(message_elt)
-        message_type = get_message_type(message_elt)
-        timestamp = get_time_unix_ms(message_elt)
-        attachment_elts = get_attachment_elts(message_elt)
-
-        parent_elt = BeautifulSoup()
-        parent_elt.append(bs4_get_file_comment(html_target))
-        bs4_append_mms_elt_with_parts_for_voice(parent_elt, html_target, attachment_elts, the_text, sender, sent_by_me, timestamp, message_type, participants)
-        sms_backup_file.write(parent_elt.prettify(formatter=FORMATTER))
-        sms_backup_file.write('\n')
+        the_text = message.the_text
+        message_type = message.message_type
+        timestamp = message.timestamp
+        attachments = message.attachments
+
+        comment_path = use_file(html_target)
+        fragment = get_mms_fragment_for_voice(comment_path, html_target, attachments, the_text, sender, sent_by_me, timestamp, message_type, participants)
+        write_fragment(sms_backup_file, fragment)
         counters['number_of_voice_sms_output'] += 1
 
+# Returns a list of (attachment_type, attachment_file_ref) tuples. For an attachment we
+# don't know how to handle, the attachment_type is None and the "reference" is the
+# element itself, as a string, for the benefit of a message to the user.
+def get_attachments(message_elt):
+    attachments = []
+    for attachment_elt in get_attachment_elts(message_elt):
+        if attachment_elt.name == 'img':
+            attachments.append((ATTACHMENT_TYPE_IMAGE, attachment_elt['src']))
+        elif attachment_elt.name == 'audio':
+            attachments.append((ATTACHMENT_TYPE_AUDIO, attachment_elt.get('src', None) or attachment_elt.a['href']))
+        elif attachment_elt.name == 'a' and 'video' in attachment_elt['class']:
+            attachments.append((ATTACHMENT_TYPE_VIDEO, attachment_elt['href']))
+        elif attachment_elt.name == 'a' and 'vcard' in attachment_elt['class']:
+            attachments.append((ATTACHMENT_TYPE_VCARD, attachment_elt['href']))
+        else:
+            attachments.append((None, str(attachment_elt)))
+    return attachments
+
 def get_attachment_elts(message_elt):
     attachment_elts = []
     div_elts = message_elt.find_all('div')
@@ -818,162 +1697,677 @@ def get_attachment_elts(message_elt):
             attachment_elts.append(vcard_elt)
     return attachment_elts
 
-def bs4_append_sms_elt(parent_elt, sender, timestamp, the_text, message_type):
-    sms_elt = html_elt.new_tag('sms')
-    parent_elt.append(sms_elt)
-
-    # protocol - Protocol used by the message, its mostly 0 in case of SMS messages.
-    sms_elt['protocol'] = '0'
-    # address - The phone number of the sender/recipient.
-    sms_elt['address'] = sender
-    # date - The Java date representation (including millisecond) of the time when the message was sent/received.
-    sms_elt['date'] = timestamp
-    # type - 1 = Received, 2 = Sent, 3 = Draft, 4 = Outbox, 5 = Failed, 6 = Queued
-    sms_elt['type'] = message_type
-    # subject - Subject of the message, its always null in case of SMS messages.
-    sms_elt['subject'] = 'null'
-    # body - The content of the message.
-    sms_elt['body'] = the_text
-    # toa - n/a, defaults to null.
-    sms_elt['toa'] = 'null'
-    # sc_toa - n/a, defaults to null.
-    sms_elt['sc_toa'] = 'null'
-    # service_center - The service center for the received message, null in case of sent messages.
-    sms_elt['service_center'] = 'null'
-    # read - Read Message = 1, Unread Message = 0.
-    sms_elt['read'] = '1'
-    # status - None = -1, Complete = 0, Pending = 32, Failed = 64.
-    sms_elt['status'] = '-1'
-    sms_elt['locked'] = '0'
-
-    # sub_id - Optional field that has the id of the phone subscription (SIM).
-    sms_elt['sub_id'] = '-1'
-    # readable_date - Optional field that has the date in a human readable format.
-    # contact_name - Optional field that has the name of the contact.
-
-def bs4_append_mms_elt_with_parts_for_voice(parent_elt, html_target, attachment_elts, the_text, other_party_number, sent_by_me, timestamp, msgbox_type, participants):
+# The second pass works out everything about an output record -- contact numbers, timestamps,
+# attachment filenames, and so on -- and describes it with one of these "fragments". Turning a
+# fragment into XML text (including reading and encoding any attachments) doesn't need any of
+# the shared state, so it can be done somewhere else, like a worker process for --jobs.
+@dataclass
+class CallFragment:
+    comment_path: str
+    telephone_number: str
+    duration: int
+    timestamp: int
+    presentation: str
+    readable_date: str
+    call_type: int
+
+@dataclass
+class SmsFragment:
+    comment_path: str
+    address: str
+    timestamp: int
+    the_text: str
+    message_type: object
+
+@dataclass
+class MmsPart:
+    comment_path: str
+    sequence_number: int
+    content_type: str
+    name: str
+    content_location: str
+    data_path: str
+
+@dataclass
+class MmsFragment:
+    comment_path: str
+    participants: list
+    timestamp: int
+    m_type: int
+    msgbox_type: object
+    addrs: list  # (address, type)
+    the_text: Optional[str]
+    parts: list  # MmsPart for each attachment
+
+def get_mms_fragment_for_voice(comment_path, html_target, attachments, the_text, other_party_number, sent_by_me, timestamp, msgbox_type, participants):
     m_type = 128 if sent_by_me else 132
-    bs4_append_mms_elt(parent_elt, participants, timestamp, m_type, msgbox_type, other_party_number, sent_by_me, the_text)
-    mms_elt = parent_elt.mms
-
-    if attachment_elts:
-        parts_elt = mms_elt.parts
-        for sequence_number, attachment_elt in enumerate(attachment_elts):
-            if attachment_elt.name == 'img':
-                attachment_file_ref = attachment_elt['src']
-                bs4_append_part_elt(parts_elt, ATTACHMENT_TYPE_IMAGE, sequence_number, html_target, attachment_file_ref)
-            elif attachment_elt.name == 'audio':
-                attachment_file_ref = attachment_elt.get('src', None) or attachment_elt.a['href']
-                bs4_append_part_elt(parts_elt, ATTACHMENT_TYPE_AUDIO, sequence_number, html_target, attachment_file_ref)
-            elif attachment_elt.name == 'a' and 'video' in attachment_elt['class']:
-                attachment_file_ref = attachment_elt['href']
-                bs4_append_part_elt(parts_elt, ATTACHMENT_TYPE_VIDEO, sequence_number, html_target, attachment_file_ref)
-            elif attachment_elt.name == 'a' and 'vcard' in attachment_elt['class']:
-                attachment_file_ref = attachment_elt['href']
-                bs4_append_part_elt(parts_elt, ATTACHMENT_TYPE_VCARD, sequence_number, html_target, attachment_file_ref)
+    addrs = get_mms_addrs(participants, other_party_number, sent_by_me)
+    parts = list()
+    if attachments:
+        for sequence_number, (attachment_type, attachment_file_ref) in enumerate(attachments):
+            if attachment_type:
+                part = get_mms_part_for_voice(attachment_type, sequence_number, html_target, attachment_file_ref)
+                if part:
+                    parts.append(part)
             else:
-                print(f'>> Unrecognized MMS attachment in HTML file (skipped):\n>> {attachment_elt}')
+                print(f'>> Unrecognized MMS attachment in HTML file (skipped):\n>> {attachment_file_ref}')
                 print(f'>>     due to File: "{get_abs_path(html_target)}"')
+    return MmsFragment(comment_path, participants, timestamp, m_type, msgbox_type, addrs, the_text, parts)
 
-def bs4_append_mms_elt(parent_elt, participants, timestamp, m_type, msgbox_type, other_party_number, sent_by_me, the_text):
-    mms_elt = html_elt.new_tag('mms')
-    parent_elt.append(mms_elt)
+def get_mms_part_for_voice(attachment_type, sequence_number, html_target, attachment_file_ref):
+    attachment_filename, content_type = figure_out_attachment_filename_and_type(attachment_type, html_target, attachment_file_ref)
+    subdirectory, __ = html_target
+    if not attachment_filename:
+        return None
+    export_path_revised = get_rel_path((subdirectory, attachment_filename))
+    comment_path = use_file((subdirectory, attachment_filename))
+    return MmsPart(comment_path, sequence_number, content_type, attachment_filename, attachment_filename, export_path_revised)
 
-    bs4_append_addrs_elt(mms_elt, participants, other_party_number, sent_by_me)
+def get_mms_fragment_for_chat(comment_path, attachment_list, the_text, sender_number, sent_by_me, timestamp, msgbox_type, participants):
+    m_type = 128 if sent_by_me else 132
+    addrs = get_mms_addrs(participants, sender_number, sent_by_me)
+    parts = list()
+    if attachment_list:
+        sequence_number = 0
+        for original_name, export_path_revised in attachment_list:
+            sequence_number += 1
+            __, ext = os.path.splitext(original_name)
+            content_type = ext_to_content_type.get(ext, 'application/octet-stream')
+            subdirectory, export_name = os.path.split(export_path_revised)
+            part_comment_path = use_file((subdirectory, export_name))
+            parts.append(MmsPart(part_comment_path, sequence_number, content_type, original_name, export_name, export_path_revised))
+    return MmsFragment(comment_path, participants, timestamp, m_type, msgbox_type, addrs, the_text, parts)
 
-    parts_elt = html_elt.new_tag('parts')
-    mms_elt.append(parts_elt)
-    bs4_append_text_part_elt(parts_elt, the_text)
-    
-    if participants:
-        participants_tilde = '~'.join(participants)
+def get_mms_addrs(participants, other_party_number, sent_by_me):
+    addrs = list()
+    me_contact = contacts_oracle.get_number_by_name('Me', None)
+    for participant in participants + [me_contact]:
+        if sent_by_me and participant == me_contact:
+            participant_is_sender = True
+        elif not sent_by_me and participant == other_party_number:
+            participant_is_sender = True
+        else:
+            participant_is_sender = False
+        # type - The type of address, 129 = BCC, 130 = CC, 151 = To, 137 = From
+        addrs.append((participant, '137' if participant_is_sender else '151'))
+    return addrs
+
+# Output XML is written out directly as text instead of being built up as a BeautifulSoup tree
+# and prettified. Attributes are always in alphabetical order (that's what prettify() did). By
+# default, an element with no children is closed with "/>". With --compat_xml, the layout is
+# exactly what older versions of this script produced (a separate closing tag for every element and
+# a blank line after each record), which is handy for comparing output files.
+compat_xml = False
+
+XML_ESCAPES = {'<': '&lt;', '>': '&gt;', '&': '&amp;'}
+# Same as EntitySubstitution.substitute_xml_containing_entities(). Something that already looks
+# like an entity (for example, the "&#10;" we use for line breaks in message text) is left alone.
+XML_NEEDS_ESCAPE = re.compile(r'[<>]|&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)')
+
+def xml_escape_match(match):
+    return XML_ESCAPES[match.group(0)]
+
+def xml_attribute(name, value):
+    if value is None:
+        return ' ' + name
+    if not isinstance(value, str):
+        value = str(value)
+    value = XML_NEEDS_ESCAPE.sub(xml_escape_match, value)
+    if '"' in value:
+        if "'" in value:
+            value = value.replace('"', '&quot;')
+        else:
+            return f" {name}='{value}'"
+    return f' {name}="{value}"'
+
+def xml_attributes(attributes):
+    return ''.join(xml_attribute(attribute_name, value) for attribute_name, value in attributes)
+
+def write_xml_start_tag(out, indent, name, attributes, empty=False):
+    out.write(indent + '<' + name + xml_attributes(attributes))
+    write_xml_start_tag_end(out, indent, name, empty)
+
+def write_xml_start_tag_end(out, indent, name, empty):
+    if not empty:
+        out.write('>\n')
+    elif compat_xml:
+        out.write('>\n' + indent + '</' + name + '>\n')
     else:
-        participants_tilde = BOGUS_NUMBER        
-    # address - The phone number of the sender/recipient.
-    mms_elt['address'] = participants_tilde
-    # ct_t - The Content-Type of the message, usually "application/vnd.wap.multipart.related"
-    mms_elt['ct_t'] = 'application/vnd.wap.multipart.related'
-    # date - The Java date representation (including millisecond) of the time when the message was sent/received.
-    mms_elt['date'] = timestamp
-    # m_type - The type of the message defined by MMS spec.
-    mms_elt['m_type'] = m_type
-    # msg_box - The type of message, 1 = Received, 2 = Sent, 3 = Draft, 4 = Outbox
-    mms_elt['msg_box'] = msgbox_type
-    # read - Has the message been read
-    mms_elt['read'] = '1'
-    # rr - The read-report of the message.
-    mms_elt['rr'] = 'null'
-    mms_elt['seen'] = '1'
-    mms_elt['sub_id'] = '-1'
-    mms_elt['text_only'] = '0'
-
-    # sub - The subject of the message, if present.
-    # m_id - The Message-ID of the message
-    # m_size - The size of the message.
-    # sim_slot - The sim card slot.
-    # readable_date - Optional field that has the date in a human readable format.
-    # contact_name - Optional field that has the name of the contact.
-    
-    return parent_elt
-
-def bs4_append_text_part_elt(elt_parent, the_text):
-    if not the_text or the_text == "MMS Sent" or the_text == "MMS Received":
-        return  # don't bother with this trivial text part 
-
-    text_part_elt = html_elt.new_tag('part')
-
-    # seq - The order of the part.
-    text_part_elt['seq'] = '-1'
-    # ct - The content type of the part.
-    text_part_elt['ct'] = 'text/plain'
-    # name - The name of the part.
-    text_part_elt['name'] = 'null'
-    # chset - The charset of the part.
-    text_part_elt['chset'] = '106'
-    text_part_elt['cd'] = 'null'
-    text_part_elt['fn'] = 'null'
-    text_part_elt['cid'] = '<text000001>'
-    # cl - The content location of the part.
-    text_part_elt['cl'] = 'text000001'
-    text_part_elt['ctt_s'] = 'null'
-    text_part_elt['ctt_t'] = 'null'
-    # text - The text content of the part.
-    text_part_elt['text'] = the_text
-    elt_parent.append(text_part_elt)
-
-    # data - The base64 encoded binary content of the part.
-
-def bs4_append_part_elt(parent_elt, attachment_type, sequence_number, html_target, attachment_file_ref):
-    attachment_filename, content_type = figure_out_attachment_filename_and_type(attachment_type, html_target, attachment_file_ref)
-    subdirectory, __ = html_target
-    if attachment_filename:
-        export_path_revised = get_rel_path((subdirectory, attachment_filename))
-        with open(export_path_revised, 'rb') as attachment_file: 
-            attachment_data = base64.b64encode(attachment_file.read()).decode()
-        parent_elt.append(bs4_get_file_comment((subdirectory, attachment_filename)))
-        part_elt = html_elt.new_tag('part')
-        parent_elt.append(part_elt)
+        out.write('/>\n')
 
-        # seq - The order of the part.
-        part_elt['seq'] = sequence_number
+def write_xml_end_tag(out, indent, name):
+    out.write(indent + '</' + name + '>\n')
+
+def write_xml_comment(out, indent, comment_path):
+    out.write(f'{indent}<!-- file: "{comment_path}" -->\n')
+
+def write_xml_fragment(out, fragment):
+    write_xml_comment(out, '', fragment.comment_path)
+    if isinstance(fragment, CallFragment):
+        write_call_xml(out, fragment)
+    elif isinstance(fragment, SmsFragment):
+        write_sms_xml(out, fragment)
+    else:
+        write_mms_xml(out, fragment)
+    if compat_xml:
+        out.write('\n')
+
+# Attachments are base64 encoded a chunk at a time, straight into the output, so that even a huge
+# video never has to be in memory all at once. The chunk size is a multiple of 3 bytes, so the
+# encoded chunks can be strung together without any "=" padding in the middle.
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+def write_base64_file(out, file_path):
+    start_time = time.perf_counter()
+    if attachment_cache.can_cache(get_attachment_size(file_path)):
+        out.write(attachment_cache.get_encoded(file_path))
+        add_timing('attachment_seconds', time.perf_counter() - start_time)
+        return
+    with open_input_binary_file(file_path) as data_file:
+        leftover = b''
+        while chunk := data_file.read(BASE64_CHUNK_SIZE):
+            chunk = leftover + chunk
+            usable_length = len(chunk) - (len(chunk) % 3)
+            leftover = chunk[usable_length:]
+            out.write(base64.b64encode(chunk[:usable_length]).decode('ascii'))
+        out.write(base64.b64encode(leftover).decode('ascii'))
+    add_timing('attachment_seconds', time.perf_counter() - start_time)
+
+# The same picture or vCard often turns up in many messages, and Google Chat repeats forwarded
+# media across groups, so the base64 text for attachments is kept in an LRU cache, up to a budget
+# of encoded bytes. Files are matched by size and a hash of their contents, so copies under different
+# names count as the same. Anything bigger than the whole budget is streamed instead of cached.
+# Each --jobs worker process has its own cache. The --attachment_threads threads share one, so it
+# has a lock, but the reading and encoding are done outside of it.
+ATTACHMENT_CACHE_COUNTERS = ('attachments_from_cache', 'attachment_bytes_saved')
+
+class AttachmentCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self._entries = OrderedDict()  # (size, digest) -> base64 text, least recently used first
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def can_cache(self, file_size):
+        return (file_size + 2) // 3 * 4 <= self.budget
+
+    def get_encoded(self, file_path):
+        with open_input_binary_file(file_path) as data_file:
+            data = data_file.read()
+        key = (len(data), hashlib.blake2b(data, digest_size=16).digest())
+        with self._lock:
+            encoded = self._entries.get(key, None)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                counters['attachments_from_cache'] += 1
+                counters['attachment_bytes_saved'] += len(encoded)
+                return encoded
+        encoded = base64.b64encode(data).decode('ascii')
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._cached_bytes += len(encoded)
+            while self._cached_bytes > self.budget:
+                __, old_encoded = self._entries.popitem(last=False)
+                self._cached_bytes -= len(old_encoded)
+        return encoded
+
+ATTACHMENT_CACHE_MEGABYTES = 64
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_MEGABYTES * 1024 * 1024)
+
+# For --jobs, a worker renders a fragment into one of these instead of an output file. Attachments
+# bigger than MAX_RENDERED_ATTACHMENT_SIZE are not encoded in the worker. The file path is handed
+# back instead, and write_one_pending_render() streams it into the output file.
+MAX_RENDERED_ATTACHMENT_SIZE = 1024 * 1024
+
+class RenderBuffer:
+    def __init__(self):
+        self.pieces = list()  # strings of XML text and (data_path,) for attachments still to be encoded
+        self.text = list()
+
+    def write(self, text):
+        self.text.append(text)
+
+    def write_attachment(self, data_path):
+        if get_attachment_size(data_path) > MAX_RENDERED_ATTACHMENT_SIZE:
+            self.flush_text()
+            self.pieces.append((data_path,))
+        else:
+            write_base64_file(self, data_path)
+
+    def flush_text(self):
+        if self.text:
+            self.pieces.append(''.join(self.text))
+            self.text.clear()
+
+    def get_pieces(self):
+        self.flush_text()
+        return self.pieces
+
+def write_attachment_data(out, data_path):
+    if isinstance(out, RenderBuffer):
+        out.write_attachment(data_path)
+    elif data_path in prefetched_attachments:
+        start_time = time.perf_counter()
+        encoded, __ = prefetched_attachments[data_path].result()
+        out.write(encoded)
+        add_timing('attachment_wait_seconds', time.perf_counter() - start_time)
+    else:
+        write_base64_file(out, data_path)
+
+def render_fragment(fragment):
+    start_time = time.perf_counter()
+    out = RenderBuffer()
+    write_xml_fragment(out, fragment)
+    add_timing('render_seconds', time.perf_counter() - start_time)
+    return out.get_pieces()
+
+def render_fragments(fragments):
+    return [render_fragment(fragment) for fragment in fragments], take_histograms(), take_counters(ATTACHMENT_CACHE_COUNTERS)
+
+def write_sms_xml(out, fragment):
+    write_xml_start_tag(out, '', 'sms', (
+        # address - The phone number of the sender/recipient.
+        ('address', fragment.address),
+        # body - The content of the message.
+        ('body', fragment.the_text),
+        # date - The Java date representation (including millisecond) of the time when the message was sent/received.
+        ('date', fragment.timestamp),
+        ('locked', '0'),
+        # protocol - Protocol used by the message, its mostly 0 in case of SMS messages.
+        ('protocol', '0'),
+        # read - Read Message = 1, Unread Message = 0.
+        ('read', '1'),
+        # sc_toa - n/a, defaults to null.
+        ('sc_toa', 'null'),
+        # service_center - The service center for the received message, null in case of sent messages.
+        ('service_center', 'null'),
+        # status - None = -1, Complete = 0, Pending = 32, Failed = 64.
+        ('status', '-1'),
+        # sub_id - Optional field that has the id of the phone subscription (SIM).
+        ('sub_id', '-1'),
+        # subject - Subject of the message, its always null in case of SMS messages.
+        ('subject', 'null'),
+        # toa - n/a, defaults to null.
+        ('toa', 'null'),
+        # type - 1 = Received, 2 = Sent, 3 = Draft, 4 = Outbox, 5 = Failed, 6 = Queued
+        ('type', fragment.message_type),
+        # readable_date - Optional field that has the date in a human readable format.
+        # contact_name - Optional field that has the name of the contact.
+        ), empty=True)
+
+def write_mms_xml(out, fragment):
+    if fragment.participants:
+        participants_tilde = '~'.join(fragment.participants)
+    else:
+        participants_tilde = BOGUS_NUMBER
+    write_xml_start_tag(out, '', 'mms', (
+        # address - The phone number of the sender/recipient.
+        ('address', participants_tilde),
+        # ct_t - The Content-Type of the message, usually "application/vnd.wap.multipart.related"
+        ('ct_t', 'application/vnd.wap.multipart.related'),
+        # date - The Java date representation (including millisecond) of the time when the message was sent/received.
+        ('date', fragment.timestamp),
+        # m_type - The type of the message defined by MMS spec.
+        ('m_type', fragment.m_type),
+        # msg_box - The type of message, 1 = Received, 2 = Sent, 3 = Draft, 4 = Outbox
+        ('msg_box', fragment.msgbox_type),
+        # read - Has the message been read
+        ('read', '1'),
+        # rr - The read-report of the message.
+        ('rr', 'null'),
+        ('seen', '1'),
+        ('sub_id', '-1'),
+        ('text_only', '0'),
+        # sub - The subject of the message, if present.
+        # m_id - The Message-ID of the message
+        # m_size - The size of the message.
+        # sim_slot - The sim card slot.
+        # readable_date - Optional field that has the date in a human readable format.
+        # contact_name - Optional field that has the name of the contact.
+        ))
+
+    write_xml_start_tag(out, ' ', 'addrs', ())
+    for address, address_type in fragment.addrs:
+        write_xml_start_tag(out, '  ', 'addr', (
+            # address - The phone number of the sender/recipient.
+            ('address', address),
+            # charset - Character set of this entry
+            ('charset', '106'),
+            # type - The type of address, 129 = BCC, 130 = CC, 151 = To, 137 = From
+            ('type', address_type),
+            ), empty=True)
+    write_xml_end_tag(out, ' ', 'addrs')
+
+    the_text = fragment.the_text
+    # don't bother with a trivial text part
+    has_text_part = the_text and the_text != "MMS Sent" and the_text != "MMS Received"
+    if not has_text_part and not fragment.parts:
+        write_xml_start_tag(out, ' ', 'parts', (), empty=True)
+    else:
+        write_xml_start_tag(out, ' ', 'parts', ())
+        if has_text_part:
+            write_text_part_xml(out, the_text)
+        for part in fragment.parts:
+            write_part_xml(out, part)
+        write_xml_end_tag(out, ' ', 'parts')
+
+    write_xml_end_tag(out, '', 'mms')
+
+def write_text_part_xml(out, the_text):
+    write_xml_start_tag(out, '  ', 'part', (
+        ('cd', 'null'),
+        # chset - The charset of the part.
+        ('chset', '106'),
+        ('cid', '<text000001>'),
+        # cl - The content location of the part.
+        ('cl', 'text000001'),
         # ct - The content type of the part.
-        part_elt['ct'] = content_type
+        ('ct', 'text/plain'),
+        ('ctt_s', 'null'),
+        ('ctt_t', 'null'),
+        ('fn', 'null'),
         # name - The name of the part.
-        part_elt['name'] = attachment_filename
-        # chset - The charset of the part.
-        part_elt['chset'] = 'null'
-        part_elt['cd'] = 'null'
-        part_elt['fn'] = 'null'
-        part_elt['cid'] = '<0>'
-        part_elt['ctt_s'] = 'null'
-        part_elt['ctt_t'] = 'null'
+        ('name', 'null'),
+        # seq - The order of the part.
+        ('seq', '-1'),
         # text - The text content of the part.
-        part_elt['text'] = 'null'
-        part_elt['sef_type'] = '0'
-        # cl - The content location of the part.
-        part_elt['cl'] = attachment_filename
+        ('text', the_text),
         # data - The base64 encoded binary content of the part.
-        part_elt['data'] = attachment_data
+        ), empty=True)
+
+def write_part_xml(out, part):
+    write_xml_comment(out, '  ', part.comment_path)
+    out.write('  <part' + xml_attributes((
+        ('cd', 'null'),
+        # chset - The charset of the part.
+        ('chset', 'null'),
+        ('cid', '<0>'),
+        # cl - The content location of the part.
+        ('cl', part.content_location),
+        # ct - The content type of the part.
+        ('ct', part.content_type),
+        ('ctt_s', 'null'),
+        ('ctt_t', 'null'),
+        )))
+    # data - The base64 encoded binary content of the part. It's streamed from the file,
+    # and base64 never needs escaping, so it's written here without xml_attribute().
+    out.write(' data="')
+    write_attachment_data(out, part.data_path)
+    out.write('"' + xml_attributes((
+        ('fn', 'null'),
+        # name - The name of the part.
+        ('name', part.name),
+        ('sef_type', '0'),
+        # seq - The order of the part.
+        ('seq', part.sequence_number),
+        # text - The text content of the part.
+        ('text', 'null'),
+        )))
+    write_xml_start_tag_end(out, '  ', 'part', empty=True)
+
+def write_call_xml(out, fragment):
+    write_xml_start_tag(out, '', 'call', (
+        # date - The Java date representation (including millisecond) of the time of the call
+        ('date', fragment.timestamp),
+        # duration - The duration of the call in seconds.
+        ('duration', fragment.duration),
+        # number - The phone number of the call.
+        ('number', fragment.telephone_number),
+        # presentation - caller id presentation info. 1 = Allowed, 2 = Restricted, 3 = Unknown, 4 = Payphone.
+        ('presentation', fragment.presentation),
+        # readable_date - Optional field that has the date in a human readable format.
+        ('readable_date', fragment.readable_date),
+        # call_type - 1 = Incoming, 2 = Outgoing, 3 = Missed, 4 = Voicemail, 5 = Rejected, 6 = Refused List.
+        ('type', fragment.call_type),
+        # post_dial_digits
+        # subscription_id - Optional field that has the id of the phone subscription (SIM). On some phones these are values like 0, 1, 2  etc. based on how the phone assigns the index to the sim being used while others have the full SIM ID.
+        # contact_name - Optional field that has the name of the contact.
+        ), empty=True)
+
+# For --jobs. With more than one job, the second pass sends batches of fragments to a pool of worker
+# processes to be turned into XML text. The results are written in the same order a single process
+# would have written them. (The first pass also uses the pool for reading the HTML files.)
+worker_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+worker_count = 1
+pending_fragments = list()  # (backup_file, fragment) not yet sent to the worker_pool
+pending_renders = deque()   # (list of backup_file, future) in the order they were sent to the worker_pool
+max_pending_renders = 0
+RENDER_BATCH_SIZE = 50
+READ_CHUNK_SIZE = 50
+
+def start_worker_pool(jobs, attachment_threads):
+    global worker_pool, worker_count, max_pending_renders, prefetch_pool
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    worker_count = jobs
+    if jobs > 1:
+        print(f'>> Using {jobs} worker processes')
+        max_pending_renders = 4 * jobs
+        worker_pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=get_worker_context(), initializer=init_worker, initargs=(voice_file_parser, compat_xml, attachment_cache.budget, takeout_archive, file_catalogue))
+    elif attachment_threads > 0:
+        prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=attachment_threads, thread_name_prefix='Attachment')
+
+# Worker processes are started with "forkserver" where there is such a thing. Forking the main process
+# itself isn't safe once it has other threads going, like the --compression threads of a BackupFile
+# or the --profile_filename sampler. Anything a worker needs is passed to it by its initializer, the
+# same as for "spawn" (the only choice on Windows).
+def get_worker_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return None
+
+def init_worker(parser, compat, attachment_cache_budget, archive, catalogue):
+    global voice_file_parser, compat_xml, attachment_cache, takeout_archive, file_catalogue
+    voice_file_parser = parser
+    file_catalogue = catalogue
+    takeout_archive = archive
+    compat_xml = compat
+    attachment_cache = AttachmentCache(attachment_cache_budget)
+    histograms.clear()  # a forked process might have a copy of the parent's
+    take_counters(ATTACHMENT_CACHE_COUNTERS)  # likewise
+
+def stop_worker_pool():
+    global worker_pool, prefetch_pool
+    if worker_pool:
+        worker_pool.shutdown()
+        worker_pool = None
+    if prefetch_pool:
+        prefetch_pool.shutdown()
+        prefetch_pool = None
+
+# The first pass, map-reduce style. Each chunk of HTML files (in a worker process, for --jobs) is read into
+# VoiceFileRecords and boiled down to its contact sightings. The sightings are merged into the ContactsOracle
+# in the original file order, so the results are exactly the same as doing it one file at a time.
+def read_voice_files(html_targets):
+    if worker_pool:
+        chunks = [html_targets[ii:ii+READ_CHUNK_SIZE] for ii in range(0, len(html_targets), READ_CHUNK_SIZE)]
+        return worker_pool.map(read_voice_files_chunk, chunks)
+    return [read_voice_files_chunk(html_targets)]
+
+def read_voice_files_chunk(html_targets):
+    voice_file_records = list()
+    reader_counts = {'call_files_read_quickly': 0, 'call_files_fully_parsed': 0}
+    for html_target in html_targets:
+        start_time = time.perf_counter()
+        voice_file_record = read_one_voice_file(html_target, reader_counts)
+        if voice_file_record:
+            add_timing('parse_seconds', time.perf_counter() - start_time)
+            voice_file_records.append(voice_file_record)
+    return voice_file_records, get_contact_sightings(voice_file_records), reader_counts, take_histograms()
+
+# A partial table of discovered contacts for some consecutive voice files, as a list of
+# (html_target, timestamp, number, name) in file order. It keeps the first sighting of each
+# (name, number) pair and each later sighting with a newer timestamp than any before it in
+# these files. Those are the only sightings that can change the ContactsOracle or lead to a
+# conflict warning. For any other, add_discovered_contact() finds the pair already known
+# with at least as new a timestamp and does nothing.
+def get_contact_sightings(voice_file_records):
+    newest_timestamps = dict()
+    contact_sightings = list()
+    for voice_file_record in voice_file_records:
+        timestamp = voice_file_record.timestamp
+        for this_number, this_name in voice_file_record.vcards:
+            if not this_name:
+                continue
+            key = (this_name, this_number)
+            newest_timestamp = newest_timestamps.get(key, None)
+            if newest_timestamp is None or timestamp > newest_timestamp:
+                newest_timestamps[key] = timestamp
+                contact_sightings.append((voice_file_record.html_target, timestamp, this_number, this_name))
+    return contact_sightings
+
+def merge_contact_sightings(contact_sightings):
+    for html_target, timestamp, this_number, this_name in contact_sightings:
+        scan_vcards_for_contacts(html_target, timestamp, [(this_number, this_name)])
+
+# For --snapshot_filename. Everything the first pass gets out of the HTML files, saved so that
+# a later run over the same files doesn't have to read them again. The contact sightings are
+# saved as-is rather than what the ContactsOracle made of them, because the contacts file and
+# policy are often what's being changed between runs. It's a pickle file, so only use your own.
+SNAPSHOT_VERSION = 1  # change this whenever VoiceFileRecord or the sightings change
+
+@dataclass
+class FirstPassSnapshot:
+    version: int
+    fingerprint: Optional[str]
+    voice_file_records: list
+    contact_sightings: list
+    reader_counts: dict
+
+# Any file under the voice_directory being added, removed, or touched changes the fingerprint.
+def get_catalogue_fingerprint(voice_directory):
+    fingerprint = hashlib.sha256()
+    for entry in file_catalogue.files_under(voice_directory):
+        fingerprint.update(f'{entry.rel_path}\0{entry.size}\0{entry.mtime!r}\n'.encode('utf-8', 'surrogateescape'))
+    return fingerprint.hexdigest()
+
+def load_first_pass_snapshot(snapshot_filename, fingerprint):
+    if not os.path.exists(snapshot_filename):
+        return None
+    try:
+        with open(snapshot_filename, 'rb') as snapshot_file:
+            first_pass_snapshot = pickle.load(snapshot_file)
+    except Exception as e:
+        print(f'>> Ignoring unreadable snapshot {get_aka_path(snapshot_filename)}: {e}')
+        return None
+    if not isinstance(first_pass_snapshot, FirstPassSnapshot) or first_pass_snapshot.version != SNAPSHOT_VERSION:
+        print('>> Ignoring snapshot from a different version of this script', get_aka_path(snapshot_filename))
+        return None
+    if first_pass_snapshot.fingerprint != fingerprint:
+        print('>> Ignoring out of date snapshot', get_aka_path(snapshot_filename))
+        return None
+    return first_pass_snapshot
+
+def save_first_pass_snapshot(snapshot_filename, first_pass_snapshot):
+    print('>> Saving 1st pass snapshot to', get_aka_path(snapshot_filename))
+    temporary_filename = snapshot_filename + '.tmp'
+    with open(temporary_filename, 'wb') as snapshot_file:
+        pickle.dump(first_pass_snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_filename, snapshot_filename)
+
+def write_fragment(backup_file, fragment):
+    if prefetch_pool:
+        prefetch_fragment(backup_file, fragment)
+        return
+    if not worker_pool:
+        write_xml_fragment_timed(backup_file, fragment)
+        return
+    pending_fragments.append((backup_file, fragment))
+    if len(pending_fragments) >= RENDER_BATCH_SIZE:
+        submit_pending_fragments()
+
+def submit_pending_fragments():
+    if pending_fragments:
+        backup_files = [backup_file for backup_file, __ in pending_fragments]
+        fragments = [fragment for __, fragment in pending_fragments]
+        pending_renders.append((backup_files, worker_pool.submit(render_fragments, fragments)))
+        pending_fragments.clear()
+    # don't let too much rendered-but-unwritten XML pile up
+    while len(pending_renders) > max_pending_renders:
+        write_one_pending_render()
+
+def write_one_pending_render():
+    backup_files, future = pending_renders.popleft()
+    rendered, some_histograms, some_counts = future.result()
+    merge_histograms(some_histograms)
+    for counter_name, count in some_counts.items():
+        counters[counter_name] += count
+    for backup_file, pieces in zip(backup_files, rendered):
+        for piece in pieces:
+            if isinstance(piece, str):
+                backup_file.write(piece)
+            else:
+                data_path, = piece
+                write_base64_file(backup_file, data_path)
+
+def write_xml_fragment_timed(backup_file, fragment):
+    start_time = time.perf_counter()
+    write_xml_fragment(backup_file, fragment)
+    add_timing('render_seconds', time.perf_counter() - start_time)
+
+# For --attachment_threads, when there is only one process. A fragment with attachments waits here
+# while a pool of threads reads and encodes its attachments (along with any other fragments written
+# after it, to keep the order). Meanwhile, the main thread goes on working out the following fragments.
+# There is a limit on how much encoded text can be waiting. A fragment whose attachments add up to
+# more than that has them streamed into the output file by the main thread, as usual.
+ATTACHMENT_THREADS = 4
+MAX_PREFETCHED_BYTES = 64 * 1024 * 1024
+MAX_PREFETCHED_FRAGMENTS = 1000
+prefetch_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+prefetched_fragments = deque()  # (backup_file, fragment, {data_path: future}, encoded size)
+prefetched_bytes = 0
+prefetched_attachments = dict()  # data_path -> future, for the fragment being written
+
+def prefetch_fragment(backup_file, fragment):
+    global prefetched_bytes
+    encoded_sizes = dict()  # data_path -> encoded size
+    for part in getattr(fragment, 'parts', ()):
+        if part.data_path not in encoded_sizes:
+            encoded_sizes[part.data_path] = (get_attachment_size(part.data_path) + 2) // 3 * 4
+    encoded_size = sum(encoded_sizes.values())
+    if encoded_size > MAX_PREFETCHED_BYTES:
+        encoded_sizes.clear()  # all of it can't be waiting at once, so none of it waits
+        encoded_size = 0
+    # make room before submitting anything, so that the limits hold with this fragment included
+    while prefetched_fragments and (prefetched_bytes + encoded_size > MAX_PREFETCHED_BYTES or len(prefetched_fragments) >= MAX_PREFETCHED_FRAGMENTS):
+        write_one_prefetched_fragment()
+    if not encoded_sizes and not prefetched_fragments:
+        write_xml_fragment_timed(backup_file, fragment)
+        return
+    futures = {data_path: prefetch_pool.submit(encode_attachment, data_path) for data_path in encoded_sizes}
+    prefetched_fragments.append((backup_file, fragment, futures, encoded_size))
+    prefetched_bytes += encoded_size
+
+# Runs on a prefetch thread. The histograms belong to the main thread, so the time taken
+# goes back with the encoded text and write_one_prefetched_fragment() records it.
+def encode_attachment(data_path):
+    start_time = time.perf_counter()
+    if attachment_cache.can_cache(get_attachment_size(data_path)):
+        encoded = attachment_cache.get_encoded(data_path)
+    else:
+        with open_input_binary_file(data_path) as data_file:
+            encoded = base64.b64encode(data_file.read()).decode('ascii')
+    return encoded, time.perf_counter() - start_time
+
+def write_one_prefetched_fragment():
+    global prefetched_attachments, prefetched_bytes
+    backup_file, fragment, prefetched_attachments, encoded_size = prefetched_fragments.popleft()
+    write_xml_fragment_timed(backup_file, fragment)
+    for future in prefetched_attachments.values():
+        __, seconds = future.result()
+        add_timing('attachment_seconds', seconds)
+    prefetched_attachments = dict()
+    prefetched_bytes -= encoded_size
+
+def flush_fragments():
+    while prefetched_fragments:
+        write_one_prefetched_fragment()
+    if not worker_pool:
+        return
+    submit_pending_fragments()
+    while pending_renders:
+        write_one_pending_render()
 
 # a somewhat arbitrary collection of content types; I did not encounter all of these
 ext_to_content_type = {
@@ -992,91 +2386,11 @@ ext_to_content_type = {
     ".vcf":   "text/x-vCard"
     }
 
-def bs4_append_mms_elt_with_parts_for_chat(parent_elt, json_target, attachment_list, the_text, sender_number, sent_by_me, timestamp, msgbox_type, participants):
-    m_type = 128 if sent_by_me else 132
-    bs4_append_mms_elt(parent_elt, participants, timestamp, m_type, msgbox_type, sender_number, sent_by_me, the_text)
-    mms_elt = parent_elt.mms
-    if attachment_list:
-        parts_elt = mms_elt.parts
-        sequence_number = 0
-        for original_name, export_path_revised in attachment_list:
-            sequence_number += 1
-            __, ext = os.path.splitext(original_name)
-            content_type = ext_to_content_type.get(ext, 'application/octet-stream')
-            # bs4_append_part_elt(parts_elt, ATTACHMENT_TYPE_IMAGE, sequence_number, html_target, attachment_file_ref)
-            with open(export_path_revised, 'rb') as attachment_file: 
-                attachment_data = base64.b64encode(attachment_file.read()).decode()
-            subdirectory, export_name = os.path.split(export_path_revised)
-            parts_elt.append(bs4_get_file_comment((subdirectory, export_name)))
-            part_elt = html_elt.new_tag('part')
-            parts_elt.append(part_elt)
-
-            # seq - The order of the part.
-            part_elt['seq'] = sequence_number
-            # ct - The content type of the part.
-            part_elt['ct'] = content_type
-            # name - The name of the part.
-            part_elt['name'] = original_name
-            # chset - The charset of the part.
-            part_elt['chset'] = 'null'
-            part_elt['cd'] = 'null'
-            part_elt['fn'] = 'null'
-            part_elt['cid'] = '<0>'
-            part_elt['ctt_s'] = 'null'
-            part_elt['ctt_t'] = 'null'
-            # text - The text content of the part.
-            part_elt['text'] = 'null'
-            part_elt['sef_type'] = '0'
-            # cl - The content location of the part.
-            part_elt['cl'] = export_name
-            # data - The base64 encoded binary content of the part.
-            part_elt['data'] = attachment_data
-
-def bs4_append_addrs_elt(elt_parent, participants, other_party_number, sent_by_me):
-    addrs_elt = html_elt.new_tag('addrs')
-    elt_parent.append(addrs_elt)
-    me_contact = contacts_oracle.get_number_by_name('Me', None)
-    for participant in participants + [me_contact]:
-        if sent_by_me and participant == me_contact:
-            participant_is_sender = True
-        elif not sent_by_me and participant == other_party_number:
-            participant_is_sender = True
-        else:
-            participant_is_sender = False
-        addr_elt = html_elt.new_tag('addr')
-
-        # address - The phone number of the sender/recipient.
-        addr_elt['address'] = participant
-        # charset - Character set of this entry
-        addr_elt['charset'] = '106'
-        # type - The type of address, 129 = BCC, 130 = CC, 151 = To, 137 = From
-        addr_elt['type'] = '137' if participant_is_sender else '151'
-
-        addrs_elt.append(addr_elt)
-
-def bs4_append_call_elt(parent_elt, telephone_number, duration, timestamp, presentation, readable_date, call_type):
-    call_elt = html_elt.new_tag('call')
-    # number - The phone number of the call.
-    call_elt['number'] = telephone_number
-    # duration - The duration of the call in seconds.
-    call_elt['duration'] = duration
-    # date - The Java date representation (including millisecond) of the time of the call
-    call_elt['date'] = timestamp
-    # presentation - caller id presentation info. 1 = Allowed, 2 = Restricted, 3 = Unknown, 4 = Payphone.
-    call_elt['presentation'] = presentation
-    # readable_date - Optional field that has the date in a human readable format.
-    call_elt['readable_date'] = readable_date    
-    # call_type - 1 = Incoming, 2 = Outgoing, 3 = Missed, 4 = Voicemail, 5 = Rejected, 6 = Refused List.
-    call_elt['type'] = call_type    
-    #call_elt['post_dial_digits'] = ''
-    # subscription_id - Optional field that has the id of the phone subscription (SIM). On some phones these are values like 0, 1, 2  etc. based on how the phone assigns the index to the sim being used while others have the full SIM ID.
-    # contact_name - Optional field that has the name of the contact.
-    
-    parent_elt.append(call_elt)
-
-def bs4_get_file_comment(file_target):
-    files_used.add(get_rel_path(file_target))
-    return Comment(f' file: "{get_rel_path(file_target)}" ')
+# Note that a file made it into the output, and give back its name for the XML comment.
+def use_file(file_target):
+    rel_path = get_rel_path(file_target)
+    files_used.add(rel_path)
+    return rel_path
 
 attachments_used = set()
 
@@ -1117,39 +2431,314 @@ def figure_out_attachment_filename_and_type(attachment_type, html_target, attach
     print(f'>>    due to File: "{get_abs_path(html_target)}"')
     return None, None
     
+# For each type of attachment, the file extensions we know how to handle and the content types
+# that go with them, in order of preference when more than one of them is there.
+attachment_extensions = {
+    ATTACHMENT_TYPE_IMAGE: (('.jpg', 'image/jpeg'), ('.gif', 'image/gif'), ('.png', 'image/png')),
+    ATTACHMENT_TYPE_AUDIO: (('.amr', 'audio/amr'), ('.mp3', 'audio/mp3')),
+    ATTACHMENT_TYPE_VIDEO: (('.mp4', 'video/mp4'), ('.3gp', 'video/3gpp')),
+    ATTACHMENT_TYPE_VCARD: (('.vcf', 'text/x-vCard'),),
+    }
+
 def consider_this_attachment_file_candidate(subdirectory, base, attachment_type):
-    attachment_filename = None
-    content_type = None
-    if attachment_type == ATTACHMENT_TYPE_IMAGE:
-        if os.path.exists(get_rel_path((subdirectory, base + '.jpg'))):
-            attachment_filename = base + '.jpg'
-            content_type = 'image/jpeg'
-        elif os.path.exists(get_rel_path((subdirectory, base + '.gif'))):
-            attachment_filename = base + '.gif'
-            content_type = 'image/gif'
-        elif os.path.exists(get_rel_path((subdirectory, base + '.png'))):
-            attachment_filename = base + '.png'
-            content_type = 'image/png'
-    elif attachment_type == ATTACHMENT_TYPE_AUDIO:
-        if os.path.exists(get_rel_path((subdirectory, base + '.mp3'))):
-            attachment_filename = base + '.mp3'
-            content_type = 'audio/mp3'
-        if os.path.exists(get_rel_path((subdirectory, base + '.amr'))):
-            attachment_filename = base + '.amr'
-            content_type = 'audio/amr'
-    elif attachment_type == ATTACHMENT_TYPE_VIDEO:
-        if os.path.exists(get_rel_path((subdirectory, base + '.3gp'))):
-            attachment_filename = base + '.3gp'
-            content_type = 'video/3gpp'
-        if os.path.exists(get_rel_path((subdirectory, base + '.mp4'))):
-            attachment_filename = base + '.mp4'
-            content_type = 'video/mp4'
-    elif attachment_type == ATTACHMENT_TYPE_VCARD:
-        if os.path.exists(get_rel_path((subdirectory, base + '.vcf'))):
-            attachment_filename = base + '.vcf'
-            content_type = 'text/x-vCard'
-    return attachment_filename, content_type
-    
+    for ext, content_type in attachment_extensions.get(attachment_type, ()):
+        if directory_index_has_file((subdirectory, base + ext)):
+            return base + ext, content_type
+    return None, None
+
+# Looking for attachments means trying a lot of possible filenames. Rather than asking the file
+# system about each one (slow if it's on a network drive), each directory is listed once, the
+# first time we look in it, into a dict of {stem: set of extensions}. Each index also has a set of
+# all the filenames in lower case, for file systems that don't care about upper/lower case.
+directory_indexes = dict()  # directory: (directory_index, casefolded_filenames)
+
+def get_directory_index(directory):
+    indexes = directory_indexes.get(directory, None)
+    if indexes is None:
+        names = list()
+        if takeout_archive:
+            listing = takeout_archive.list_directory(directory)
+            if listing:
+                subdirectory_names, file_listing = listing
+                names.extend(subdirectory_names)
+                names.extend(name for name, __, __ in file_listing)
+        else:
+            try:
+                with os.scandir(directory or os.curdir) as entries:
+                    for entry in entries:
+                        if entry.is_symlink() and not os.path.exists(entry.path):
+                            continue  # dangling
+                        names.append(entry.name)
+            except OSError:
+                pass  # same as a directory with nothing in it
+        indexes = add_directory_index(directory, names)
+    return indexes
+
+def add_directory_index(directory, names):
+    directory_index = dict()
+    casefolded_filenames = set()
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        directory_index.setdefault(stem, set()).add(ext)
+        casefolded_filenames.add(name.casefold())
+    indexes = directory_index, casefolded_filenames
+    directory_indexes[directory] = indexes
+    return indexes
+
+def directory_index_has_file(file_target):
+    directory, filename = os.path.split(get_rel_path(file_target))
+    stem, ext = os.path.splitext(filename)
+    directory_index, casefolded_filenames = get_directory_index(directory)
+    if ext in directory_index.get(stem, ()):
+        return True
+    # The listing can't tell us whether the file system cares about upper/lower case, so ask
+    # it about a name that's only different in case. That's rare enough not to cost much.
+    if filename.casefold() in casefolded_filenames:
+        return input_file_exists(get_rel_path(file_target))
+    return False
+
+# Everything under the Google Voice and Google Chat directories is found with a single scan up front.
+# The two passes over the HTML files, the chat files, the attachment lookups, and the check for
+# unused files at the end all work from this catalogue instead of going back to the file system.
+FILE_KIND_HTML = "html"
+FILE_KIND_JSON = "json"
+FILE_KIND_ATTACHMENT = "attachment"  # anything else; it's probably an attachment
+
+@dataclass
+class CatalogueEntry:
+    target: tuple  # (subdirectory, basename)
+    rel_path: str
+    size: int
+    mtime: float
+    kind: str
+
+class FileCatalogue:
+    def __init__(self):
+        self._trees = dict()  # top directory: (list of CatalogueEntry, list of directories), both in os.walk() order
+        self._rel_paths = set()
+        self._sizes = dict()  # rel_path: size
+
+    def scan(self, top):
+        entries = list()
+        directories = list()
+        # same order as os.walk(top)
+        pending_directories = [top]
+        while pending_directories:
+            subdirectory = pending_directories.pop()
+            if takeout_archive:
+                listing = takeout_archive.list_directory(subdirectory)
+            else:
+                listing = list_directory(subdirectory)
+            if listing is None:
+                continue  # like os.walk(), quietly skip what we can't read
+            subdirectory_names, file_listing = listing
+            directories.append(subdirectory)
+            names = list(subdirectory_names)
+            for name, size, mtime in file_listing:
+                names.append(name)
+                target = (subdirectory, name)
+                entries.append(CatalogueEntry(target, get_rel_path(target), size, mtime, get_file_kind(name)))
+            add_directory_index(os.path.normpath(subdirectory), names)
+            subdirectories = [os.path.join(subdirectory, name) for name in subdirectory_names]
+            if not takeout_archive:
+                # like os.walk(), list symlinked directories but don't go into them. Paths inside an
+                # archive aren't on the filesystem, and the archive listing already decided what they are.
+                subdirectories = [path for path in subdirectories if not os.path.islink(path)]
+            pending_directories.extend(reversed(subdirectories))
+        self._trees[top] = (entries, directories)
+        self._rel_paths.update(entry.rel_path for entry in entries)
+        self._sizes.update((entry.rel_path, entry.size) for entry in entries)
+
+    def files_under(self, top):
+        entries, __ = self._trees[top]
+        return entries
+
+    def directories_under(self, top):
+        __, directories = self._trees[top]
+        return directories
+
+    def has_file(self, target):
+        return get_rel_path(target) in self._rel_paths
+
+    # None if the file wasn't seen by scan()
+    def get_size(self, path):
+        return self._sizes.get(os.path.normpath(path), None)
+
+# The size of an attachment, from the FileCatalogue if it's there, to save asking the file system again.
+def get_attachment_size(data_path):
+    size = file_catalogue.get_size(data_path)
+    if size is None:
+        size = get_input_file_size(data_path)
+    return size
+
+# For FileCatalogue.scan(). Gives back (subdirectory names, list of (filename, size, mtime)), or None if the
+# directory can't be read. Symlinks to directories are listed as subdirectories.
+def list_directory(directory):
+    try:
+        with os.scandir(directory) as scandir_entries:
+            scandir_entries = list(scandir_entries)
+    except OSError:
+        return None
+    subdirectory_names = list()
+    file_listing = list()
+    for scandir_entry in scandir_entries:
+        try:
+            is_dir = scandir_entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            subdirectory_names.append(scandir_entry.name)
+            continue
+        try:
+            stat_result = scandir_entry.stat()
+        except OSError:
+            continue  # dangling symlink, or it went away
+        file_listing.append((scandir_entry.name, stat_result.st_size, stat_result.st_mtime))
+    return subdirectory_names, file_listing
+
+def get_file_kind(file_name):
+    __, ext = os.path.splitext(file_name)
+    if ext == '.html':
+        return FILE_KIND_HTML
+    if ext == '.json':
+        return FILE_KIND_JSON
+    return FILE_KIND_ATTACHMENT
+
+file_catalogue = FileCatalogue()
+
+# For --takeout_archive. Instead of unpacking the Takeout .zip or .tgz files, the files are read from
+# inside them. Google splits a big Takeout into parts, and a directory can be spread over more than one
+# part, so all of the parts are indexed together. Paths are relative to the "Takeout/" folder inside the
+# archives, the same as they would be when running from within the unpacked "Takeout/" directory.
+# Each thread (and each worker process) opens its own handles on the archive files, since a .zip
+# or .tar file can't be read from two places at once through the same handle.
+TAKEOUT_ARCHIVE_TOP = 'Takeout'
+takeout_archive = None
+
+class TakeoutArchive:
+    def __init__(self, archive_filenames):
+        self._archive_filenames = list(archive_filenames)
+        self._members = dict()      # rel_path: (part number, ZipInfo or TarInfo)
+        self._directories = dict()  # directory: (list of subdirectory names, list of (filename, size, mtime))
+        self._local = threading.local()
+        for part, archive_filename in enumerate(self._archive_filenames):
+            print('>> Indexing', get_aka_path(archive_filename))
+            if zipfile.is_zipfile(archive_filename):
+                with zipfile.ZipFile(archive_filename) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            self._add_member(info.filename, part, info, info.file_size, time.mktime(info.date_time + (0, 0, -1)))
+            elif tarfile.is_tarfile(archive_filename):
+                with tarfile.open(archive_filename) as archive:
+                    for info in archive:
+                        if info.isreg():
+                            info.tarfile = None  # so that it can be pickled for the worker processes
+                            self._add_member(info.name, part, info, info.size, info.mtime)
+                if not archive_filename.endswith('.tar'):
+                    print(f'>> {archive_filename} is compressed as a whole, so reading files out of order is slow. A .zip or an uncompressed .tar is faster.')
+            else:
+                raise Exception(f'{get_aka_path(archive_filename)} is not a .zip or .tar/.tgz file')
+
+    def _add_member(self, member_name, part, info, size, mtime):
+        rel_path = os.path.normpath(member_name)
+        top, __, rest = rel_path.partition(os.sep)
+        if top == TAKEOUT_ARCHIVE_TOP and rest:
+            rel_path = rest
+        if rel_path in self._members:
+            return  # the same file in more than one part; the first one wins
+        self._members[rel_path] = (part, info)
+        directory, filename = os.path.split(rel_path)
+        directory = directory or os.curdir
+        self._get_directory(directory)[1].append((filename, size, mtime))
+
+    def _get_directory(self, directory):
+        listing = self._directories.get(directory, None)
+        if listing is None:
+            listing = (list(), list())
+            self._directories[directory] = listing
+            if directory != os.curdir:
+                parent, name = os.path.split(directory)
+                self._get_directory(parent or os.curdir)[0].append(name)
+        return listing
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']  # open handles stay behind
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_archive(self, part):
+        # A forked worker process gets a copy of the parent's handles, which it must not share.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.archives = dict()
+        archive = self._local.archives.get(part, None)
+        if archive is None:
+            archive_filename = self._archive_filenames[part]
+            if zipfile.is_zipfile(archive_filename):
+                archive = zipfile.ZipFile(archive_filename)
+            else:
+                archive = tarfile.open(archive_filename)
+            self._local.archives[part] = archive
+        return archive
+
+    def _get_member(self, path):
+        return self._members.get(os.path.normpath(path), None)
+
+    def has_file(self, path):
+        return self._get_member(path) is not None
+
+    def get_size(self, path):
+        member = self._get_member(path)
+        if member is None:
+            raise FileNotFoundError(f'No such file in {self._archive_filenames}: {path}')
+        __, info = member
+        return info.file_size if isinstance(info, zipfile.ZipInfo) else info.size
+
+    def open_binary(self, path):
+        member = self._get_member(path)
+        if member is None:
+            raise FileNotFoundError(f'No such file in {self._archive_filenames}: {path}')
+        part, info = member
+        archive = self._get_archive(part)
+        if isinstance(info, zipfile.ZipInfo):
+            return archive.open(info)
+        return archive.extractfile(info)
+
+    # Same as list_directory(), but for a directory inside the archive.
+    def list_directory(self, directory):
+        return self._directories.get(os.path.normpath(directory), None)
+
+    def describe(self, path):
+        member = self._get_member(path)
+        part = member[0] if member else 0
+        return f'{os.path.normpath(path)} in {os.path.abspath(self._archive_filenames[part])}'
+
+# Everything that reads from the Takeout goes through these, so that it doesn't matter whether
+# the files are on disk or in the archive.
+def open_input_file(path, encoding=None):
+    if takeout_archive:
+        return TextIOWrapper(takeout_archive.open_binary(path), encoding=encoding)
+    return open(path, 'r', encoding=encoding)
+
+def open_input_binary_file(path):
+    if takeout_archive:
+        return takeout_archive.open_binary(path)
+    return open(path, 'rb')
+
+def get_input_file_size(path):
+    if takeout_archive:
+        return takeout_archive.get_size(path)
+    return os.path.getsize(path)
+
+def input_file_exists(path):
+    if takeout_archive:
+        return takeout_archive.has_file(path)
+    return os.path.exists(path)
+
 # One of the mysteries for Takeout formatting. If the <cite> element includes a
 # <span> tag, then it was sent by someone else. If no <span> tag, it was sent by Me.
 def get_message_type(message):
@@ -1164,7 +2753,11 @@ def get_vm_transcript(message_elt):
     if not full_text_elt:
         return None
     
-    return BeautifulSoup(full_text_elt.text, 'html.parser').prettify(formatter=FORMATTER).strip()
+    return prettify_vm_transcript(full_text_elt.text)
+
+def prettify_vm_transcript(transcript_text):
+    # always 'html.parser', whichever parser is reading the HTML files, so that the results are the same
+    return BeautifulSoup(transcript_text, 'html.parser').prettify(formatter=FORMATTER).strip()
 
 def get_message_text(message_elt):
     text_elt = message_elt.find('q')
@@ -1174,13 +2767,9 @@ def get_message_text(message_elt):
         br.replace_with("&#10;")
     return text_elt.text
 
-def get_mms_participant_phone_numbers(html_target, participants_elt):
+def get_mms_participant_phone_numbers(html_target, raw_participants):
     participants = []
-    tel_elts = participants_elt.find_all(class_='tel')
-    for tel_elt in tel_elts:
-        if not tel_elt.name == 'a':
-            continue
-        raw_number = tel_elt['href'][4:]
+    for raw_number in raw_participants:
         if not raw_number:
             # I don't know if this can ever happen
             raw_number = contact_name_to_number(get_sender_name_from_title_or_filename(html_target))
@@ -1209,9 +2798,8 @@ def get_mms_participant_phone_numbers(html_target, participants_elt):
     return participants
 
 def format_number(html_target, raw_number):
-    try:
-        phone_number = phonenumbers.parse(raw_number, None)
-    except phonenumbers.phonenumberutil.NumberParseException:
+    e164_number = get_e164_number(raw_number)
+    if e164_number is None:
         # I also saw this on a 10-year-old "Placed" call. Probably a data glitch.
         print()
         if raw_number:
@@ -1221,10 +2809,34 @@ def format_number(html_target, raw_number):
         print(f'      due to File: "{get_abs_path(html_target)}"')
         counters['todo_errors'] += 1
         return raw_number
+    return e164_number
+
+# A Takeout has maybe a few hundred different phone numbers, but each of them shows up over and
+# over again. The normalized forms (including "can't be parsed", as None) are remembered, so the
+# work is done once per number. The messages for a bad number are still given every time.
+NUMBER_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def get_e164_number(raw_number):
+    try:
+        phone_number = phonenumbers.parse(raw_number, None)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return None
     return phonenumbers.format_number(phone_number, phonenumbers.PhoneNumberFormat.E164)
 
+@functools.lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def get_nanp_number(number):
+    if len(number) == 10 and not number.startswith('1'):
+        return '+1' + number
+    elif len(number) == 11 and number.startswith('1'):
+        return '+' + number
+    else:
+        # This is unlikely to work out
+        return number
+
+PHONE_NUMBER_PATTERN = re.compile(r'(\+?[0-9]+)')
 def is_phone_number(value):
-    match_phone_number = re.match(r'(\+?[0-9]+)', value)
+    match_phone_number = PHONE_NUMBER_PATTERN.match(value)
     if match_phone_number:
         return match_phone_number.group(1)
     return None 
@@ -1245,9 +2857,53 @@ def get_time_unix_ms(message):
     if not time_elt:
         time_elt = message.find(class_='published')
     iso_time = time_elt['title']
-    #parsed_iso_time = dateutil.parser.isoparse(iso_time)
-    parsed_iso_time = datetime_from_string(iso_time)
-    return unix_time_ms_from_datetime(parsed_iso_time)
+    return unix_ms_from_iso_time(iso_time)
+
+# Every message has a timestamp, and dateutil's parser is slow because it can figure out almost
+# anything. Takeout only uses a couple of formats, so those are picked apart with a regular
+# expression, and dateutil only sees something different. Like unix_time_ms_from_datetime(),
+# these drop any fraction of a second.
+ISO_TIME_PATTERN = re.compile(r'(\d{4})-(\d\d)-(\d\d)T([01]\d|2[0-3]):([0-5]\d):([0-5]\d)(?:\.\d+)?(?:Z|([+-])(\d\d):([0-5]\d))')
+# as in Google Chat messages.json, for example: Friday, January 15, 2016 at 4:07:30 PM UTC
+CHAT_TIME_PATTERN = re.compile(r'[A-Z][a-z]+, ([A-Z][a-z]+) (\d{1,2}), (\d{4}) at (1[0-2]|[1-9]):([0-5]\d):([0-5]\d) ([AP])M UTC')
+MONTH_NUMBERS = {month_name: month_number for month_number, month_name in enumerate(
+    ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December'), start=1)}
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def unix_ms_from_iso_time(iso_time):
+    match = ISO_TIME_PATTERN.fullmatch(iso_time)
+    if match:
+        year, month, day, hour, minute, second, offset_sign, offset_hours, offset_minutes = match.groups()
+        offset_seconds = 0
+        if offset_sign:
+            offset_seconds = int(offset_hours) * 3600 + int(offset_minutes) * 60
+            if offset_sign == '-':
+                offset_seconds = -offset_seconds
+        unix_ms = unix_ms_from_fields(int(year), int(month), int(day), int(hour), int(minute), int(second), offset_seconds)
+        if unix_ms is not None:
+            return unix_ms
+    return unix_time_ms_from_datetime(datetime_from_string(iso_time))
+
+def unix_ms_from_chat_time(chat_time):
+    match = CHAT_TIME_PATTERN.fullmatch(chat_time)
+    if match:
+        month_name, day, year, hour, minute, second, am_pm = match.groups()
+        month = MONTH_NUMBERS.get(month_name, None)
+        hour = int(hour) % 12
+        if am_pm == 'P':
+            hour += 12
+        if month:
+            unix_ms = unix_ms_from_fields(int(year), month, int(day), hour, int(minute), int(second), 0)
+            if unix_ms is not None:
+                return unix_ms
+    return unix_time_ms_from_datetime(datetime_from_string(chat_time))
+
+def unix_ms_from_fields(year, month, day, hour, minute, second, offset_seconds):
+    try:
+        days = datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+    except ValueError:
+        return None  # let dateutil sort it out
+    return (days * 86400 + hour * 3600 + minute * 60 + second - offset_seconds) * 1000
 
 def unix_to_iso_time(unix_time_seconds):
     dt = datetime.datetime.fromtimestamp(unix_time_seconds, datetime.timezone.utc)
@@ -1255,6 +2911,8 @@ def unix_to_iso_time(unix_time_seconds):
     return iso
 
 def get_aka_path(path):
+    if is_stdout_output(path):
+        return path + ', aka standard output'
     if os.path.isabs(path):
         return path
     else:
@@ -1262,6 +2920,8 @@ def get_aka_path(path):
 
 def get_abs_path(target):
     rel_path = get_rel_path(target)
+    if takeout_archive:
+        return takeout_archive.describe(rel_path)
     return os.path.abspath(rel_path)    
 
 def get_rel_path(target):
@@ -1273,29 +2933,216 @@ def write_dummy_headers():
     # The extra padding on the "count" lines are so that we can write the real count later
     # without worrying about not having enough space. The extra whitespace at that
     # place in the XML file is not significant.
-    sms_backup_file.write(XML_HEADER)
-    sms_backup_file.write('<smses count="0">'
+    sms_backup_file.write_dummy_header(XML_HEADER + '<smses count="0">'
                            '                                          \n')
     sms_backup_file.write("<!--Converted from Google Voice Takeout data -->\n")
 
     ################
-    vm_backup_file.write(XML_HEADER)
-    vm_backup_file.write('<smses count="0">'
+    vm_backup_file.write_dummy_header(XML_HEADER + '<smses count="0">'
                            '                                          \n')
     vm_backup_file.write("<!--Converted from Google Voice Takeout data -->\n")
 
     ################
-    call_backup_file.write(XML_HEADER)
-    call_backup_file.write('<calls count="0">'
+    call_backup_file.write_dummy_header(XML_HEADER + '<calls count="0">'
                            '                                          \n')
     call_backup_file.write("<!--Converted from Google Voice Takeout data -->\n")
 
     ################
-    chat_backup_file.write(XML_HEADER)
-    chat_backup_file.write('<smses count="0">'
+    chat_backup_file.write_dummy_header(XML_HEADER + '<smses count="0">'
                            '                                          \n')
     chat_backup_file.write("<!--Converted from Google Chat Takeout data -->\n")
 
+# For --metrics_filename and the timings at the end. The run is divided into stages, one after the
+# other, and each stage's wall clock time is kept. Timings of individual files, fragments, and
+# attachments go into histograms. Worker processes keep their own histograms and hand them back
+# with their results to be merged.
+STAGE_NAMES = ('setup', 'scan', 'pass1', 'contacts', 'pass2', 'chat', 'flush', 'headers', 'report', 'audit')
+stage_seconds = dict()
+current_stage = None
+current_stage_start_time = 0.0
+histograms = dict()
+
+# Ends whatever stage is going on (if any) and starts the next one (if any).
+def start_stage(stage_name):
+    global current_stage, current_stage_start_time
+    now = time.perf_counter()
+    if current_stage:
+        stage_seconds[current_stage] = stage_seconds.get(current_stage, 0.0) + now - current_stage_start_time
+    current_stage = stage_name
+    current_stage_start_time = now
+    if profiler:
+        profile_this_stage(stage_name)
+
+# Counts of timings in buckets of powers of 2 microseconds, so it doesn't matter how many there are.
+class TimingHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.min_seconds = None
+        self.max_seconds = 0.0
+        self.buckets = dict()  # upper bound in microseconds -> count
+
+    def add(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        if self.min_seconds is None or seconds < self.min_seconds:
+            self.min_seconds = seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        upper_bound = 1 << int(seconds * 1000000).bit_length()
+        self.buckets[upper_bound] = self.buckets.get(upper_bound, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_seconds += other.total_seconds
+        if self.min_seconds is None or (other.min_seconds is not None and other.min_seconds < self.min_seconds):
+            self.min_seconds = other.min_seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        for upper_bound, count in other.buckets.items():
+            self.buckets[upper_bound] = self.buckets.get(upper_bound, 0) + count
+
+    # The percentile is the upper bound of the bucket it falls in, so it is only good to within a factor of 2.
+    def get_percentile_seconds(self, percentile):
+        wanted = self.count * percentile / 100
+        so_far = 0
+        for upper_bound in sorted(self.buckets):
+            so_far += self.buckets[upper_bound]
+            if so_far >= wanted:
+                return min(upper_bound / 1000000, self.max_seconds)
+        return self.max_seconds
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total_seconds,
+            'mean_seconds': self.total_seconds / self.count if self.count else None,
+            'min_seconds': self.min_seconds,
+            'max_seconds': self.max_seconds,
+            'p50_seconds': self.get_percentile_seconds(50),
+            'p90_seconds': self.get_percentile_seconds(90),
+            'p99_seconds': self.get_percentile_seconds(99),
+            'buckets_microseconds': {str(upper_bound): self.buckets[upper_bound] for upper_bound in sorted(self.buckets)},
+            }
+
+def add_timing(histogram_name, seconds):
+    histogram = histograms.get(histogram_name, None)
+    if not histogram:
+        histogram = histograms[histogram_name] = TimingHistogram()
+    histogram.add(seconds)
+
+# For a worker process to hand back some of its counts so far.
+def take_counters(counter_names):
+    some_counts = {counter_name: counters[counter_name] for counter_name in counter_names}
+    for counter_name in counter_names:
+        counters[counter_name] = 0
+    return some_counts
+
+# For a worker process to hand back what it has timed so far.
+def take_histograms():
+    some_histograms = dict(histograms)
+    histograms.clear()
+    return some_histograms
+
+def merge_histograms(some_histograms):
+    for histogram_name, some_histogram in some_histograms.items():
+        histogram = histograms.get(histogram_name, None)
+        if not histogram:
+            histograms[histogram_name] = some_histogram
+        else:
+            histogram.merge(some_histogram)
+
+# For --profile_filename. cProfile gives exact call counts and times for each function, but it only
+# knows who called whom, not whole call stacks. For the flame graph, a thread samples the main
+# thread's stack every PROFILE_SAMPLE_INTERVAL seconds while profiling is on.
+PROFILE_ALL_STAGES = 'all'
+PROFILE_SAMPLE_INTERVAL = 0.005
+profiler: Optional[cProfile.Profile] = None
+profile_stages = set()
+stack_sampler = None
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id):
+        super().__init__(name='StackSampler', daemon=True)
+        self.thread_id = thread_id
+        self.sampling = False
+        self.stack_counts = dict()  # "outermost;...;innermost" -> number of samples
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(PROFILE_SAMPLE_INTERVAL):
+            if not self.sampling:
+                continue
+            frame = sys._current_frames().get(self.thread_id, None)
+            stack = list()
+            while frame:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                collapsed_stack = ';'.join(reversed(stack))
+                self.stack_counts[collapsed_stack] = self.stack_counts.get(collapsed_stack, 0) + 1
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def write_collapsed(self, collapsed_filename):
+        with open(collapsed_filename, 'w', encoding='utf-8') as collapsed_file:
+            for collapsed_stack in sorted(self.stack_counts):
+                collapsed_file.write(f'{collapsed_stack} {self.stack_counts[collapsed_stack]}\n')
+
+def start_profiler(stages, jobs):
+    global profiler, stack_sampler
+    if jobs != 1:
+        print('>> Info: Work done by --jobs worker processes will not show up in the profile')
+    profile_stages.update(STAGE_NAMES if PROFILE_ALL_STAGES in stages else stages)
+    profiler = cProfile.Profile()
+    stack_sampler = StackSampler(threading.get_ident())
+    stack_sampler.start()
+
+def profile_this_stage(stage_name):
+    profiling = stage_name in profile_stages
+    if profiling and not stack_sampler.sampling:
+        profiler.enable()
+    elif not profiling and stack_sampler.sampling:
+        profiler.disable()
+    stack_sampler.sampling = profiling
+
+def stop_profiler(profile_filename, how_many):
+    global profiler
+    profile_this_stage(None)
+    stack_sampler.stop()
+    pstats_filename = profile_filename + '.pstats'
+    collapsed_filename = profile_filename + '.collapsed'
+    print('>> Writing profile to', get_aka_path(pstats_filename), 'and', get_aka_path(collapsed_filename))
+    profiler.dump_stats(pstats_filename)
+    stack_sampler.write_collapsed(collapsed_filename)
+    print(f'>> The {how_many} functions with the most time of their own during {", ".join(stage_name for stage_name in STAGE_NAMES if stage_name in profile_stages)}:')
+    stats = pstats.Stats(profiler, stream=sys.stdout)
+    stats.strip_dirs().sort_stats(pstats.SortKey.TIME).print_stats(how_many)
+    profiler = None
+
+def write_metrics(metrics_filename, args):
+    e164_cache_info = get_e164_number.cache_info()
+    nanp_cache_info = get_nanp_number.cache_info()
+    resolution_hits, resolution_misses = contacts_oracle.get_resolution_counts()
+    metrics = {
+        'version': __updated__,
+        'options': {name: value for name, value in args.items() if name in ('number_policy', 'nanp_numbers', 'parser', 'jobs', 'snapshot_filename', 'compat_xml')},
+        'counters': counters,
+        'caches': {
+            'phone_number': {'hits': e164_cache_info.hits, 'misses': e164_cache_info.misses},
+            'nanp_heuristic': {'hits': nanp_cache_info.hits, 'misses': nanp_cache_info.misses},
+            'contact_lookup': {'hits': resolution_hits, 'misses': resolution_misses},
+            },
+        'stage_seconds': stage_seconds,
+        'total_seconds': sum(stage_seconds.values()),
+        'histograms': {histogram_name: histograms[histogram_name].as_dict() for histogram_name in sorted(histograms)},
+        }
+    print('>> Writing metrics to', get_aka_path(metrics_filename))
+    with open(metrics_filename, 'w', encoding='utf-8') as metrics_file:
+        json.dump(metrics, metrics_file, indent=2)
+
 def print_counters(contacts_filename, sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename):
     pp = pprint.PrettyPrinter(indent=2, width=132)
     print(">> Counters:")
@@ -1304,8 +3151,16 @@ def print_counters(contacts_filename, sms_backup_filename, vm_backup_filename, c
     print(f">> {counters['number_of_calls_output']:6} Call records from Google Voice written to {get_aka_path(call_backup_filename)}")
     print(f">> {counters['number_of_chat_sms_output']:6} SMS/MMS records from Google Chat written to {get_aka_path(chat_backup_filename)}")
     print(f">> {counters['number_of_discovered_contacts']:6} Contacts discovered in HTML files")
+    print(f">> {counters['call_files_read_quickly']:6} HTML files read by the quick call log reader")
+    print(f">> {counters['call_files_fully_parsed']:6} HTML files that looked like call logs but needed the full HTML parser")
+    print(f">> {counters['html_files_from_snapshot']:6} HTML files not read because the 1st pass came from the snapshot")
+    print(f">> {counters['attachments_from_cache']:6} Attachments encoded from the cache ({counters['attachment_bytes_saved']} bytes of base64 reused)")
     print(f">> {counters['conflict_warnings']:6} Conflict info warnings given")
     print(f">> {counters['todo_errors']:6} TODO errors given")
+    for what, cache_info in (('Phone number', get_e164_number.cache_info()), ('NANP heuristic', get_nanp_number.cache_info())):
+        print(f">> {cache_info.hits:6} {what} lookups answered from the cache ({cache_info.misses} worked out, {cache_info.currsize} cached)")
+    resolution_hits, resolution_misses = contacts_oracle.get_resolution_counts()
+    print(f">> {resolution_hits:6} Contact lookups answered from the cache ({resolution_misses} worked out)")
     if counters['conflict_warnings'] > 0:
         print(">> Recap of conflict info warnings:")
         for name, numbers in conflicting_contacts.items():
@@ -1315,28 +3170,215 @@ def print_counters(contacts_filename, sms_backup_filename, vm_backup_filename, c
         print(">> Recap of missing or unresolved contacts (not including disallowed numbers):")
         print(f">>    {missing_contacts}")
     
-def write_real_headers(sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename):
+# Writes the headers of the files whose header_first is as given. The counts are the usual counters,
+# or for the headers that go first, what count_output_records() worked out.
+def write_real_headers(counts, header_first):
     print()
 
-    with open(sms_backup_filename, 'r+') as backup_file:
-        backup_file.write(XML_HEADER)
-        backup_file.write(f'<smses count="{counters["number_of_voice_sms_output"]}">\n')
+    if sms_backup_file.header_first == header_first:
+        sms_backup_file.write_real_header(XML_HEADER + f'<smses count="{counts["number_of_voice_sms_output"]}">\n')
 
     ################
-    with open(vm_backup_filename, 'r+') as backup_file:
-        backup_file.write(XML_HEADER)
-        backup_file.write(f'<smses count="{counters["number_of_vms_output"]}">\n')
+    if vm_backup_file.header_first == header_first:
+        vm_backup_file.write_real_header(XML_HEADER + f'<smses count="{counts["number_of_vms_output"]}">\n')
 
     ################
-    with open(call_backup_filename, 'r+') as backup_file:
-        backup_file.write(XML_HEADER)
-        backup_file.write(f'<calls count="{counters["number_of_calls_output"]}">\n')
+    if call_backup_file.header_first == header_first:
+        call_backup_file.write_real_header(XML_HEADER + f'<calls count="{counts["number_of_calls_output"]}">\n')
 
     ################
-    with open(chat_backup_filename, 'r+') as backup_file:
-        backup_file.write(XML_HEADER)
-        backup_file.write(f'<smses count="{counters["number_of_chat_sms_output"]}">\n')
-
+    if chat_backup_file.header_first == header_first:
+        chat_backup_file.write_real_header(XML_HEADER + f'<smses count="{counts["number_of_chat_sms_output"]}">\n')
+
+# For outputs whose header has to be written first (see BackupFile), the counts in the headers are
+# worked out before the 2nd pass, so that everything after the header can go straight into the
+# output as it's made. The Voice counts come from what the 1st pass kept. Counting the chat records
+# means reading each group's messages.json an extra time, so that's only done if the chat file needs
+# it, and by the worker processes if there are some.
+def count_output_records(voice_file_records, chat_subdirectories):
+    counts = dict.fromkeys(('number_of_voice_sms_output', 'number_of_vms_output', 'number_of_calls_output', 'number_of_chat_sms_output'), 0)
+    for voice_file_record in voice_file_records:
+        sms_count, vm_count, call_count = count_voice_file_records(voice_file_record)
+        counts['number_of_voice_sms_output'] += sms_count
+        counts['number_of_vms_output'] += vm_count
+        counts['number_of_calls_output'] += call_count
+    if chat_backup_file.header_first:
+        if worker_pool:
+            counts['number_of_chat_sms_output'] = sum(worker_pool.map(count_chat_messages, chat_subdirectories))
+        else:
+            counts['number_of_chat_sms_output'] = sum(count_chat_messages(subdirectory) for subdirectory in chat_subdirectories)
+    return counts
+
+# The headers that went first can't be fixed afterwards, so make sure what they said came true.
+def check_header_counts(header_counts):
+    for backup_file, counter_name in ((sms_backup_file, 'number_of_voice_sms_output'), (vm_backup_file, 'number_of_vms_output'),
+                                      (call_backup_file, 'number_of_calls_output'), (chat_backup_file, 'number_of_chat_sms_output')):
+        if backup_file.header_first and header_counts[counter_name] != counters[counter_name]:
+            raise Exception(f'The header of {get_aka_path(backup_file.name)} says {header_counts[counter_name]} records, but {counters[counter_name]} were written. It\'s probably a bug in the script.')
+
+
+# The output files. Once everything else has been written, the dummy header at the top is replaced
+# by one with the real count. For a plain file, that's done by seeking back to the start and writing
+# over it. A compressed file can't be written over, and neither can an output that isn't a regular
+# file (a named pipe, or something like "/dev/fd/63" from the shell). For those, the header is written
+# first instead, with counts worked out before the 2nd pass (see count_output_records()), and everything
+# after it goes straight into the output as it's made. Anything written before that (just the comment
+# after the header) is kept until then. For --compression, the compressing is done by a background thread
+# (the compressors let go of the GIL while they work), so it happens at the same time as converting
+# the Takeout files.
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_BZ2 = 'bz2'
+COMPRESSION_XZ = 'xz'
+COMPRESSION_EXTENSIONS = {COMPRESSION_GZIP: '.gz', COMPRESSION_BZ2: '.bz2', COMPRESSION_XZ: '.xz'}
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+COMPRESSION_QUEUE_LENGTH = 16  # chunks waiting for the background thread
+
+def get_compressor(compression):
+    if compression == COMPRESSION_GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+ is for the gzip format
+    if compression == COMPRESSION_BZ2:
+        return bz2.BZ2Compressor()
+    if compression == COMPRESSION_XZ:
+        return lzma.LZMACompressor()
+    raise Exception(f'Unknown compression "{compression}"')
+
+def get_compressed_filename(filename, compression):
+    extension = COMPRESSION_EXTENSIONS.get(compression, '')
+    if extension and not filename.endswith(extension) and is_seekable_output(filename):
+        return filename + extension
+    return filename
+
+def is_seekable_output(filename):
+    if is_stdout_output(filename):
+        return False
+    try:
+        return stat.S_ISREG(os.stat(filename).st_mode)
+    except OSError:
+        return True  # it doesn't exist yet, so it will be a regular file
+
+# For an output file that is standard output. Everything the script prints (the ">>" lines and the
+# rest) goes to standard error instead. That's done underneath Python, on the file descriptors, so
+# that it covers the worker processes as well.
+STDOUT_FILENAMES = ('-', '/dev/stdout', '/proc/self/fd/1', '/dev/fd/1')
+stdout_output_fd = None  # where standard output really goes
+
+def is_stdout_output(filename):
+    return filename in STDOUT_FILENAMES
+
+def send_stdout_to_stderr():
+    global stdout_output_fd
+    sys.stdout.flush()
+    stdout_output_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+# For prep_output_files(). Only a regular file (or a link to one) is renamed to ".BAK", never
+# something like /dev/stdout, a named pipe, or a link to something under /dev or /proc.
+def can_back_up_output(filename):
+    if is_stdout_output(filename) or not os.path.lexists(filename):
+        return False
+    if os.path.abspath(filename).startswith(('/dev/', '/proc/')):
+        return False
+    if stat.S_ISLNK(os.lstat(filename).st_mode) and os.path.abspath(os.path.join(os.path.dirname(filename), os.readlink(filename))).startswith(('/dev/', '/proc/')):
+        return False
+    return is_seekable_output(filename)
+
+class BackupFile:
+    def __init__(self, filename, compression):
+        self.name = filename
+        self.header_first = compression != COMPRESSION_NONE or not is_seekable_output(filename)
+        self._dummy_header = ''
+        self._real_header = None
+        self._early_writes = list()  # for header_first, what's written before the real header
+        if is_stdout_output(filename):
+            filename = stdout_output_fd
+        if compression == COMPRESSION_NONE:
+            self._file = open(filename, 'w', encoding='utf-8', newline='\n')
+            self._compressor = None
+            if not self.header_first:
+                self.write = self._file.write  # nothing in between for the plain case
+            return
+        self._compressor = get_compressor(compression)
+        self._file = open(filename, 'wb')
+        self._pending = list()
+        self._pending_size = 0
+        self._chunks = queue.Queue(maxsize=COMPRESSION_QUEUE_LENGTH)
+        self._thread_exception = None
+        self._thread = threading.Thread(target=self._compress_chunks, name='Compress ' + os.path.basename(self.name), daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, text):
+        if self.header_first and self._real_header is None:
+            self._early_writes.append(text)
+            return len(text)
+        if not self._compressor:
+            return self._file.write(text)
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= COMPRESSION_CHUNK_SIZE:
+            self._send_pending()
+        return len(text)
+
+    def write_dummy_header(self, header):
+        self._dummy_header = header
+        if not self.header_first:
+            self._file.write(header)
+
+    # The real header must not be longer than the dummy header. The rest of the dummy
+    # header (padding) is left as is, so the file is the same either way.
+    def write_real_header(self, header):
+        self._real_header = header + self._dummy_header[len(header):]
+        if self.header_first:
+            self.write(self._real_header)
+            for text in self._early_writes:
+                self.write(text)
+            self._early_writes.clear()
+        else:
+            self._file.seek(0)
+            self._file.write(header)
+            self._file.seek(0, os.SEEK_END)
+
+    # One write can be a whole attachment, so what's pending is cut up into chunks of the usual size,
+    # to keep the queue from holding more than COMPRESSION_QUEUE_LENGTH of those.
+    def _send_pending(self):
+        pending = ''.join(self._pending).encode('utf-8')
+        self._pending.clear()
+        self._pending_size = 0
+        for start in range(0, len(pending), COMPRESSION_CHUNK_SIZE):
+            self._chunks.put(pending[start:start + COMPRESSION_CHUNK_SIZE])
+
+    def _compress_chunks(self):
+        try:
+            while True:
+                chunk = self._chunks.get()
+                if chunk is None:
+                    break
+                self._file.write(self._compressor.compress(chunk))
+            self._file.write(self._compressor.flush())
+        except BaseException as e:
+            self._thread_exception = e
+            while self._chunks.get() is not None:
+                pass  # keep write() from waiting forever
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.header_first and self._real_header is None:
+            self.write_real_header('')  # something went wrong; the dummy header will have to do
+        if self._compressor:
+            if self._pending:
+                self._send_pending()
+            self._chunks.put(None)
+            self._thread.join()
+        self._file.close()
+        if self._compressor and self._thread_exception:
+            raise self._thread_exception
 
 def write_trailers():
     sms_backup_file.write('</smses>\n')
@@ -1346,7 +3388,7 @@ def write_trailers():
 
 def prep_output_files(sms_backup_filename, vm_backup_filename, call_backup_filename, chat_backup_filename):
     sms_backup_filename_BAK = sms_backup_filename + '.BAK'
-    if os.path.exists(sms_backup_filename):
+    if can_back_up_output(sms_backup_filename):
         if os.path.exists(sms_backup_filename_BAK):
             print('>> Removing', os.path.abspath(sms_backup_filename_BAK))
             os.remove(sms_backup_filename_BAK)
@@ -1357,7 +3399,7 @@ def prep_output_files(sms_backup_filename, vm_backup_filename, call_backup_filen
     print(">>")
 
     call_backup_filename_BAK = call_backup_filename + '.BAK'
-    if os.path.exists(call_backup_filename):
+    if can_back_up_output(call_backup_filename):
         if os.path.exists(call_backup_filename_BAK):
             print('>> Removing', os.path.abspath(call_backup_filename_BAK))
             os.remove(call_backup_filename_BAK)
@@ -1368,7 +3410,7 @@ def prep_output_files(sms_backup_filename, vm_backup_filename, call_backup_filen
     print(">>")
 
     vm_backup_filename_BAK = vm_backup_filename + '.BAK'
-    if os.path.exists(vm_backup_filename):
+    if can_back_up_output(vm_backup_filename):
         if os.path.exists(vm_backup_filename_BAK):
             print('>> Removing', os.path.abspath(vm_backup_filename_BAK))
             os.remove(vm_backup_filename_BAK)
@@ -1379,7 +3421,7 @@ def prep_output_files(sms_backup_filename, vm_backup_filename, call_backup_filen
     print(">>")
 
     chat_backup_filename_BAK = chat_backup_filename + '.BAK'
-    if os.path.exists(chat_backup_filename):
+    if can_back_up_output(chat_backup_filename):
         if os.path.exists(chat_backup_filename_BAK):
             print('>> Removing', os.path.abspath(chat_backup_filename_BAK))
             os.remove(chat_backup_filename_BAK)
@@ -1409,12 +3451,10 @@ def get_name_or_number_from_filename(html_basename):
     return (contact_name_from_filename, phone_number_from_filename)
 
 
-def get_name_or_number_from_title():
+def get_name_or_number_from_title(title_value):
     global phone_number_from_html_title, contact_name_from_html_title
     phone_number_from_html_title = None
     contact_name_from_html_title = None
-    title_elt = html_elt.find('head').find('title')
-    title_value = title_elt.get_text()
     # Takeout puts a newline in the middle of the title
     split = title_value.split("\n")
     correspondent = split[len(split)-1].strip()
@@ -1436,17 +3476,15 @@ def get_name_or_number_from_title():
 # contacts list. Also make a note of a contact which is "not me" for
 # use as the address in an SMS record (it's always "the other end"). The
 # same logic does not apply to MMS, which has a different scheme for address.
-def scan_vcards_for_contacts(html_target, parent_elt):
+def scan_vcards_for_contacts(html_target, timestamp_ms, vcards):
     global me
     not_me_vcard_number = None
     # We make the simplifying assumption that the timestamps in any given HTML file
     # are close (enough) together and it doesn't matter much which one we use for
     # the contact timestamp. We also ignore milliseconds.
-    timestamp = get_time_unix_ms(parent_elt) / 1000
+    timestamp = timestamp_ms / 1000
     
-    vcard_elts = parent_elt.find_all(class_="vcard")
-    for vcard_elt in vcard_elts:
-        this_number, this_name = get_number_and_name_from_tel_elt_parent(vcard_elt)
+    for this_number, this_name in vcards:
         if this_number:
             if this_name != "Me":
                 not_me_vcard_number = this_number
@@ -1467,27 +3505,40 @@ def scan_vcards_for_contacts(html_target, parent_elt):
                     conflicting_contacts[this_name] = conflict_list
     return not_me_vcard_number
 
+# The (number, name) pairs of all of the vcards under some element, for later use by scan_vcards_for_contacts().
+def get_vcards(parent_elt):
+    vcards = list()
+    for vcard_elt in parent_elt.find_all(class_="vcard"):
+        this_number, this_name = get_number_and_name_from_tel_elt_parent(vcard_elt)
+        if this_number:
+            vcards.append((this_number, this_name))
+    return vcards
+
 def get_number_and_name_from_tel_elt_parent(parent_elt):
-    this_name = None
-    this_number = None
     tel_elt = parent_elt.find(class_='tel')
     if not tel_elt:
         return None, None
     href_attr = tel_elt['href']
+    fn_elt = parent_elt.find(class_="fn")
+    return get_number_and_name_from_href_and_fn(href_attr, fn_elt.get_text() if fn_elt else None)
+
+def get_number_and_name_from_href_and_fn(href_attr, fn_text):
+    this_name = None
+    this_number = None
     if href_attr:
         if href_attr.startswith("tel:"):
             href_attr = href_attr[4:]
         if not href_attr:
             return None, None  # this shouldn't happen
         this_number = href_attr
-        fn_elt = parent_elt.find(class_="fn")
-        if not fn_elt:
+        if fn_text is None:
             return this_number, None
-        this_name = fn_elt.get_text()
+        this_name = fn_text
         # Sometimes the "name" ends up being a repeat of the phone number, which is useless for us
         if not this_name or is_phone_number(this_name):
             return this_number, None
     return this_number, this_name
 
-main()
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Run sms.py over a Takeout tree (usually one made by make_takeout.py) and measure how long each
+# stage takes, how fast it goes, how much memory it uses, and how much it writes. Results can be
+# saved as a baseline and later runs compared against it.
+#
+# The stages are found by watching for the ">>" lines that sms.py prints as it moves along:
+#     setup   start-up, reading the contacts file, and scanning the directories
+#     pass1   the 1st pass over the Google Voice HTML files
+#     pass2   the 2nd pass, writing the Google Voice records
+#     chat    the Google Chat groups
+#     finish  rewriting the headers and the reports at the end
+# Output bytes for a stage are however much the output files grew while it ran, so they lag a bit
+# behind because of buffering. Peak RSS for a stage is for the main process only (where /proc
+# has it). The overall peak RSS is for the biggest single process, including any workers.
+#
+# Any arguments after "--" are passed along to sms.py. For example:
+#     python make_takeout.py --scale 5
+#     python benchmark.py --save_baseline
+#     (change something)
+#     python benchmark.py -- --jobs 4
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SMS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sms.py')
+
+STAGES = ('setup', 'pass1', 'pass2', 'chat', 'finish')
+# the line that starts each stage after the first
+STAGE_MARKERS = (
+    ('pass1',  '>> 1st pass'),
+    ('pass2',  '>> 2nd pass'),
+    ('chat',   '>> Reading chat files'),
+    ('finish', '>> Counters:'),
+    )
+# only the record counts; the others can change with options like --jobs without the output changing
+COUNTER_PATTERN = re.compile(r'^>> +(\d+) (.*) written to ')
+
+OUTPUT_NAMES = ('sms-gvoice.xml', 'sms-vm-gvoice.xml', 'calls-gvoice.xml', 'sms-chat.xml')
+
+# For comparing against the baseline, whether a bigger number is better or worse. Anything
+# not listed is just shown.
+LOWER_IS_BETTER = ('wall_seconds', 'peak_rss_kb')
+HIGHER_IS_BETTER = ('files_per_second', 'records_per_second')
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark sms.py, stage by stage, and compare against a baseline.',
+                                        epilog='Arguments after "--" are passed to sms.py.')
+    argparser.add_argument('-d', '--takeout_directory', default=os.path.join('synthetic', 'Takeout'),
+                           help='The "Takeout" directory to run sms.py in. Defaults to "%(default)s".')
+    argparser.add_argument('-r', '--runs', type=int, default=3,
+                           help='How many times to run sms.py. The median of each number is reported. Defaults to %(default)s.')
+    argparser.add_argument('-b', '--baseline_filename', default='benchmark-baseline.json',
+                           help='JSON file with the results to compare against. Defaults to "%(default)s".')
+    argparser.add_argument('--save_baseline', action='store_true',
+                           help='Save these results as the new baseline instead of comparing against it.')
+    argparser.add_argument('--tolerance', type=float, default=0.10,
+                           help='How much worse than the baseline (as a fraction) counts as a regression. Defaults to %(default)s.')
+    argparser.add_argument('-o', '--results_filename', default=None,
+                           help='Also write the results of this run as JSON to this file.')
+    argparser.add_argument('sms_args', nargs='*', help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    takeout_directory = os.path.abspath(args.takeout_directory)
+    if not os.path.isdir(takeout_directory):
+        raise Exception(f'No such Takeout directory {takeout_directory}. Make one with make_takeout.py.')
+    inputs = count_inputs(takeout_directory)
+    print(f">> {inputs['html_files']} HTML files, {inputs['chat_groups']} chat groups, and {inputs['input_bytes']} bytes under {takeout_directory}")
+
+    all_results = list()
+    with tempfile.TemporaryDirectory(prefix='sms-benchmark-') as output_directory:
+        for run_number in range(1, args.runs + 1):
+            results = run_once(takeout_directory, output_directory, inputs, args.sms_args)
+            print(f">> Run {run_number}: {results['total']['wall_seconds']:.2f} seconds")
+            all_results.append(results)
+    results = {
+        'sms_args': args.sms_args,
+        'inputs': inputs,
+        'runs': args.runs,
+        'stages': {stage: median_of([results['stages'][stage] for results in all_results]) for stage in STAGES},
+        'total': median_of([results['total'] for results in all_results]),
+        'counters': all_results[-1]['counters'],
+        }
+    print_results(results)
+    if args.results_filename:
+        write_json(args.results_filename, results)
+
+    if args.save_baseline:
+        write_json(args.baseline_filename, results)
+        print('>> Saved baseline to', os.path.abspath(args.baseline_filename))
+    elif os.path.exists(args.baseline_filename):
+        with open(args.baseline_filename) as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare_results(baseline, results, args.tolerance):
+            sys.exit(1)
+    else:
+        print('>> No baseline to compare against in', os.path.abspath(args.baseline_filename))
+
+def count_inputs(takeout_directory):
+    inputs = {'html_files': 0, 'chat_groups': 0, 'input_files': 0, 'input_bytes': 0}
+    for directory, __, filenames in os.walk(takeout_directory):
+        for filename in filenames:
+            inputs['input_files'] += 1
+            inputs['input_bytes'] += os.path.getsize(os.path.join(directory, filename))
+            if filename.endswith('.html'):
+                inputs['html_files'] += 1
+            elif filename == 'messages.json':
+                inputs['chat_groups'] += 1
+    return inputs
+
+def run_once(takeout_directory, output_directory, inputs, sms_args):
+    output_filenames = [os.path.join(output_directory, output_name) for output_name in OUTPUT_NAMES]
+    command = [sys.executable, '-u', SMS_SCRIPT,
+               '-s', output_filenames[0], '-v', output_filenames[1], '-c', output_filenames[2], '-t', output_filenames[3]]
+    command.extend(sms_args)
+    stage_starts = dict()
+    stage_output_bytes = dict()
+    stage_rss = dict()
+    counters = dict()
+    log_lines = list()
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, cwd=takeout_directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, encoding='utf-8', errors='replace')
+    stage = 'setup'
+    stage_starts[stage] = start_time
+    stage_output_bytes[stage] = 0
+    for line in process.stdout:
+        log_lines.append(line)
+        line = line.rstrip('\n')
+        for next_stage, marker in STAGE_MARKERS:
+            if line.startswith(marker) and STAGES.index(next_stage) > STAGES.index(stage):
+                stage_rss[stage] = get_peak_rss_kb(process.pid)
+                stage = next_stage
+                stage_starts[stage] = time.perf_counter()
+                stage_output_bytes[stage] = get_output_bytes(output_filenames)
+                break
+        if stage == 'finish':
+            match = COUNTER_PATTERN.match(line)
+            if match:
+                counters[match.group(2)] = int(match.group(1))
+    stage_rss[stage] = get_peak_rss_kb(process.pid)
+    __, status, rusage = os.wait4(process.pid, 0)
+    end_time = time.perf_counter()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.stdout.writelines(log_lines[-20:])
+        raise Exception(f'sms.py exited with status {process.returncode}')
+    total_output_bytes = get_output_bytes(output_filenames)
+
+    # a stage that never started (like chat, when there is no chat directory) took no time
+    stage_ends = dict()
+    next_start = end_time
+    for stage in reversed(STAGES):
+        if stage in stage_starts:
+            stage_ends[stage] = next_start
+            next_start = stage_starts[stage]
+    voice_records = sum(count for name, count in counters.items() if 'from Google Voice' in name)
+    chat_records = sum(count for name, count in counters.items() if 'from Google Chat' in name)
+    stages = dict()
+    for stage in STAGES:
+        if stage not in stage_starts:
+            stages[stage] = {'wall_seconds': 0.0, 'output_bytes': 0, 'peak_rss_kb': None}
+            continue
+        seconds = stage_ends[stage] - stage_starts[stage]
+        following = [other for other in STAGES[STAGES.index(stage) + 1:] if other in stage_output_bytes]
+        output_bytes_after = stage_output_bytes[following[0]] if following else total_output_bytes
+        stages[stage] = {'wall_seconds': seconds,
+                         'output_bytes': output_bytes_after - stage_output_bytes[stage],
+                         'peak_rss_kb': stage_rss.get(stage)}
+    for stage, files, records in (('pass1', inputs['html_files'], None),
+                                  ('pass2', inputs['html_files'], voice_records),
+                                  ('chat', inputs['chat_groups'], chat_records)):
+        seconds = stages[stage]['wall_seconds']
+        stages[stage]['files_per_second'] = files / seconds if seconds else None
+        if records is not None:
+            stages[stage]['records_per_second'] = records / seconds if seconds else None
+    total_seconds = end_time - start_time
+    total = {'wall_seconds': total_seconds,
+             'files_per_second': inputs['input_files'] / total_seconds,
+             'records_per_second': (voice_records + chat_records) / total_seconds,
+             'peak_rss_kb': rusage.ru_maxrss,
+             'output_bytes': total_output_bytes}
+    return {'stages': stages, 'total': total, 'counters': counters}
+
+def get_output_bytes(output_filenames):
+    return sum(os.path.getsize(output_filename) for output_filename in output_filenames if os.path.exists(output_filename))
+
+# the high water mark of the resident set size, in kB, if this is a system with /proc
+def get_peak_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def median_of(metrics_list):
+    medians = dict()
+    for name in metrics_list[0]:
+        values = [metrics[name] for metrics in metrics_list if metrics.get(name) is not None]
+        medians[name] = statistics.median(values) if values else None
+    return medians
+
+def print_results(results):
+    print(f">> Median of {results['runs']} runs:")
+    print(f">> {'stage':8} {'seconds':>9} {'files/s':>10} {'records/s':>10} {'peak RSS kB':>12} {'output bytes':>14}")
+    for stage in STAGES + ('total',):
+        metrics = results['total'] if stage == 'total' else results['stages'][stage]
+        print(f">> {stage:8} {format_number(metrics.get('wall_seconds'), 9, '.2f')} {format_number(metrics.get('files_per_second'), 10, '.1f')}"
+              f" {format_number(metrics.get('records_per_second'), 10, '.1f')} {format_number(metrics.get('peak_rss_kb'), 12, '.0f')}"
+              f" {format_number(metrics.get('output_bytes'), 14, '.0f')}")
+
+def format_number(value, width, spec):
+    if value is None:
+        return ' ' * (width - 1) + '-'
+    return f'{value:{width}{spec}}'
+
+# Print how these results differ from the baseline. Returns False if anything got worse by more than the tolerance.
+def compare_results(baseline, results, tolerance):
+    all_good = True
+    if baseline.get('inputs') != results['inputs']:
+        print(">> Warning: the baseline was made with different input files, so the comparison doesn't mean much")
+    if baseline.get('sms_args') != results['sms_args']:
+        print(f">> Warning: the baseline was made with sms.py arguments {baseline.get('sms_args')}")
+    print('>> Compared with the baseline:')
+    for stage in STAGES + ('total',):
+        metrics = results['total'] if stage == 'total' else results['stages'][stage]
+        baseline_metrics = baseline['total'] if stage == 'total' else baseline['stages'].get(stage, {})
+        for name, value in metrics.items():
+            baseline_value = baseline_metrics.get(name)
+            if value is None or not baseline_value:
+                continue
+            change = (value - baseline_value) / baseline_value
+            worse = (name in LOWER_IS_BETTER and change > tolerance) or (name in HIGHER_IS_BETTER and -change > tolerance)
+            # small stages jump around too much to be worth complaining about
+            if worse and name != 'peak_rss_kb' and metrics['wall_seconds'] < 0.1 and baseline_metrics['wall_seconds'] < 0.1:
+                worse = False
+            if worse:
+                all_good = False
+            print(f">> {stage:8} {name:20} {baseline_value:14.2f} -> {value:14.2f} {change:+8.1%}{'  REGRESSION' if worse else ''}")
+    if results['counters'] != baseline.get('counters'):
+        print('>> Warning: the record counts are different from the baseline; the output has changed')
+        all_good = False
+    return all_good
+
+def write_json(json_filename, results):
+    with open(json_filename, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
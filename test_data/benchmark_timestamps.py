@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Micro-benchmark for the timestamp parsing in sms.py. Random timestamps in the two shapes Takeout
+# uses (the ISO 8601 "title" of a Google Voice message and the "created_date" of a Google Chat
+# message) are turned into epoch milliseconds, once through the fast path and once the old way,
+# through dateutil. It reports the cost per timestamp for each, and checks that they agree.
+#
+#     python benchmark_timestamps.py
+#     python benchmark_timestamps.py --count 100000
+
+import argparse
+import datetime
+import importlib.util
+import os
+import random
+import sys
+import time
+
+SMS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sms.py')
+
+OFFSETS = ('Z', '-08:00', '-07:00', '-05:00', '+00:00', '+01:00', '+05:30', '+09:00', '+13:45')
+
+def main():
+    argparser = argparse.ArgumentParser(description='Time the timestamp parsing in sms.py, with and without dateutil.')
+    argparser.add_argument('-n', '--count', type=int, default=20000,
+                           help='How many random timestamps of each shape. Defaults to %(default)s.')
+    argparser.add_argument('--seed', type=int, default=1,
+                           help='Seed for the random timestamps. Defaults to %(default)s.')
+    args = argparser.parse_args()
+
+    sms = load_sms_script()
+    rng = random.Random(args.seed)
+    iso_times = [make_iso_time(rng) for __ in range(args.count)]
+    chat_times = [make_chat_time(rng) for __ in range(args.count)]
+
+    print(f'{args.count} timestamps of each shape, microseconds per timestamp')
+    print(f'{"shape":<6} {"dateutil":>10} {"fast path":>10} {"speedup":>8}')
+    failures = 0
+    for shape, timestamps, fast_parser in (('ISO', iso_times, sms.unix_ms_from_iso_time), ('Chat', chat_times, sms.unix_ms_from_chat_time)):
+        def slow_parser(timestamp):
+            return sms.unix_time_ms_from_datetime(sms.datetime_from_string(timestamp))
+        slow_seconds, slow_results = time_parser(slow_parser, timestamps)
+        fast_seconds, fast_results = time_parser(fast_parser, timestamps)
+        slow_us = slow_seconds / len(timestamps) * 1e6
+        fast_us = fast_seconds / len(timestamps) * 1e6
+        print(f'{shape:<6} {slow_us:>10.1f} {fast_us:>10.1f} {slow_us / fast_us:>7.1f}x')
+        for timestamp, slow_result, fast_result in zip(timestamps, slow_results, fast_results):
+            if slow_result != fast_result:
+                print(f'MISMATCH: {timestamp}: dateutil {slow_result}, fast path {fast_result}')
+                failures += 1
+    sys.exit(1 if failures else 0)
+
+def load_sms_script():
+    spec = importlib.util.spec_from_file_location('sms', SMS_SCRIPT)
+    sms = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sms)
+    return sms
+
+def time_parser(parser, timestamps):
+    start_time = time.perf_counter()
+    results = [parser(timestamp) for timestamp in timestamps]
+    return time.perf_counter() - start_time, results
+
+def make_datetime(rng):
+    return datetime.datetime(2008, 1, 1) + datetime.timedelta(seconds=rng.randrange(16 * 365 * 86400))
+
+def make_iso_time(rng):
+    dt = make_datetime(rng)
+    fraction = f'.{rng.randrange(1000):03}' if rng.random() < 0.5 else ''
+    return dt.strftime('%Y-%m-%dT%H:%M:%S') + fraction + rng.choice(OFFSETS)
+
+def make_chat_time(rng):
+    dt = make_datetime(rng)
+    hour = dt.hour % 12 or 12
+    return f'{dt:%A, %B} {dt.day}, {dt.year} at {hour}:{dt:%M:%S} {"PM" if dt.hour >= 12 else "AM"} UTC'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# Make a synthetic Google Takeout tree, as big as you like, for performance work on sms.py.
+# The hand-made test data next to this script is for checking that the output is right, but
+# it's much too small to say anything about speed. The files written here copy the layout of
+# real Takeout files (including the boilerplate that makes them bigger than they need to be)
+# for every kind of Google Voice file sms.py knows about, plus Google Chat groups. The names,
+# numbers, and words are made up, and the attachments are random bytes of a realistic size.
+#
+# The output directory ends up like a test_data directory:
+#     OUTPUT_DIRECTORY/contacts.json
+#     OUTPUT_DIRECTORY/Takeout/Voice/Calls/...
+#     OUTPUT_DIRECTORY/Takeout/Google Chat/Groups/...
+# so you can run sms.py from OUTPUT_DIRECTORY/Takeout with the default options.
+# The same --seed always makes the same files.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+from html import escape
+
+ME_NAME = "Pat Q Owner"
+ME_EMAIL = "pqowner@example.com"
+ME_NUMBER = "+17325550100"
+
+FIRST_NAMES = ["Ada", "Blaise", "Carl", "Dorothy", "Emmy", "Felix", "Grace", "Henri", "Irene", "Johannes",
+               "Katherine", "Leonhard", "Mary", "Niels", "Olga", "Pierre", "Rosalind", "Sofia", "Tycho", "Ursula"]
+LAST_NAMES = ["Lovelace", "Pascal", "Gauss", "Hodgkin", "Noether", "Klein", "Hopper", "Poincare", "Joliot",
+              "Kepler", "Johnson", "Euler", "Somerville", "Bohr", "Ladyzhenskaya", "Curie", "Franklin",
+              "Kovalevskaya", "Brahe", "LeGuin"]
+WORDS = ("the quick brown fox jumps over a lazy dog while we wait for the train and talk about "
+         "lunch tomorrow maybe pizza or tacos call me when you get home did you see that new "
+         "movie I think it starts at eight don't forget the tickets ok sounds good see you soon "
+         "running late traffic is terrible can you pick up milk thanks love you bye & <3").split()
+
+# These are the same as in real Takeout files. They make up much of the size of a small file.
+CHAT_LOG_STYLE = '''<style type="text/css">
+          /* Copyright 2011 Google Inc.  All Rights Reserved. */
+
+body {
+  font-size: 13px;
+  font-family: Arial, Helvectica, sans-serif;
+}
+
+a {
+  color: #00c;
+}
+
+a:hover {
+  text-decoration: underline;
+}
+
+.tags,
+.hChatLog,
+.noteContainer,
+.deletedStatusContainer{
+  margin: 0 auto;
+  width: 750px;
+  min-width: 750px;
+}
+
+.message {
+  max-width: 640px;
+}
+
+/* The following three style rules exist to override default behavior in the
+ * user-agent stylesheet used by common browsers such as Chrome. */
+cite {
+  font-style: normal;
+}
+
+q::before {
+  content: "";
+}
+
+q::after {
+  content: "";
+}
+
+.tags,
+.noteContainer {
+  margin-top: 13px;
+}
+
+.participants {
+  margin-bottom: 13px;
+}
+
+.deletedStatusContainer {
+  margin-bottom: 13px;
+}
+
+        </style>'''
+
+CALL_LOG_STYLE = '''<style type="text/css">
+        /* Copyright 2011 Google Inc.  All Rights Reserved. */
+
+body {
+  font-size: 13px;
+  font-family: Arial, Helvectica, sans-serif;
+}
+
+a {
+  color: #00c;
+}
+
+a:hover {
+  text-decoration: underline;
+}
+
+.haudio {
+  margin: 0 auto;
+  width: 750px;
+  min-width: 750px;
+}
+
+.album {
+  display: block;
+  font-size: 110%;
+  line-height:200%;
+}
+
+.haudio > .fn {
+  display: none;
+}
+
+.contributor {
+  font-size: 110%;
+  font-weight: bold;
+}
+
+.published {
+  display: block;
+}
+
+.tags,
+.noteContainer {
+  margin-top: 13px;
+}
+
+audio {
+  display: block;
+}
+
+.start-time,
+.end-time,
+.confidence {
+  display: none;
+}
+
+.high {
+  color: #000;
+}
+
+.med {
+  color: #555;
+}
+
+.low {
+  color: #888;
+}
+
+.full-text {
+  display: none;
+}
+
+.recording-warning-message {
+  color: #000; /* Black */
+}
+
+.recording-error-message {
+  color: #f00; /* Red */
+}
+      </style>'''
+
+HTML_START = ('<?xml version="1.0" ?>\n'
+              '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'
+              '<html xmlns="http://www.w3.org/1999/xhtml"><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />\n')
+
+DELETED_STATUS = '<div class="deletedStatusContainer">User Deleted:\nFalse</div>'
+
+# Takeout writes local times. These files pretend everybody lives in one place with no daylight saving time.
+LOCAL_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+
+# the file extension for each kind of MMS attachment
+ATTACHMENT_KINDS = {
+    'image': '.jpg',
+    'audio': '.mp3',
+    'video': '.mp4',
+    'vcard': '.vcf',
+    }
+
+# some globals, rather than toting them around in every function call
+rng = random.Random()
+args = None
+counts = {
+    'voice_html_files': 0,
+    'voice_messages':   0,
+    'chat_groups':      0,
+    'chat_messages':    0,
+    'attachment_files': 0,
+    'attachment_bytes': 0,
+    }
+# content for --duplicate_fraction to pick from, by kind
+attachment_contents = {kind: list() for kind in ATTACHMENT_KINDS}
+
+def main():
+    global args
+    argparser = argparse.ArgumentParser(description='Make a synthetic Google Takeout tree for performance testing of sms.py.')
+    argparser.add_argument('-o', '--output_directory', default='synthetic',
+                           help='Directory to make. "Takeout" and "contacts.json" go inside it. Anything already there is removed. Defaults to "%(default)s".')
+    argparser.add_argument('--seed', type=int, default=1,
+                           help='Seed for the random choices. Defaults to %(default)s.')
+    argparser.add_argument('--scale', type=float, default=1.0,
+                           help='Multiplier for all of the file counts below. Defaults to %(default)s.')
+    argparser.add_argument('--contacts', type=int, default=200,
+                           help='Number of other people. Defaults to %(default)s.')
+    argparser.add_argument('--text_files', type=int, default=400,
+                           help='Number of one-to-one "Text" HTML files. Defaults to %(default)s.')
+    argparser.add_argument('--group_files', type=int, default=60,
+                           help='Number of "Group Conversation" HTML files. Defaults to %(default)s.')
+    argparser.add_argument('--messages_per_file', type=int, default=25,
+                           help='Average number of messages in a Text or Group Conversation file. Defaults to %(default)s.')
+    argparser.add_argument('--call_files', type=int, default=600,
+                           help='Number of Received, Placed, and Missed call HTML files, all together. Defaults to %(default)s.')
+    argparser.add_argument('--voicemail_files', type=int, default=80,
+                           help='Number of Voicemail HTML files. Defaults to %(default)s.')
+    argparser.add_argument('--recorded_files', type=int, default=10,
+                           help='Number of Recorded call HTML files. Defaults to %(default)s.')
+    argparser.add_argument('--chat_groups', type=int, default=30,
+                           help='Number of Google Chat groups. Defaults to %(default)s.')
+    argparser.add_argument('--messages_per_chat', type=int, default=200,
+                           help='Average number of messages in a Google Chat group. Defaults to %(default)s.')
+    argparser.add_argument('--attachment_fraction', type=float, default=0.1,
+                           help='Fraction of messages that have attachments. Defaults to %(default)s.')
+    argparser.add_argument('--duplicate_fraction', type=float, default=0.2,
+                           help='Fraction of attachments that are copies of an earlier one, like a forwarded picture. Defaults to %(default)s.')
+    argparser.add_argument('--image_size', type=int, default=150*1024,
+                           help='Average size in bytes of an image attachment. Defaults to %(default)s.')
+    argparser.add_argument('--audio_size', type=int, default=250*1024,
+                           help='Average size in bytes of an audio attachment or voicemail recording. Defaults to %(default)s.')
+    argparser.add_argument('--video_size', type=int, default=2*1024*1024,
+                           help='Average size in bytes of a video attachment. Defaults to %(default)s.')
+    args = argparser.parse_args()
+    rng.seed(args.seed)
+
+    output_directory = args.output_directory
+    voice_directory = os.path.join(output_directory, 'Takeout', 'Voice', 'Calls')
+    chat_directory = os.path.join(output_directory, 'Takeout', 'Google Chat', 'Groups')
+    if os.path.exists(output_directory):
+        print('>> Removing', os.path.abspath(output_directory))
+        shutil.rmtree(output_directory)
+    os.makedirs(voice_directory)
+    os.makedirs(chat_directory)
+
+    people = make_people(args.contacts)
+    write_contacts_file(os.path.join(output_directory, 'contacts.json'), people)
+    print('>> Writing Google Voice files to', os.path.abspath(voice_directory))
+    for __ in range(scaled(args.text_files)):
+        write_text_file(voice_directory, [rng.choice(people)])
+    for __ in range(scaled(args.group_files)):
+        write_text_file(voice_directory, rng.sample(people, min(len(people), rng.randint(2, 6))))
+    for __ in range(scaled(args.call_files)):
+        write_call_file(voice_directory, rng.choice(people), rng.choice(('Received', 'Placed', 'Missed')))
+    for __ in range(scaled(args.voicemail_files)):
+        write_call_file(voice_directory, rng.choice(people), 'Voicemail')
+    for __ in range(scaled(args.recorded_files)):
+        write_call_file(voice_directory, rng.choice(people), 'Recorded')
+    print('>> Writing Google Chat files to', os.path.abspath(chat_directory))
+    named_people = [person for person in people if person[0]]
+    for group_number in range(scaled(args.chat_groups)):
+        write_chat_group(chat_directory, group_number, rng.sample(named_people, min(len(named_people), rng.randint(1, 4))))
+
+    print(">> Counts:")
+    print(f">> {counts['voice_html_files']:8} Google Voice HTML files")
+    print(f">> {counts['voice_messages']:8} Google Voice messages and calls")
+    print(f">> {counts['chat_groups']:8} Google Chat groups")
+    print(f">> {counts['chat_messages']:8} Google Chat messages")
+    print(f">> {counts['attachment_files']:8} Attachment files")
+    print(f">> {counts['attachment_bytes']:8} Attachment bytes")
+
+def scaled(count):
+    return max(0, round(count * args.scale))
+
+# A person is (name, number, email). Some people don't have a name, the way it goes with
+# numbers that aren't in your Google Contacts, so those only show up as numbers.
+def make_people(how_many):
+    people = list()
+    numbers = rng.sample(range(2000000, 9999999), how_many)
+    for ii, number in enumerate(numbers):
+        name = f'{FIRST_NAMES[ii % len(FIRST_NAMES)]} {chr(ord("A") + (ii // len(FIRST_NAMES)) % 26)} {LAST_NAMES[(ii * 7) % len(LAST_NAMES)]}'
+        if ii >= len(FIRST_NAMES) * 26:
+            name = f'{name} {ii}'
+        email = name.lower().replace(' ', '.') + '@example.com'
+        if rng.random() < 0.1:
+            name = None
+        people.append((name, f'+1732{number}', email))
+    return people
+
+def write_contacts_file(contacts_filename, people):
+    contacts = {"Me": ME_NUMBER, ME_NAME: "Me", ME_EMAIL: "Me"}
+    # Like a real one, this only has some of the people in it. The rest are discovered in the HTML files.
+    # Google Chat only knows people by name and email, so the emails are all here.
+    for name, number, email in people:
+        if name and rng.random() < 0.3:
+            contacts[name] = number
+        contacts[email] = number
+    with open(contacts_filename, 'w', encoding='utf-8') as contacts_file:
+        json.dump(contacts, contacts_file, indent=2, ensure_ascii=False)
+
+def random_time():
+    start = datetime.datetime(2012, 1, 1, tzinfo=datetime.timezone.utc)
+    return start + datetime.timedelta(seconds=rng.randrange(12 * 365 * 24 * 3600), milliseconds=rng.randrange(1000))
+
+def filename_time(when):
+    return when.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H_%M_%SZ')
+
+def html_time(when):
+    local = when.astimezone(LOCAL_TIMEZONE)
+    iso = local.strftime('%Y-%m-%dT%H:%M:%S.') + f'{local.microsecond // 1000:03d}' + local.strftime('%z')[:3] + ':' + local.strftime('%z')[3:]
+    readable = f'{local.strftime("%b")} {local.day}, {local.year}, {local.hour % 12 or 12}:{local.strftime("%M:%S")}&#8239;{local.strftime("%p")}\nPacific Time'
+    return iso, readable
+
+def random_text():
+    return ' '.join(rng.choice(WORDS) for __ in range(rng.randint(1, 40)))
+
+def vcard_for(name, number):
+    return f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{escape(name or number)}</span></a></cite>'
+
+def me_vcard():
+    return f'<cite class="sender vcard"><a class="tel" href="tel:{ME_NUMBER}"><abbr class="fn" title="">Me</abbr></a></cite>'
+
+def attachment_content(kind, name, number):
+    if kind == 'vcard':
+        return (f'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:{name or number}\r\nTEL;TYPE=CELL:{number}\r\nEND:VCARD\r\n').encode('utf-8')
+    contents = attachment_contents[kind]
+    if contents and rng.random() < args.duplicate_fraction:
+        return rng.choice(contents)
+    average_size = {'image': args.image_size, 'audio': args.audio_size, 'video': args.video_size}[kind]
+    content = rng.randbytes(max(1, int(rng.uniform(0.2, 1.8) * average_size)))
+    # keep a few around for duplicates, without hanging on to every byte written
+    if len(contents) < 20:
+        contents.append(content)
+    else:
+        contents[rng.randrange(len(contents))] = content
+    return content
+
+def write_attachment_file(path, content):
+    with open(path, 'wb') as attachment_file:
+        attachment_file.write(content)
+    counts['attachment_files'] += 1
+    counts['attachment_bytes'] += len(content)
+
+# The HTML for one MMS attachment. Like Takeout, the reference leaves off the file extension.
+def attachment_html(kind, file_ref):
+    file_ref = escape(file_ref)
+    if kind == 'image':
+        return f'<div><img src="{file_ref}" alt="Image MMS Attachment" /></div>'
+    if kind == 'audio':
+        return f'<div><audio controls="controls" src="{file_ref}"><a rel="enclosure" href="{file_ref}">Audio</a></audio></div>'
+    if kind == 'video':
+        return f'<div><a class="video" href="{file_ref}">Video MMS Attachment</a></div>'
+    return f'<div><a class="vcard" href="{file_ref}">Contact card attachment</a></div>'
+
+# A "Text" file, either one-to-one or a "Group Conversation", with every message on the same day.
+def write_text_file(voice_directory, others):
+    when = random_time()
+    is_group = len(others) > 1
+    name, number, __ = others[0]
+    if is_group:
+        stem = f'Group Conversation - {filename_time(when)}'
+        title = 'Group Conversation'
+    else:
+        stem = f'{name or number} - Text - {filename_time(when)}'
+        title = f'Me to\n{escape(name or "")}'
+    pieces = [HTML_START, f'<title>{title}</title>\n', CHAT_LOG_STYLE, '</head>\n<body><div class="hChatLog hfeed">']
+    if is_group:
+        pieces.append('<div class="participants">Group conversation with:\n')
+        pieces.append(', '.join(vcard_for(name, number) for name, number, __ in others))
+        pieces.append('</div>')
+    pieces.append('\n')
+    message_count = max(1, int(rng.expovariate(1 / args.messages_per_file)))
+    messages = list()
+    for message_number in range(1, message_count + 1):
+        when += datetime.timedelta(seconds=rng.randint(1, 600), milliseconds=rng.randrange(1000))
+        iso, readable = html_time(when)
+        sent_by_me = rng.random() < 0.4
+        message = [f'<div class="message"><abbr class="dt" title="{iso}">{readable}</abbr>:\n']
+        sender_name, sender_number, __ = rng.choice(others)
+        message.append(me_vcard() if sent_by_me else vcard_for(sender_name, sender_number))
+        message.append(':\n')
+        if rng.random() < args.attachment_fraction:
+            kinds = rng.choices(list(ATTACHMENT_KINDS), weights=(70, 10, 10, 10), k=rng.choice((1, 1, 1, 2)))
+            message.append('<q>MMS Sent</q>\n' if sent_by_me else '<q>MMS Received</q>\n')
+            attachment_htmls = list()
+            for attachment_number, kind in enumerate(kinds, start=1):
+                file_ref = f'{stem}-{message_number}-{attachment_number}'
+                vcard_name, vcard_number, __ = rng.choice(others)
+                write_attachment_file(os.path.join(voice_directory, file_ref + ATTACHMENT_KINDS[kind]), attachment_content(kind, vcard_name, vcard_number))
+                attachment_htmls.append(attachment_html(kind, file_ref))
+            message.append(' '.join(attachment_htmls))
+        else:
+            message.append(f'<q>{escape(random_text())}</q>\n')
+        message.append('</div>')
+        messages.append(''.join(message))
+        counts['voice_messages'] += 1
+    pieces.append(' '.join(messages))
+    pieces.append('</div>\n\n<div class="tags">Labels:\n<a rel="tag" href="http://www.google.com/voice#sms">Text</a>')
+    if rng.random() < 0.5:
+        pieces.append(', <a rel="tag" href="http://www.google.com/voice#inbox">Inbox</a>')
+    pieces.append(f'</div>\n{DELETED_STATUS}</body></html>')
+    write_html_file(os.path.join(voice_directory, stem + '.html'), pieces)
+
+CALL_TITLES = {
+    'Received':  'Received call from',
+    'Placed':    'Placed call to',
+    'Missed':    'Missed call from',
+    'Voicemail': 'Voicemail from',
+    'Recorded':  'Recorded call with',
+    }
+
+# A call log file: Received, Placed, Missed, Voicemail, or Recorded
+def write_call_file(voice_directory, person, label):
+    name, number, __ = person
+    when = random_time()
+    stem = f'{name or number} - {label} - {filename_time(when)}'
+    call_title = CALL_TITLES[label]
+    iso, readable = html_time(when)
+    pieces = [HTML_START, f'<title>{call_title}\n{escape(name or "")}</title>\n', CALL_LOG_STYLE, '</head>\n']
+    pieces.append('<body><div class="haudio"><span class="album">Call Log for\n</span>\n')
+    pieces.append(f'<span class="fn">{call_title}\n{escape(name or "")}</span>\n')
+    pieces.append(f'<div class="contributor vcard">{call_title}\n<a class="tel" href="tel:{number}"><span class="fn">{escape(name or "")}</span></a></div>\n')
+    pieces.append(f'<abbr class="published" title="{iso}">{readable}</abbr>\n')
+    seconds = 0 if label == 'Missed' else rng.randint(0, 3600)
+    if label == 'Voicemail':
+        words = [random_text() for __ in range(rng.randint(1, 3))]
+        pieces.append(f'Transcript:\n<span class="description"><span class="full-text">{escape(" ".join(words))}</span>\n')
+        start_time = 0.0
+        for word in ' '.join(words).split():
+            end_time = start_time + rng.uniform(0.1, 0.6)
+            confidence = rng.random()
+            level = 'high' if confidence > 0.8 else 'med' if confidence > 0.5 else 'low'
+            pieces.append(f'<span class="word {level}">{escape(word)}\n<span class="start-time">{start_time:.7g}</span>\n'
+                          f'<span class="end-time">{end_time:.7g}</span>\n<span class="confidence">{confidence:.8f}</span></span> ')
+            start_time = end_time
+        pieces.append('</span>\n')
+        seconds = rng.randint(3, 120)
+    if label in ('Voicemail', 'Recorded'):
+        audio_filename = stem + '.mp3'
+        write_attachment_file(os.path.join(voice_directory, audio_filename), attachment_content('audio', name, number))
+        pieces.append(f'\n<br />\n<audio controls="controls" src="{escape(audio_filename)}"><a rel="enclosure" href="{escape(audio_filename)}">Audio</a></audio>\n\n')
+    if label != 'Missed':
+        hours, remainder = divmod(seconds, 3600)
+        minutes, seconds_left = divmod(remainder, 60)
+        duration = 'PT' + (f'{hours}H' if hours else '') + (f'{minutes}M' if minutes else '') + f'{seconds_left}S'
+        pieces.append(f'\n<br />\n<abbr class="duration" title="{duration}">({hours:02d}:{minutes:02d}:{seconds_left:02d})</abbr>\n')
+    label_tags = [f'<a rel="tag" href="http://www.google.com/voice#{label.lower()}">{label}</a>']
+    if label != 'Placed' and rng.random() < 0.5:
+        label_tags.append('<a rel="tag" href="http://www.google.com/voice#inbox">Inbox</a>')
+    pieces.append(f'\n<div class="tags">Labels:\n{", ".join(label_tags)}</div>\n{DELETED_STATUS}</div></body></html>')
+    write_html_file(os.path.join(voice_directory, stem + '.html'), pieces)
+    counts['voice_messages'] += 1
+
+def write_html_file(html_filename, pieces):
+    with open(html_filename, 'w', encoding='utf-8', newline='\n') as html_file:
+        html_file.write(''.join(pieces))
+    counts['voice_html_files'] += 1
+
+# A Google Chat "DM" (with one other person) or "Space" (more than one).
+def write_chat_group(chat_directory, group_number, others):
+    is_space = len(others) > 1
+    group_id = f'{"Space" if is_space else "DM"} AAAA{group_number:07d}'
+    group_directory = os.path.join(chat_directory, group_id)
+    os.makedirs(group_directory)
+    members = [{"name": name, "email": email, "user_type": "Human"} for name, __, email in others]
+    members.append({"name": ME_NAME, "email": ME_EMAIL, "user_type": "Human"})
+    group_info = {"members": members}
+    if is_space:
+        group_info = {"name": f"Space {group_number}", **group_info}
+    with open(os.path.join(group_directory, 'group_info.json'), 'w', encoding='utf-8') as group_info_file:
+        json.dump(group_info, group_info_file, indent=2)
+
+    messages = list()
+    export_names_used = dict()
+    when = random_time()
+    for message_number in range(max(1, int(rng.expovariate(1 / args.messages_per_chat)))):
+        when += datetime.timedelta(seconds=rng.randint(1, 6 * 3600))
+        creator = rng.choice(members)
+        message = {"creator": creator,
+                   "created_date": when.strftime('%A, %B ') + f'{when.day}, {when.year} at {when.hour % 12 or 12}:{when.strftime("%M:%S %p")} UTC'}
+        if rng.random() < args.attachment_fraction:
+            kind = rng.choices(('image', 'video', 'vcard'), weights=(80, 10, 10))[0]
+            original_name = f'{when.strftime("%Y-%m-%d")}{ATTACHMENT_KINDS[kind]}'
+            export_name = 'File-' + original_name
+            # Takeout numbers the export files when the names collide, just like sms.py expects
+            collisions = export_names_used.get(export_name, None)
+            export_names_used[export_name] = 0 if collisions is None else collisions + 1
+            root, ext = os.path.splitext(export_name)
+            if collisions is not None:
+                root = f'{root}({collisions + 1})'
+            name, number, __ = rng.choice(others)
+            write_attachment_file(os.path.join(group_directory, root + ext), attachment_content(kind, name, number))
+            message["attached_files"] = [{"original_name": original_name, "export_name": export_name}]
+        if "attached_files" not in message or rng.random() < 0.3:
+            message["text"] = random_text()
+        message["topic_id"] = f'{message_number:011d}'
+        message["message_id"] = f'{group_id.split()[1]}/{message_number:011d}/{message_number:011d}'
+        messages.append(message)
+    with open(os.path.join(group_directory, 'messages.json'), 'w', encoding='utf-8') as messages_file:
+        json.dump({"messages": messages}, messages_file, indent=2)
+    counts['chat_groups'] += 1
+    counts['chat_messages'] += len(messages)
+
+if __name__ == '__main__':
+    main()